@@ -1,41 +1,246 @@
-from flask import Flask, render_template, request, redirect, url_for, make_response, jsonify, flash, send_file
+from flask import Flask, render_template, request, redirect, url_for, make_response, jsonify, flash, send_file, session, g, has_app_context
+from markupsafe import Markup
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session as FlaskSQLAlchemySession
 from flask_wtf import FlaskForm
 from flask_wtf.csrf import CSRFProtect
-from wtforms import StringField, FloatField, SubmitField, SelectField, DateField
+from wtforms import StringField, FloatField, SubmitField, SelectField, DateField, HiddenField
 from wtforms.validators import DataRequired, Email, Optional
+from sqlalchemy import event, create_engine
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.pool import NullPool
 from datetime import datetime, date
 import csv
 import io
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-import shutil
 import os
 import json
+import gzip
+import sqlite3
+import threading
+import time
+import warnings
+from collections import OrderedDict
+import unicodedata
+import click
 from pathlib import Path
-from tkinter import Tk, filedialog, messagebox
+import numpy as np
+import forecast
+import downsample
+from timeline import StockTimeline
+
+try:
+    import brotli
+except ImportError:  # brotliは任意（未インストールならgzipのみ）
+    brotli = None
+
+# 使う機会の少ない任意の依存（openpyxl: 発注書のxlsx、pyarrow: 列指向エクスポート）は
+# 起動を遅くしないよう初回使用時に読み込む
+_optional_modules = {}
+
+def optional_import(name):
+    """任意の依存モジュールを読み込む（未インストールなら None。結果は覚えておく）"""
+    if name not in _optional_modules:
+        import importlib
+        try:
+            _optional_modules[name] = importlib.import_module(name)
+        except ImportError:
+            _optional_modules[name] = None
+    return _optional_modules[name]
 
 # 設定ファイルのパス
 CONFIG_FILE = 'config.json'
 
-def load_config():
-    """設定ファイルを読み込む"""
-    if os.path.exists(CONFIG_FILE):
+# config.json の項目と型（ここにない項目はそのまま残す）
+CONFIG_SCHEMA = {
+    'database_folder': str,
+    'site_databases': dict,
+    'webhooks': list,
+    'settings': dict,  # app.config の値（下の SETTINGS_SCHEMA のキーのみ）
+}
+
+# config.json の "settings" で上書きできる app.config の値と型
+SETTINGS_SCHEMA = {
+    'SECRET_KEY': str,
+    'SQLITE_PRAGMAS': dict,  # 接続ごとに実行する PRAGMA（例: {"busy_timeout": 5000, "cache_size": -20000}）
+    'READ_ROUTING': str,
+    'READ_SNAPSHOT_MAX_AGE': float,
+    'READ_SNAPSHOT_COPY_PAGES': int,
+    'READ_SNAPSHOT_COPY_PAUSE': float,
+    'ARCHIVE_AFTER_DAYS': int,
+    'ROW_CACHE_MAX_BYTES': int,
+    'TIMELINE_HORIZON_DAYS': int,
+    'LOT_ALLOCATION_STRATEGY': str,
+    'CONFLICT_RETRY_ATTEMPTS': int,
+    'COLUMNAR_CHUNK_ROWS': int,
+    'FORECAST_HISTORY_DAYS': int,
+    'FORECAST_REFRESH_SECONDS': float,
+    'WEBHOOK_BATCH_SIZE': int,
+    'WEBHOOK_MAX_ATTEMPTS': int,
+    'WEBHOOK_BACKOFF_SECONDS': float,
+    'WEBHOOK_POLL_SECONDS': float,
+    'WEBHOOK_TIMEOUT': float,
+    'REORDER_SERVICE_Z': float,
+    'REORDER_COVER_DAYS': int,
+    'REORDER_DEFAULT_LEAD_DAYS': float,
+    'CHART_MAX_POINTS': int,
+    'API_MAX_BATCH': int,
+    'API_PAGE_SIZE': int,
+    'IDEMPOTENCY_TTL_HOURS': float,
+    'JINJA_CACHE_DIR': str,  # テンプレートのバイトコードキャッシュ（空文字で無効）
+    'SERVER_HOST': str,  # 配布版（デスクトップ起動）の待ち受けアドレス
+    'SERVER_PORT': int,
+    'OPEN_BROWSER': bool,  # 起動完了時にブラウザを開くか
+    'DB_BUSY_WAIT_MS': float,  # この時間以上かかった書き込みをロック待ちとして数える
+    'PURGE_CHUNK_ROWS': int,
+    'PURGE_PAUSE_SECONDS': float,
+    'STOCK_MEMO_MAX_ENTRIES': int,
+    'STOCK_MEMO_PATH': (str, type(None)),  # 在庫計算キャッシュを共有する SQLite ファイル（null で無効）
+}
+
+# 環境変数による上書き（例: ZAIKO_DATABASE_FOLDER, ZAIKO_ROW_CACHE_MAX_BYTES）
+CONFIG_ENV_PREFIX = 'ZAIKO_'
+
+class ConfigError(ValueError):
+    """config.json（または環境変数）の内容が不正"""
+
+def check_config_value(name, value, expected):
+    """値が型に合うか確認する（float には int も可、int に bool は不可。expected は型のタプルも可）"""
+    if expected is float and isinstance(value, int) and not isinstance(value, bool):
+        return float(value)
+    if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+        names = ' / '.join(t.__name__ for t in expected) if isinstance(expected, tuple) else expected.__name__
+        raise ConfigError(f'{name} は {names} で指定してください（{value!r}）')
+    return value
+
+def validate_config(config):
+    """設定をスキーマで検証する（不正なら ConfigError）"""
+    if not isinstance(config, dict):
+        raise ConfigError('設定ファイルの最上位はオブジェクトにしてください')
+    for key, expected in CONFIG_SCHEMA.items():
+        if config.get(key) is not None:
+            config[key] = check_config_value(key, config[key], expected)
+    for key, value in (config.get('settings') or {}).items():
+        if key not in SETTINGS_SCHEMA:
+            raise ConfigError(f'settings.{key} は不明な設定です')
+        config['settings'][key] = check_config_value(f'settings.{key}', value, SETTINGS_SCHEMA[key])
+    return config
+
+def parse_env_value(name, text, expected):
+    if expected is str:
+        return text
+    if expected == (str, type(None)):
+        return text or None
+    try:
+        value = json.loads(text)
+    except ValueError:
+        raise ConfigError(f'環境変数 {name} の値を解釈できません: {text}')
+    return check_config_value(name, value, expected)
+
+class ConfigStore:
+    """config.json の読み書き
+
+    読み込んだ内容はファイルの更新時刻とサイズが変わるまで再利用する。書き込みは
+    同じフォルダの一時ファイルに書いてから置き換えるので、途中で落ちても壊れない。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp = None
+        self._config = None
+        self.loads = 0
+        self.hits = 0
+
+    def _file_stamp(self):
         try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self):
+        """ファイルの設定（環境変数の上書きは含まない）。戻り値は変更してよいコピー"""
+        import copy
+        
+        stamp = self._file_stamp()
+        with self._lock:
+            if self._config is not None and stamp == self._stamp:
+                self.hits += 1
+                return copy.deepcopy(self._config)
+            try:
+                if stamp is None:
+                    config = {}
+                else:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        config = validate_config(json.load(f))
+            except (ValueError, OSError) as e:
+                if self._config is None:
+                    raise ConfigError(f'設定ファイル {self.path} を読み込めません: {e}') from e
+                # 編集途中などで壊れている場合は、最後に読めた内容を使い続ける
+                # app の生成前にも呼ばれるので app.logger ではなく warnings で知らせる
+                warnings.warn(f'設定ファイル {self.path} を読み込めないため前回の設定を使います: {e}', RuntimeWarning, stacklevel=2)
+                return copy.deepcopy(self._config)
+            self._config, self._stamp = config, stamp
+            self.loads += 1
+            return copy.deepcopy(config)
+
+    def save(self, config):
+        """検証してから一時ファイル経由で置き換える"""
+        import tempfile
+        
+        config = validate_config(config)
+        folder = os.path.dirname(os.path.abspath(self.path))
+        with self._lock:
+            fd, temp_path = tempfile.mkstemp(prefix='.config-', suffix='.tmp', dir=folder)
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump(config, f, ensure_ascii=False, indent=2)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(temp_path, self.path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+            self._config, self._stamp = json.loads(json.dumps(config)), self._file_stamp()
+
+    def effective(self):
+        """ファイルの設定に環境変数（ZAIKO_<項目名>）の上書きを重ねたもの"""
+        config = self.load()
+        for key, expected in CONFIG_SCHEMA.items():
+            name = CONFIG_ENV_PREFIX + key.upper()
+            if key != 'settings' and name in os.environ:
+                config[key] = parse_env_value(name, os.environ[name], expected)
+        settings = config.setdefault('settings', {})
+        for key, expected in SETTINGS_SCHEMA.items():
+            name = CONFIG_ENV_PREFIX + key
+            if name in os.environ:
+                settings[key] = parse_env_value(name, os.environ[name], expected)
+        return config
+
+    def stats(self):
+        with self._lock:
+            return {'path': os.path.abspath(self.path), 'loads': self.loads, 'hits': self.hits}
+
+config_store = ConfigStore(CONFIG_FILE)
+
+def load_config():
+    """設定ファイルを読み込む（保存し直す用途向け。参照だけなら get_config() を使う）"""
+    return config_store.load()
 
 def save_config(config):
     """設定ファイルに保存"""
-    with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-        json.dump(config, f, ensure_ascii=False, indent=2)
+    config_store.save(config)
+
+def get_config():
+    """環境変数の上書きを含めた現在の設定"""
+    return config_store.effective()
 
 def select_database_folder():
     """データベースフォルダを選択"""
+    from tkinter import Tk, filedialog
+    
     root = Tk()
     root.withdraw()
     root.attributes('-topmost', True)
@@ -50,13 +255,15 @@ def select_database_folder():
 
 def get_database_path():
     """データベースパスを取得または設定"""
-    config = load_config()
+    config = get_config()
     
     # 設定にデータベースフォルダがあるか確認
-    if 'database_folder' in config and os.path.exists(config['database_folder']):
+    if config.get('database_folder') and os.path.exists(config['database_folder']):
         db_folder = config['database_folder']
     else:
-        # フォルダ選択ダイアログを表示
+        # フォルダ選択ダイアログを表示（tkinter はこのときだけ読み込む）
+        from tkinter import Tk, messagebox
+        
         root = Tk()
         root.withdraw()
         root.attributes('-topmost', True)
@@ -76,6 +283,7 @@ def get_database_path():
             os.makedirs(db_folder, exist_ok=True)
         
         # 設定を保存
+        config = load_config()
         config['database_folder'] = db_folder
         save_config(config)
     
@@ -86,14 +294,527 @@ def get_database_path():
 # Flaskアプリケーションの初期化
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key'
+# config.json の "settings" と環境変数の値を先に入れる（以降の setdefault は既定値になる）
+app.config.update(get_config()['settings'])
+app.config.setdefault('SQLITE_PRAGMAS', {})
+
+# テンプレートのバイトコードキャッシュ（起動のたびにテンプレートをコンパイルし直さない）
+import tempfile
+app.config.setdefault('JINJA_CACHE_DIR', os.path.join(os.environ.get('LOCALAPPDATA') or tempfile.gettempdir(), 'zaiko', 'jinja_cache'))
+
+if app.config['JINJA_CACHE_DIR']:
+    from jinja2 import FileSystemBytecodeCache
+    try:
+        os.makedirs(app.config['JINJA_CACHE_DIR'], exist_ok=True)
+        app.jinja_env.bytecode_cache = FileSystemBytecodeCache(app.config['JINJA_CACHE_DIR'])
+    except OSError as e:
+        app.logger.warning(f'テンプレートキャッシュを使えません（{e}）')
+
+def precompile_templates():
+    """全テンプレートを読み込んでコンパイルしておく（バイトコードキャッシュにも書き出される）"""
+    names = [name for name in app.jinja_env.list_templates() if name.endswith('.html')]
+    for name in names:
+        app.jinja_env.get_template(name)
+    return names
 
 # データベースパスを取得
 db_path = get_database_path()
 app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
 
-db = SQLAlchemy(app)
+app.json.compact = True  # APIレスポンスは常にコンパクトなJSONで返す
+
+class ReadRoutingSession(FlaskSQLAlchemySession):
+    """read_only_route のリクエスト中は読み取り用エンジンに問い合わせるセッション"""
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_app_context() and g.get('read_engine') is not None:
+            return g.read_engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+db = SQLAlchemy(app, session_options={'class_': ReadRoutingSession})
 csrf = CSRFProtect(app)
 
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """設定 SQLITE_PRAGMAS の PRAGMA を新しい接続ごとに実行する"""
+    for name, value in app.config['SQLITE_PRAGMAS'].items():
+        if not name.replace('_', '').isalnum():
+            raise ConfigError(f'PRAGMA 名が不正です: {name}')
+        dbapi_connection.execute(f'PRAGMA {name} = {value}' if isinstance(value, (int, float))
+                                 else f"PRAGMA {name} = '{str(value).replace(chr(39), chr(39) * 2)}'")
+
+with app.app_context():
+    event.listen(db.engine, 'connect', apply_sqlite_pragmas)
+
+# SQLite のロック待ちの計測（/admin/db_stats、負荷テスト loadtest.py が前後の差分を表示する）
+#   lock_errors -- busy_timeout を過ぎて「database is locked / busy」で失敗した SQL
+#   busy_waits  -- 書き込みの SQL のうち DB_BUSY_WAIT_MS 以上かかったもの。SQLite は busy_timeout の間
+#                  ロックの取得を内部で再試行し、その回数は Python から取れないため、待ち時間で数える
+app.config.setdefault('DB_BUSY_WAIT_MS', 100)
+
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE', 'REPLACE')  # 最初の書き込みの実行中に書き込みロックを待つ
+
+class DatabaseStats:
+    """SQL の実行回数・ロック待ち・ロックエラー・楽観ロックの再実行回数（スレッドセーフ）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.statements = 0
+            self.busy_waits = 0
+            self.busy_wait_seconds = 0.0
+            self.lock_errors = 0
+            self.conflict_retries = 0
+
+    def record_statement(self, statement, seconds):
+        busy = seconds * 1000 >= app.config['DB_BUSY_WAIT_MS'] and statement.lstrip()[:7].upper().startswith(WRITE_STATEMENTS)
+        with self._lock:
+            self.statements += 1
+            if busy:
+                self.busy_waits += 1
+                self.busy_wait_seconds += seconds
+
+    def count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'statements': self.statements,
+                'busy_waits': self.busy_waits,
+                'busy_wait_seconds': round(self.busy_wait_seconds, 3),
+                'busy_wait_threshold_ms': app.config['DB_BUSY_WAIT_MS'],
+                'lock_errors': self.lock_errors,
+                'conflict_retries': self.conflict_retries
+            }
+
+database_stats = DatabaseStats()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statement_started', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info['statement_started'].pop()
+    database_stats.record_statement(statement, time.perf_counter() - started)
+
+@event.listens_for(Engine, 'handle_error')
+def count_lock_errors(context):
+    started = context.connection.info.get('statement_started') if context.connection is not None else None
+    if started:
+        started.pop()
+    message = str(context.original_exception).lower()
+    if isinstance(context.original_exception, sqlite3.OperationalError) and ('locked' in message or 'busy' in message):
+        database_stats.count('lock_errors')
+
+@app.after_request
+def compress_response(response):
+    """JSONレスポンスをAccept-Encodingに応じてbrotli/gzip圧縮する"""
+    if (response.mimetype != 'application/json' or response.direct_passthrough
+            or response.status_code != 200 or 'Content-Encoding' in response.headers):
+        return response
+    data = response.get_data()
+    if len(data) < 512:
+        return response
+    
+    accept = request.headers.get('Accept-Encoding', '').lower()
+    if brotli is not None and 'br' in accept:
+        response.set_data(brotli.compress(data, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif 'gzip' in accept:
+        response.set_data(gzip.compress(data, compresslevel=6))
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        return response
+    response.headers['Content-Length'] = len(response.get_data())
+    response.vary.add('Accept-Encoding')
+    return response
+
+# 重い読み取り専用エンドポイントの接続先
+#   'primary'  -- 書き込みと同じ接続（従来どおり）
+#   'readonly' -- 同じDBファイルを mode=ro / query_only の別接続で読む（常に最新）
+#   'snapshot' -- 定期的に複製したスナップショットを読む（本体の読み取りロックを持たない）
+app.config.setdefault('READ_ROUTING', 'readonly')
+app.config.setdefault('READ_SNAPSHOT_MAX_AGE', 60)  # スナップショットの最大経過秒数（超えたらバックグラウンドで取り直す）
+app.config.setdefault('READ_SNAPSHOT_COPY_PAGES', 256)  # 複製で1回に写すページ数（その間だけ本体の読み取りロックを持つ）
+app.config.setdefault('READ_SNAPSHOT_COPY_PAUSE', 0.01)  # 複製の各回の間に本体を空ける秒数
+
+_read_engines = {}
+_read_engines_lock = threading.Lock()
+_snapshot_lock = threading.Lock()
+_snapshot_refresher = None  # スナップショットを複製中のスレッド
+
+def read_only_engine(path):
+    """DBファイルを読み取り専用で開くエンジン（ファイルごとに1つ）
+
+    スナップショットの差し替え後に古いファイルを掴み続けないよう接続はプールしない。
+    """
+    with _read_engines_lock:
+        engine = _read_engines.get(path)
+        if engine is None:
+            uri = Path(os.path.abspath(path)).as_uri() + '?mode=ro'
+            engine = create_engine(
+                'sqlite://', poolclass=NullPool,
+                creator=lambda: sqlite3.connect(uri, uri=True, check_same_thread=False)
+            )
+            
+            @event.listens_for(engine, 'connect')
+            def set_query_only(dbapi_connection, connection_record):
+                dbapi_connection.execute('PRAGMA query_only = 1')
+            
+            _read_engines[path] = engine
+        return engine
+
+def snapshot_path():
+    return get_db_path() + '.snapshot'
+
+def snapshot_age(path):
+    """スナップショットの経過秒数（まだなければ None）"""
+    try:
+        return time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+
+def copy_snapshot(db_path, path, pages, pause):
+    """SQLite のオンラインバックアップで一時ファイルに複製してから置き換える
+
+    pages ページずつ写し、各回の間は pause 秒待つ。読み取りロックは1回の間だけ持つので、
+    複製中も本体への書き込みは止まらない。
+    """
+    temp_path = path + '.tmp'
+    source = sqlite3.connect(Path(os.path.abspath(db_path)).as_uri() + '?mode=ro', uri=True)
+    target = sqlite3.connect(temp_path)
+    try:
+        source.backup(target, pages=pages, progress=lambda status, remaining, total: time.sleep(pause))
+    finally:
+        target.close()
+        source.close()
+    os.replace(temp_path, path)
+
+def refresh_snapshot(max_age=None):
+    """スナップショットの経過秒数を返し、max_age 秒より古ければバックグラウンドで取り直す
+
+    取り直している間は既存のスナップショットをそのまま使う。まだ一度も作られていなければ None。
+    """
+    global _snapshot_refresher
+    max_age = app.config['READ_SNAPSHOT_MAX_AGE'] if max_age is None else max_age
+    path = snapshot_path()
+    age = snapshot_age(path)
+    if age is not None and age <= max_age:
+        return age
+    with _snapshot_lock:
+        if _snapshot_refresher is None or not _snapshot_refresher.is_alive():
+            db_path = get_db_path()
+            pages = app.config['READ_SNAPSHOT_COPY_PAGES']
+            pause = app.config['READ_SNAPSHOT_COPY_PAUSE']
+            
+            def run():
+                try:
+                    copy_snapshot(db_path, path, pages, pause)
+                except (OSError, sqlite3.Error) as e:
+                    app.logger.warning('スナップショットの更新に失敗しました: %s', e)
+            
+            _snapshot_refresher = threading.Thread(target=run, name='snapshot-refresh', daemon=True)
+            _snapshot_refresher.start()
+    return age
+
+def read_only_route(view):
+    """重い読み取り専用エンドポイントを READ_ROUTING の接続先に振り分けるデコレーター
+
+    レスポンスヘッダーで接続先（X-Data-Source）とデータの経過秒数（X-Data-Staleness）を返す。
+    """
+    from functools import wraps
+    
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        mode = app.config['READ_ROUTING']
+        staleness = 0.0
+        if mode == 'snapshot':
+            staleness = refresh_snapshot()
+            if staleness is None:
+                # 最初の複製が終わるまでは本体を読み取り専用で読む
+                mode = 'readonly'
+                staleness = 0.0
+            else:
+                g.read_engine = read_only_engine(snapshot_path())
+        if mode == 'readonly':
+            g.read_engine = read_only_engine(get_db_path())
+        
+        response = make_response(view(*args, **kwargs))
+        response.headers['X-Data-Source'] = mode if mode in ('readonly', 'snapshot') else 'primary'
+        response.headers['X-Data-Staleness'] = f'{staleness:.1f}'
+        if mode == 'snapshot':
+            response.headers['X-Data-Max-Staleness'] = str(app.config['READ_SNAPSHOT_MAX_AGE'])
+        return response
+    return wrapper
+
+def compute_critical_periods(current_stock, min_weight, reservations):
+    """現在の在庫量から予約を時系列に適用し、最低重量を下回る期間を求める
+
+    reservations は予定日順に並んだ (scheduled_date, type, quantity) のリスト。
+    """
+    min_weight = min_weight or 0.0
+    
+    if not reservations:
+        # 予約がない場合、現在の在庫が最低重量を下回っているかチェック
+        if current_stock < min_weight:
+            return [{
+                'start_date': datetime.now().date(),
+                'end_date': None,
+                'min_stock': current_stock,
+                'shortage': min_weight - current_stock
+            }]
+        return []
+    
+    critical_periods = []
+    running_stock = current_stock
+    period_start = None
+    period_start_date = None
+    min_stock_in_period = running_stock
+    
+    # 現在の在庫が既に不足している場合
+    if running_stock < min_weight:
+        period_start = True
+        period_start_date = datetime.now().date()
+        min_stock_in_period = running_stock
+    
+    # 各予約を時系列で処理
+    for scheduled_date, type_, quantity in reservations:
+        # 予約実行前の在庫状態をチェック
+        prev_stock = running_stock
+        
+        # 予約を実行
+        if type_ == 'use':
+            running_stock -= quantity
+        else:  # replenish
+            running_stock += quantity
+        
+        # 使用予約で最低重量を下回った場合、期間開始
+        if type_ == 'use' and prev_stock >= min_weight and running_stock < min_weight:
+            period_start = True
+            period_start_date = scheduled_date
+            min_stock_in_period = running_stock
+        
+        # 既に期間中で、さらに在庫が減少
+        elif period_start and running_stock < min_weight:
+            min_stock_in_period = min(min_stock_in_period, running_stock)
+        
+        # 補充予約で最低重量を上回った場合、期間終了
+        if type_ == 'replenish' and period_start and running_stock >= min_weight:
+            critical_periods.append({
+                'start_date': period_start_date,
+                'end_date': scheduled_date,
+                'min_stock': min_stock_in_period,
+                'shortage': min_weight - min_stock_in_period
+            })
+            period_start = False
+            period_start_date = None
+            min_stock_in_period = running_stock
+    
+    # 最後の期間が終了していない場合
+    if period_start:
+        critical_periods.append({
+            'start_date': period_start_date,
+            'end_date': None,  # 終了日未定（補充予約が必要）
+            'min_stock': min_stock_in_period,
+            'shortage': min_weight - min_stock_in_period
+        })
+    
+    return critical_periods
+
+# 原料ごとの在庫計算（現在量・予測在庫・危機期間・使用統計）のメモ化
+#   キーは (原料ID, 関数名, 引数)、値は data_version つきで保持し、バージョンが変われば再計算する。
+#   data_version はロット・予約・原料の flush ごとに bump_material_versions が加算する。
+#   STOCK_MEMO_PATH を設定すると、同じファイルを使うプロセス（ワーカー）間で SQLite の
+#   第2層を共有する（プロセス内の LRU になければ読み、計算したら書き込む）。
+app.config.setdefault('STOCK_MEMO_MAX_ENTRIES', 4096)
+app.config.setdefault('STOCK_MEMO_PATH', None)
+
+class StockMemo:
+    """在庫計算結果の LRU（スレッドセーフ）と、任意の SQLite 第2層
+
+    返した値は他の呼び出しと共有されるので、呼び出し元で変更しないこと。
+    SQLite 層の読み書きに失敗しても計算結果はそのまま返す（キャッシュは取りこぼしてよい）。
+    """
+
+    def __init__(self, max_entries, path=None):
+        self.max_entries = max_entries
+        self.path = path
+        self._entries = OrderedDict()  # (material_id, name, args) -> (version, value)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.by_name = {}  # 関数名 -> [hits, misses]
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=0.2, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode = WAL')
+            connection.execute('PRAGMA synchronous = OFF')
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS stock_memo ('
+                'material_id INTEGER NOT NULL, name TEXT NOT NULL, args TEXT NOT NULL, '
+                'version INTEGER NOT NULL, value BLOB NOT NULL, PRIMARY KEY (material_id, name, args))'
+            )
+            self._local.connection = connection
+        return connection
+
+    def _disk_get(self, key, version):
+        import pickle
+        
+        try:
+            row = self._connection().execute(
+                'SELECT value FROM stock_memo WHERE material_id = ? AND name = ? AND args = ? AND version = ?',
+                (key[0], key[1], repr(key[2]), version)
+            ).fetchone()
+        except sqlite3.Error:
+            return None
+        return pickle.loads(row[0]) if row else None
+
+    def _disk_put(self, key, version, value):
+        import pickle
+        
+        try:
+            with self._connection() as connection:
+                connection.execute(
+                    'INSERT OR REPLACE INTO stock_memo (material_id, name, args, version, value) VALUES (?, ?, ?, ?, ?)',
+                    (key[0], key[1], repr(key[2]), version, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+                )
+        except sqlite3.Error:
+            pass
+
+    def _count(self, name, hit):
+        counts = self.by_name.setdefault(name, [0, 0])
+        counts[0 if hit else 1] += 1
+
+    def get(self, key, version):
+        """(見つかったか, 値)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._count(key[1], True)
+                return True, entry[1]
+        if self.path:
+            value = self._disk_get(key, version)
+            if value is not None:
+                self._store(key, version, value)
+                with self._lock:
+                    self.disk_hits += 1
+                    self._count(key[1], True)
+                return True, value
+        with self._lock:
+            self.misses += 1
+            self._count(key[1], False)
+        return False, None
+
+    def _store(self, key, version, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (version, value)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def put(self, key, version, value):
+        self._store(key, version, value)
+        if self.path:
+            self._disk_put(key, version, value)
+
+    def invalidate(self, material_id):
+        """原料のエントリを破棄（原料の削除時。IDが再利用されても古い値を返さない）"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == material_id]:
+                del self._entries[key]
+        if self.path:
+            try:
+                with self._connection() as connection:
+                    connection.execute('DELETE FROM stock_memo WHERE material_id = ?', (material_id,))
+            except sqlite3.Error:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+        if self.path:
+            try:
+                with self._connection() as connection:
+                    connection.execute('DELETE FROM stock_memo')
+            except sqlite3.Error:
+                pass
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups, 4) if lookups else None,
+                'evictions': self.evictions,
+                'disk_tier': self.path,
+                'by_function': {name: {'hits': hits, 'misses': misses} for name, (hits, misses) in self.by_name.items()}
+            }
+
+stock_memo = StockMemo(app.config['STOCK_MEMO_MAX_ENTRIES'], app.config['STOCK_MEMO_PATH'])
+
+@event.listens_for(db.session, 'after_flush')
+def mark_uncommitted_writes(session, flush_context):
+    session.info['uncommitted_writes'] = True
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def clear_uncommitted_writes(session):
+    session.info.pop('uncommitted_writes', None)
+
+def has_uncommitted_writes(session):
+    """flush 済み・未 flush の未コミットの変更があるか
+
+    その間に読んだ data_version は加算済みでも確定していない（ロールバックされると
+    次のコミットが同じ番号を使う）ので、バージョンをキーにしたキャッシュには使えない。
+    """
+    return bool(session.info.get('uncommitted_writes') or session.new or session.dirty or session.deleted)
+
+def memoize_stock_view(daily=False):
+    """RawMaterial のメソッドの結果を (原料ID, data_version) ごとにメモ化するデコレーター
+
+    daily=True は今日の日付に依存する計算（危機期間・期間集計）で、日付もキーに含める。
+    バージョンは計算の前後で読み、途中で別のコミットが入った場合は保存しない。
+    未コミットの変更があるトランザクションの中ではメモを使わずに計算する。
+    """
+    from functools import wraps
+    
+    def decorator(method):
+        name = method.__name__
+        
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            if self.id is None or has_uncommitted_writes(db.session):
+                return method(self, *args, **kwargs)
+            def current_version():
+                return db.session.query(RawMaterial.data_version).filter(RawMaterial.id == self.id).scalar()
+            key = (self.id, name, args + tuple(sorted(kwargs.items())) + ((date.today().isoformat(),) if daily else ()))
+            version = current_version()
+            found, value = stock_memo.get(key, version)
+            if found:
+                return value
+            value = method(self, *args, **kwargs)
+            if version is not None and current_version() == version:
+                stock_memo.put(key, version, value)
+            return value
+        return wrapper
+    return decorator
+
 class RawMaterial(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False)
@@ -103,165 +824,151 @@ class RawMaterial(db.Model):
     email = db.Column(db.String(120), nullable=True)  # 購入担当者メール
     excel_path = db.Column(db.String(500), nullable=True)  # エクセルファイルパス
     action_type = db.Column(db.String(20), default='none')  # 'email', 'excel', 'none'
+    data_version = db.Column(db.Integer, nullable=False, default=0)  # ロット・予約の変更ごとに加算（キャッシュ無効化用）
+    deleted_at = db.Column(db.DateTime, nullable=True, index=True)  # 削除済み（関連データはバックグラウンドで削除中）
 
+    @memoize_stock_view()
     def get_total_lot_weight(self):
         """全ロットの現在重量の合計"""
         return sum(lot.weight for lot in self.lots)
     
+    @memoize_stock_view()
     def get_predicted_stock(self):
         """現在量 + 未実行の補充予約 - 未実行の使用予約 = 予測在庫量（ロットの合計）"""
         total_current = self.get_total_lot_weight()
         # 実行済みの予約はカウントしない
-        replenish = sum(r.quantity for r in self.reservations if r.type == 'replenish' and not r.executed)
-        use = sum(r.quantity for r in self.reservations if r.type == 'use' and not r.executed)
+        pending = self.get_pending_reservations()
+        replenish = sum(r.quantity for r in pending if r.type == 'replenish')
+        use = sum(r.quantity for r in pending if r.type == 'use')
         return total_current + replenish - use
     
+    def get_pending_reservations(self):
+        """未実行の予約だけを取得（実行済みの履歴全体はロードしない）"""
+        return Reservation.query.filter_by(material_id=self.id, executed=False).order_by(
+            Reservation.scheduled_date, Reservation.id
+        ).all()
+    
     def is_low_stock_alert(self):
         """予測在庫が最低量を下回るかチェック（途中の期間も含む）"""
         # 途中で最低量を下回る期間がある場合もアラートとする
         critical_periods = self.get_critical_periods()
         return len(critical_periods) > 0
 
+    @memoize_stock_view(daily=True)
     def get_critical_periods(self):
         """最低重量を下回る期間を計算"""
-        from datetime import datetime, timedelta
-        
-        # 現在の在庫量
-        current_stock = self.get_total_lot_weight()
-        
         # 未実行の予約を日付順に取得
-        reservations = sorted(
-            [r for r in self.reservations if not r.executed and r.scheduled_date],
-            key=lambda x: x.scheduled_date
+        reservations = [r for r in self.get_pending_reservations() if r.scheduled_date]
+        return compute_critical_periods(
+            self.get_total_lot_weight(),
+            self.min_weight,
+            [(r.scheduled_date, r.type, r.quantity) for r in reservations]
         )
-        
-        if not reservations:
-            # 予約がない場合、現在の在庫が最低重量を下回っているかチェック
-            if current_stock < self.min_weight:
-                return [{
-                    'start_date': datetime.now().date(),
-                    'end_date': None,
-                    'min_stock': current_stock,
-                    'shortage': self.min_weight - current_stock
-                }]
-            return []
-        
-        critical_periods = []
-        running_stock = current_stock
-        period_start = None
-        period_start_date = None
-        min_stock_in_period = running_stock
-        
-        # 現在の在庫が既に不足している場合
-        if running_stock < self.min_weight:
-            period_start = True
-            period_start_date = datetime.now().date()
-            min_stock_in_period = running_stock
-        
-        # 各予約を時系列で処理
-        for reservation in reservations:
-            # 予約実行前の在庫状態をチェック
-            prev_stock = running_stock
-            
-            # 予約を実行
-            if reservation.type == 'use':
-                running_stock -= reservation.quantity
-            else:  # replenish
-                running_stock += reservation.quantity
-            
-            # 使用予約で最低重量を下回った場合、期間開始
-            if reservation.type == 'use' and prev_stock >= self.min_weight and running_stock < self.min_weight:
-                period_start = True
-                period_start_date = reservation.scheduled_date
-                min_stock_in_period = running_stock
-            
-            # 既に期間中で、さらに在庫が減少
-            elif period_start and running_stock < self.min_weight:
-                min_stock_in_period = min(min_stock_in_period, running_stock)
-            
-            # 補充予約で最低重量を上回った場合、期間終了
-            if reservation.type == 'replenish' and period_start and running_stock >= self.min_weight:
-                critical_periods.append({
-                    'start_date': period_start_date,
-                    'end_date': reservation.scheduled_date,
-                    'min_stock': min_stock_in_period,
-                    'shortage': self.min_weight - min_stock_in_period
-                })
-                period_start = False
-                period_start_date = None
-                min_stock_in_period = running_stock
-        
-        # 最後の期間が終了していない場合
-        if period_start:
-            critical_periods.append({
-                'start_date': period_start_date,
-                'end_date': None,  # 終了日未定（補充予約が必要）
-                'min_stock': min_stock_in_period,
-                'shortage': self.min_weight - min_stock_in_period
-            })
-        
-        return critical_periods
 
-    def get_usage_stats(self, period_days):
-        """指定期間の使用量・補充量を集計"""
-        from datetime import datetime, timedelta
-        
-        end_date = datetime.now()
-        start_date = end_date - timedelta(days=period_days)
-        
-        # 実行済みの予約のみを対象（実行日時が記録されているもの）
-        executed_reservations = [r for r in self.reservations if r.executed and r.executed_date]
+    @memoize_stock_view(daily=True)
+    def get_usage_stats(self, period_days, bucket='day', points=None):
+        """指定期間の使用量・補充量を集計（日別ロールアップから読み込み）
+
+        bucket: 'day' / 'week' / 'month' のいずれか。週・月単位の場合は
+        日別データを週初め（月曜）・月初の日付キーにまとめ直す。
+        points を指定すると、日単位の累積使用量・累積補充量を LTTB で
+        points 点程度に間引いた 'cumulative' も返す。
+        """
+        from datetime import timedelta
         
-        # 期間内の予約をフィルタ
-        period_reservations = [
-            r for r in executed_reservations 
-            if start_date <= r.executed_date <= end_date
-        ]
+        end_day = date.today()
+        start_day = end_day - timedelta(days=period_days - 1)
         
-        # 使用量と補充量を集計
-        total_used = sum(r.actual_quantity or r.quantity for r in period_reservations if r.type == 'use')
-        total_replenished = sum(r.actual_quantity or r.quantity for r in period_reservations if r.type == 'replenish')
+        rows = DailyUsageRollup.query.filter(
+            DailyUsageRollup.material_id == self.id,
+            DailyUsageRollup.day >= start_day,
+            DailyUsageRollup.day <= end_day
+        ).order_by(DailyUsageRollup.day).all()
         
-        # 日別データ
+        total_used = 0.0
+        total_replenished = 0.0
+        transaction_count = 0
         daily_data = {}
-        for r in period_reservations:
-            date_key = r.executed_date.strftime('%Y-%m-%d')
+        for row in rows:
+            total_used += row.used
+            total_replenished += row.replenished
+            transaction_count += row.tx_count
+            
+            date_key = bucket_start(row.day, bucket).strftime('%Y-%m-%d')
             if date_key not in daily_data:
                 daily_data[date_key] = {'used': 0, 'replenished': 0}
-            
-            if r.type == 'use':
-                daily_data[date_key]['used'] += r.actual_quantity or r.quantity
-            else:
-                daily_data[date_key]['replenished'] += r.actual_quantity or r.quantity
+            daily_data[date_key]['used'] += row.used
+            daily_data[date_key]['replenished'] += row.replenished
         
-        return {
+        stats = {
             'period_days': period_days,
-            'start_date': start_date.strftime('%Y-%m-%d'),
-            'end_date': end_date.strftime('%Y-%m-%d'),
+            'bucket': bucket,
+            'start_date': start_day.strftime('%Y-%m-%d'),
+            'end_date': end_day.strftime('%Y-%m-%d'),
             'total_used': round(total_used, 3),
             'total_replenished': round(total_replenished, 3),
             'net_change': round(total_replenished - total_used, 3),
             'daily_data': daily_data,
-            'transaction_count': len(period_reservations)
+            'transaction_count': transaction_count
         }
+        if points:
+            # 記録のない日も0として並べ、期間の先頭からの累積にする
+            used = np.zeros(period_days)
+            replenished = np.zeros(period_days)
+            for row in rows:
+                offset = (row.day - start_day).days
+                used[offset] += row.used
+                replenished[offset] += row.replenished
+            labels = [(start_day + timedelta(days=i)).strftime('%Y-%m-%d') for i in range(period_days)]
+            labels, series = downsample.downsample_series(labels, {
+                'used': np.round(np.cumsum(used), 3).tolist(),
+                'replenished': np.round(np.cumsum(replenished), 3).tolist()
+            }, points)
+            stats['cumulative'] = dict(series, dates=labels)
+        return stats
 
     def __repr__(self):
         return f'<RawMaterial {self.name}>'
 
+class Location(db.Model):
+    """保管場所（拠点・倉庫）"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)  # 拠点名
+    date_created = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return f'<Location {self.name}>'
+
 class Lot(db.Model):
     """ロット（原料の下位管理単位）"""
+    __table_args__ = (
+        db.Index('ix_lot_location_material', 'location_id', 'material_id'),
+        db.Index('ix_lot_material_expiry', 'material_id', 'expiry_date', 'date_created'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     material_id = db.Column(db.Integer, db.ForeignKey('raw_material.id'), nullable=False)
     lot_name = db.Column(db.String(100), nullable=False)  # ロット名
-    weight = db.Column(db.Float, nullable=False)  # ロットの重量
+    # Webhook の増減判定のため、期限切れのインスタンスに代入しても変更前の値を読み込む
+    weight = db.mapped_column(db.Float, nullable=False, active_history=True)  # ロットの重量
     date_created = db.Column(db.DateTime, default=db.func.current_timestamp())
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=True)  # 保管場所（未設定は拠点指定なし）
+    expiry_date = db.Column(db.Date, nullable=True)  # 使用期限（FEFO割当に使用）
+    version = db.Column(db.Integer, nullable=False, default=1)  # 楽観ロック用（更新のたびに+1）
 
     material = db.relationship('RawMaterial', backref=db.backref('lots', lazy=True, cascade='all, delete-orphan'))
+    location = db.relationship('Location')
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return f'<Lot {self.lot_name}>'
 
 class Reservation(db.Model):
+    __table_args__ = (
+        db.Index('ix_reservation_location_pending', 'location_id', 'executed', 'scheduled_date'),
+        # アーカイブ後も同じIDを使うので、削除（アーカイブ）済みのIDを再利用しない
+        {'sqlite_autoincrement': True},
+    )
     id = db.Column(db.Integer, primary_key=True)
     material_id = db.Column(db.Integer, db.ForeignKey('raw_material.id'), nullable=False)
     lot_id = db.Column(db.Integer, db.ForeignKey('lot.id'), nullable=True)  # 既存ロット指定（オプショナル）
@@ -274,13 +981,18 @@ class Reservation(db.Model):
     purpose = db.Column(db.String(200), nullable=True)  # 目的
     scheduled_date = db.Column(db.Date, nullable=True)  # 予定日
     date = db.Column(db.DateTime, default=db.func.current_timestamp())  # 登録日
-    executed = db.Column(db.Boolean, default=False)  # 実行済みかどうか
+    executed = db.mapped_column(db.Boolean, default=False, active_history=True)  # 実行済みかどうか（変更前の値も履歴に残す）
     executed_date = db.Column(db.DateTime, nullable=True)  # 実行日時
+    location_id = db.Column(db.Integer, db.ForeignKey('location.id'), nullable=True)  # 対象拠点
+    version = db.Column(db.Integer, nullable=False, default=1)  # 楽観ロック用（更新のたびに+1）
 
     material = db.relationship('RawMaterial', backref=db.backref('reservations', lazy=True, cascade='all, delete-orphan'))
+    location = db.relationship('Location')
     lot = db.relationship('Lot', backref=db.backref('reservations', lazy=True, cascade='all, delete-orphan'))
     recipe = db.relationship('Recipe', backref=db.backref('reservations', lazy=True))
 
+    __mapper_args__ = {'version_id_col': version}
+
     def is_overdue(self):
         """期限切れかどうかをチェック"""
         if not self.scheduled_date or self.executed:
@@ -290,6 +1002,62 @@ class Reservation(db.Model):
     def __repr__(self):
         return f'<Reservation {self.type} {self.quantity}>'
 
+class LotAllocation(db.Model):
+    """使用予約の実行時にどのロットから何を引き当てたかの記録"""
+    id = db.Column(db.Integer, primary_key=True)
+    reservation_id = db.Column(db.Integer, db.ForeignKey('reservation.id'), nullable=False, index=True)
+    lot_id = db.Column(db.Integer, db.ForeignKey('lot.id', ondelete='SET NULL'), nullable=True)
+    lot_name = db.Column(db.String(100), nullable=False)  # ロット削除後も追跡できるよう名前を保持
+    quantity = db.Column(db.Float, nullable=False)  # 引当量
+
+    reservation = db.relationship('Reservation', backref=db.backref('allocations', lazy=True, cascade='all, delete-orphan'))
+
+    def __repr__(self):
+        return f'<LotAllocation {self.lot_name} {self.quantity}>'
+
+class ReservationArchive(db.Model):
+    """古い実行済み予約の保管先（予約テーブルを小さく保つため archive_executed_reservations で移動）
+
+    id は元の予約IDをそのまま使う。
+    """
+    __tablename__ = 'reservation_archive'
+    __table_args__ = (
+        db.Index('ix_reservation_archive_material_executed', 'material_id', 'executed_date'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    material_id = db.Column(db.Integer, db.ForeignKey('raw_material.id'), nullable=False)
+    lot_id = db.Column(db.Integer, nullable=True)  # 元のロットID（ロット削除後も残る）
+    lot_name = db.Column(db.String(100), nullable=True)
+    recipe_id = db.Column(db.Integer, nullable=True)
+    type = db.Column(db.String(20), nullable=False)
+    quantity = db.Column(db.Float, nullable=False)
+    actual_quantity = db.Column(db.Float, nullable=True)
+    user_name = db.Column(db.String(100), nullable=True)
+    purpose = db.Column(db.String(200), nullable=True)
+    scheduled_date = db.Column(db.Date, nullable=True)
+    date = db.Column(db.DateTime, nullable=True)
+    executed = db.Column(db.Boolean, default=True)
+    executed_date = db.Column(db.DateTime, nullable=True)
+    location_id = db.Column(db.Integer, nullable=True)
+    archived_date = db.Column(db.DateTime, default=db.func.current_timestamp())  # アーカイブ日時
+
+    def __repr__(self):
+        return f'<ReservationArchive {self.type} {self.quantity}>'
+
+# アーカイブと予約テーブルで共通の列（履歴クエリの UNION ALL と移動に使う）
+HISTORY_COLUMNS = ('id', 'material_id', 'lot_id', 'lot_name', 'recipe_id', 'type', 'quantity',
+                   'actual_quantity', 'user_name', 'purpose', 'scheduled_date', 'date',
+                   'executed', 'executed_date', 'location_id')
+
+def executed_history():
+    """実行済み予約の履歴（予約テーブル + アーカイブ）をまとめたサブクエリ
+
+    履歴を集計するクエリはこれを使えば、アーカイブ済みかどうかを意識しなくてよい。
+    """
+    hot = db.select(*[getattr(Reservation, c) for c in HISTORY_COLUMNS]).where(Reservation.executed == True)
+    cold = db.select(*[getattr(ReservationArchive, c) for c in HISTORY_COLUMNS])
+    return db.union_all(hot, cold).subquery('history')
+
 class Recipe(db.Model):
     """複数原料の組み合わせ（レシピ）"""
     id = db.Column(db.Integer, primary_key=True)
@@ -315,83 +1083,719 @@ class RecipeItem(db.Model):
     def __repr__(self):
         return f'<RecipeItem {self.material.name} {self.quantity}>'
 
-class MaterialForm(FlaskForm):
-    name = StringField('Name', validators=[DataRequired()])
-    weight = FloatField('Weight (g)', validators=[Optional()], default=0.0)
-    min_weight = FloatField('Min Weight (g)', default=0.0)
-    action_type = SelectField('Action Type', choices=[('none', 'なにもしない'), ('email', 'メール連絡'), ('excel', 'エクセルを開く')], default='none')
-    email = StringField('Purchase Email', validators=[Optional(), Email()])
-    excel_path = StringField('Excel File Path', validators=[Optional()])
-    submit = SubmitField('Submit')
+class DailyUsageRollup(db.Model):
+    """原料ごとの日別使用量・補充量の集計（統計グラフ用）"""
+    __tablename__ = 'daily_usage_rollup'
+    material_id = db.Column(db.Integer, db.ForeignKey('raw_material.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)  # 実行日
+    used = db.Column(db.Float, nullable=False, default=0.0)  # 使用量合計
+    replenished = db.Column(db.Float, nullable=False, default=0.0)  # 補充量合計
+    tx_count = db.Column(db.Integer, nullable=False, default=0)  # 取引回数
+    adjusted = db.Column(db.Float, nullable=False, default=0.0)  # used のうち在庫調整（ロットの直接編集・削除）の分
 
-class LotForm(FlaskForm):
-    lot_name = StringField('Lot Name', validators=[DataRequired()])
-    weight = FloatField('Weight', validators=[DataRequired()])
-    submit = SubmitField('Submit')
+    def __repr__(self):
+        return f'<DailyUsageRollup {self.material_id} {self.day}>'
 
-class ReservationForm(FlaskForm):
-    lot_id = SelectField('Existing Lot (Optional)', coerce=int, validators=[Optional()])
-    lot_name = StringField('New Lot Name (Optional)', validators=[Optional()])
-    quantity = FloatField('Quantity', validators=[DataRequired()])
+def bucket_start(day, bucket):
+    """日付を集計単位（日・週・月）の開始日に丸める"""
+    from datetime import timedelta
+    
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    return day
 
-    user_name = StringField('User Name (Optional)', validators=[Optional()])
-    purpose = StringField('Purpose (Optional)', validators=[Optional()])
-    scheduled_date = DateField('Scheduled Date (Optional)', format='%Y-%m-%d', validators=[Optional()])
-    submit = SubmitField('Reserve')
+# ロットの直接編集・削除で自動作成される在庫調整の履歴（利用者は 'システム'）。
+# 実際の使用・補充ではないので、トレースにも需要予測にも含めない
+ADJUSTMENT_PURPOSE_PREFIXES = ('ロット直接編集', 'ロット削除')
 
-class RecipeForm(FlaskForm):
-    name = StringField('Recipe Name', validators=[DataRequired()])
-    description = StringField('Description (Optional)', validators=[Optional()])
-    submit = SubmitField('Save Recipe')
+def is_stock_adjustment(user_name, purpose):
+    return user_name == 'システム' and (purpose or '').startswith(ADJUSTMENT_PURPOSE_PREFIXES)
 
-@app.route('/')
-def index():
-    search = request.args.get('search', '')
-    sort_by = request.args.get('sort_by', 'name')
-    materials = RawMaterial.query
-    if search:
-        materials = materials.filter(RawMaterial.name.contains(search))
-    if sort_by == 'name':
-        materials = materials.order_by(RawMaterial.name)
-    elif sort_by == 'weight':
-        # ソート用: SQLでは直接計算できないため、Pythonでソート
-        materials = materials.all()
-        materials = sorted(materials, key=lambda m: m.get_total_lot_weight())
-        return render_template('index.html', materials=materials, search=search, sort_by=sort_by)
-    materials = materials.all()
-    return render_template('index.html', materials=materials, search=search, sort_by=sort_by)
+def stock_adjustment_clause(user_name, purpose):
+    """is_stock_adjustment の SQL 版（user_name / purpose は列）"""
+    return db.and_(user_name == 'システム',
+                   db.or_(*[purpose.startswith(prefix) for prefix in ADJUSTMENT_PURPOSE_PREFIXES]))
 
-@app.route('/add', methods=['GET', 'POST'])
-def add():
-    form = MaterialForm()
-    if form.validate_on_submit():
-        material = RawMaterial(
-            name=form.name.data, 
-            weight=form.weight.data if form.weight.data is not None else 0.0, 
-            unit='g',  # g固定
-            min_weight=form.min_weight.data,
-            email=form.email.data,
-            excel_path=form.excel_path.data,
-            action_type=form.action_type.data
+def record_daily_usage(reservation):
+    """実行済み予約を日別ロールアップに加算する（呼び出し元のトランザクション内で実行）"""
+    from sqlalchemy.dialects.sqlite import insert
+    
+    if not reservation.executed or not reservation.executed_date:
+        return
+    if reservation.type not in ('use', 'replenish'):
+        # 拠点間移動は全体の在庫量が変わらないため集計しない
+        return
+    quantity = reservation.actual_quantity or reservation.quantity
+    used = quantity if reservation.type == 'use' else 0.0
+    replenished = quantity if reservation.type == 'replenish' else 0.0
+    adjusted = used if is_stock_adjustment(reservation.user_name, reservation.purpose) else 0.0
+    
+    stmt = insert(DailyUsageRollup).values(
+        material_id=reservation.material_id,
+        day=reservation.executed_date.date(),
+        used=used,
+        replenished=replenished,
+        tx_count=1,
+        adjusted=adjusted
+    )
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['material_id', 'day'],
+        set_={
+            'used': DailyUsageRollup.used + stmt.excluded.used,
+            'replenished': DailyUsageRollup.replenished + stmt.excluded.replenished,
+            'tx_count': DailyUsageRollup.tx_count + 1,
+            'adjusted': DailyUsageRollup.adjusted + stmt.excluded.adjusted
+        }
+    )
+    db.session.execute(stmt)
+
+def rebuild_daily_usage_rollup():
+    """実行済み予約の履歴（アーカイブ済みを含む）から日別ロールアップを作り直す"""
+    history = executed_history()
+    quantity = db.func.coalesce(db.func.nullif(history.c.actual_quantity, 0), history.c.quantity)
+    day = db.func.date(history.c.executed_date)
+    rows = db.session.query(
+        history.c.material_id,
+        day,
+        db.func.sum(db.case((history.c.type == 'use', quantity), else_=0.0)),
+        db.func.sum(db.case((history.c.type == 'replenish', quantity), else_=0.0)),
+        db.func.count(history.c.id),
+        db.func.sum(db.case((db.and_(history.c.type == 'use',
+                                     stock_adjustment_clause(history.c.user_name, history.c.purpose)), quantity),
+                            else_=0.0))
+    ).filter(
+        history.c.executed_date.isnot(None),
+        history.c.type.in_(['use', 'replenish'])
+    ).group_by(history.c.material_id, day).all()
+    
+    DailyUsageRollup.query.delete()
+    for material_id, day_str, used, replenished, tx_count, adjusted in rows:
+        db.session.add(DailyUsageRollup(
+            material_id=material_id,
+            day=datetime.strptime(day_str, '%Y-%m-%d').date(),
+            used=used or 0.0,
+            replenished=replenished or 0.0,
+            tx_count=tx_count,
+            adjusted=adjusted or 0.0
+        ))
+    db.session.commit()
+    stock_memo.clear()  # 使用統計は data_version を変えずに作り直したため
+    return len(rows)
+
+@app.cli.command('backfill-rollup')
+def backfill_rollup_command():
+    """既存の実行済み予約から日別ロールアップを再構築する"""
+    db.create_all()
+    count = rebuild_daily_usage_rollup()
+    print(f'✓ 日別ロールアップを再構築しました（{count}件）')
+
+# この日数より前に実行された予約をアーカイブへ移動する
+app.config.setdefault('ARCHIVE_AFTER_DAYS', 365)
+
+def archive_executed_reservations(older_than_days=None, batch_size=1000):
+    """古い実行済み予約を reservation_archive へ移動する
+
+    日別ロールアップは実行時に集計済みなので統計は変わらない。書き込みロックを
+    長く持たないよう batch_size 件ずつコミットする。戻り値は移動した件数。
+    """
+    from datetime import timedelta
+    
+    days = older_than_days if older_than_days is not None else app.config['ARCHIVE_AFTER_DAYS']
+    cutoff = datetime.now() - timedelta(days=days)
+    columns = ', '.join(HISTORY_COLUMNS)
+    moved = 0
+    while True:
+        ids = [row[0] for row in db.session.query(Reservation.id).filter(
+            Reservation.executed == True,
+            Reservation.executed_date < cutoff
+        ).order_by(Reservation.id).limit(batch_size)]
+        if not ids:
+            break
+        placeholders = ', '.join('?' * len(ids))
+        connection = db.session.connection()
+        connection.exec_driver_sql(
+            f'INSERT INTO reservation_archive ({columns}, archived_date) '
+            f'SELECT {columns}, CURRENT_TIMESTAMP FROM reservation WHERE id IN ({placeholders})',
+            tuple(ids)
         )
-        db.session.add(material)
+        connection.exec_driver_sql(f'DELETE FROM reservation WHERE id IN ({placeholders})', tuple(ids))
         db.session.commit()
-        return redirect(url_for('index'))
-    return render_template('add.html', form=form)
+        moved += len(ids)
+    return moved
 
-@app.route('/edit/<int:id>', methods=['GET', 'POST'])
-def edit(id):
-    material = RawMaterial.query.get_or_404(id)
-    form = MaterialForm()
-    if form.validate_on_submit():
-        material.name = form.name.data
-        material.weight = form.weight.data
-        material.unit = 'g'  # g固定
-        material.min_weight = form.min_weight.data
-        material.email = form.email.data
-        material.excel_path = form.excel_path.data
-        material.action_type = form.action_type.data
-        db.session.commit()
+@app.cli.command('archive-reservations')
+@click.option('--days', type=int, default=None, help='この日数より前に実行された予約を移動（既定: ARCHIVE_AFTER_DAYS）')
+def archive_reservations_command(days):
+    """古い実行済み予約をアーカイブテーブルへ移動する"""
+    db.create_all()
+    count = archive_executed_reservations(days)
+    print(f'✓ 実行済み予約を{count}件アーカイブしました')
+
+# 全文検索インデックス（FTS5 trigram）
+# rowid = 元テーブルのid * 4 + 種別コード として、トリガーから1行単位で更新できるようにする
+SEARCH_KINDS = {'material': 1, 'lot': 2, 'recipe': 3}
+_search_index_ready = None
+
+def normalize_search_text(text):
+    """検索用に文字列を正規化（NFKCで全角/半角を統一し、カタカナをひらがなに寄せる）"""
+    if text is None:
+        return ''
+    text = unicodedata.normalize('NFKC', text).lower()
+    return ''.join(chr(ord(ch) - 0x60) if '\u30a1' <= ch <= '\u30f6' else ch for ch in text)
+
+@event.listens_for(Engine, 'connect')
+def register_sqlite_functions(dbapi_connection, connection_record):
+    """トリガーから呼べるように正規化関数をSQLiteに登録"""
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        dbapi_connection.create_function('normalize_search_text', 1, normalize_search_text, deterministic=True)
+
+def _search_triggers(table, kind, label_column, material_column):
+    code = SEARCH_KINDS[kind]
+    insert_sql = (
+        f"INSERT INTO search_index(rowid, kind, ref_id, material_id, label, body) "
+        f"VALUES (new.id * 4 + {code}, '{kind}', new.id, {material_column}, new.{label_column}, "
+        f"normalize_search_text(new.{label_column}));"
+    )
+    delete_sql = f"DELETE FROM search_index WHERE rowid = old.id * 4 + {code};"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {table}_search_ai AFTER INSERT ON {table} BEGIN {insert_sql} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_search_au AFTER UPDATE OF {label_column} ON {table} "
+        f"BEGIN {delete_sql} {insert_sql} END",
+        f"CREATE TRIGGER IF NOT EXISTS {table}_search_ad AFTER DELETE ON {table} BEGIN {delete_sql} END",
+    ]
+
+def ensure_search_index(rebuild=False):
+    """検索インデックスとトリガーを作成し、空なら既存データから構築する
+
+    FTS5が使えないSQLiteの場合はFalseを返し、検索はLIKEにフォールバックする。
+    トリガーは normalize_search_text() を呼ぶため、本アプリ以外から原料・ロット・
+    レシピを書き換える場合は同名の関数を接続に登録しておく必要がある。
+    """
+    global _search_index_ready
+    if _search_index_ready is not None and not rebuild:
+        return _search_index_ready
+    
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+        "kind UNINDEXED, ref_id UNINDEXED, material_id UNINDEXED, label UNINDEXED, body, "
+        "tokenize='trigram')"
+    ]
+    statements += _search_triggers('raw_material', 'material', 'name', 'new.id')
+    statements += _search_triggers('lot', 'lot', 'lot_name', 'new.material_id')
+    statements += _search_triggers('recipe', 'recipe', 'name', 'NULL')
+    
+    try:
+        for sql in statements:
+            db.session.execute(db.text(sql))
+        
+        empty = db.session.execute(db.text('SELECT count(*) FROM search_index')).scalar() == 0
+        if rebuild or empty:
+            db.session.execute(db.text('DELETE FROM search_index'))
+            db.session.execute(db.text(
+                "INSERT INTO search_index(rowid, kind, ref_id, material_id, label, body) "
+                "SELECT id * 4 + 1, 'material', id, id, name, normalize_search_text(name) FROM raw_material"
+            ))
+            db.session.execute(db.text(
+                "INSERT INTO search_index(rowid, kind, ref_id, material_id, label, body) "
+                "SELECT id * 4 + 2, 'lot', id, material_id, lot_name, normalize_search_text(lot_name) FROM lot"
+            ))
+            db.session.execute(db.text(
+                "INSERT INTO search_index(rowid, kind, ref_id, material_id, label, body) "
+                "SELECT id * 4 + 3, 'recipe', id, NULL, name, normalize_search_text(name) FROM recipe"
+            ))
+        db.session.commit()
+        _search_index_ready = True
+    except Exception as e:
+        db.session.rollback()
+        app.logger.warning(f'検索インデックスを利用できません（LIKE検索にフォールバック）: {e}')
+        _search_index_ready = False
+    return _search_index_ready
+
+# 論理削除された原料（削除ジョブの完了まで検索インデックスに残る）を検索結果から除く条件
+NOT_DELETED_MATERIAL_SQL = 'material_id NOT IN (SELECT id FROM raw_material WHERE deleted_at IS NOT NULL)'
+
+def search_base_tables(kinds, condition, params, order):
+    """元テーブル（原料・ロット・レシピ）を検索する。condition は '{column}' を列名に置き換えて使う"""
+    parts = []
+    if 'material' in kinds:
+        parts.append("SELECT 'material' AS kind, id AS ref_id, id AS material_id, name AS label FROM raw_material WHERE "
+                     + condition.format(column='name') + ' AND deleted_at IS NULL')
+    if 'lot' in kinds:
+        parts.append("SELECT 'lot', id, material_id, lot_name FROM lot WHERE " + condition.format(column='lot_name')
+                     + f' AND {NOT_DELETED_MATERIAL_SQL}')
+    if 'recipe' in kinds:
+        parts.append("SELECT 'recipe', id, NULL, name FROM recipe WHERE " + condition.format(column='name'))
+    if not parts:
+        return []
+    sql = f"SELECT * FROM ({' UNION ALL '.join(parts)}) ORDER BY {order} LIMIT :limit OFFSET :offset"
+    return db.session.execute(db.text(sql), params).all()
+
+def search_entries(query, kinds=None, limit=20, offset=0):
+    """検索インデックスを引き、関連度順に (kind, ref_id, material_id, label) を返す
+
+    3文字以上はFTS5のMATCH（bm25順）で引く。2文字以下は trigram で引けず、
+    インデックスの body への LIKE も非ASCIIでは一致しないため、元テーブルを正規化してLIKEで照合する。
+    完全一致・前方一致を優先して並べる。
+    """
+    normalized = normalize_search_text(query).strip()
+    if not normalized:
+        return []
+    kinds = [k for k in (kinds or SEARCH_KINDS) if k in SEARCH_KINDS]
+    params = {'q': normalized, 'limit': limit, 'offset': offset}
+    kind_filter = 'kind IN (' + ', '.join(f"'{k}'" for k in kinds) + ')'
+    
+    if not ensure_search_index():
+        # フォールバック: 元テーブルをLIKEで検索
+        params['like'] = f'%{query.strip()}%'
+        return search_base_tables(kinds, '{column} LIKE :like', params, 'length(label)')
+    
+    order = "(body = :q) DESC, (body LIKE :prefix) DESC"
+    params['prefix'] = normalized.replace('%', '').replace('_', '') + '%'
+    if len(normalized) < 3:
+        params['like'] = '%' + normalized.replace('%', '').replace('_', '') + '%'
+        return search_base_tables(
+            kinds, 'normalize_search_text({column}) LIKE :like', params,
+            '(normalize_search_text(label) = :q) DESC, (normalize_search_text(label) LIKE :prefix) DESC, length(label)'
+        )
+    params['match'] = '"' + normalized.replace('"', '""') + '"'
+    sql = (
+        f"SELECT kind, ref_id, material_id, label FROM search_index "
+        f"WHERE search_index MATCH :match AND {kind_filter} "
+        f"AND (material_id IS NULL OR {NOT_DELETED_MATERIAL_SQL}) "
+        f"ORDER BY {order}, rank LIMIT :limit OFFSET :offset"
+    )
+    return db.session.execute(db.text(sql), params).all()
+
+def search_material_ids(query):
+    """原料名またはロット名が一致する原料IDの集合"""
+    rows = search_entries(query, kinds=['material', 'lot'], limit=-1)
+    return {row.material_id for row in rows}
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """検索インデックスを既存データから作り直す"""
+    db.create_all()
+    if ensure_search_index(rebuild=True):
+        print('✓ 検索インデックスを再構築しました')
+    else:
+        print('エラー: このSQLiteではFTS5（trigram）が利用できません')
+
+@event.listens_for(db.session, 'after_flush')
+def bump_material_versions(session, flush_context):
+    """ロット・予約・原料の変更を検知して原料の data_version を加算する"""
+    material_ids = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, (Lot, Reservation)) and obj.material_id:
+            material_ids.add(obj.material_id)
+        elif isinstance(obj, RawMaterial) and obj not in session.new:
+            material_ids.add(obj.id)
+    if material_ids:
+        session.connection().execute(
+            RawMaterial.__table__.update()
+            .where(RawMaterial.__table__.c.id.in_(material_ids))
+            .values(data_version=RawMaterial.__table__.c.data_version + 1)
+        )
+
+class FragmentCache:
+    """描画済みHTML断片のLRUキャッシュ（メモリ上限つき・スレッドセーフ）
+
+    キーは ((material_id, location_id), data_version)。キーごとに最新バージョンの1件だけを
+    保持し、古いバージョンは新しい断片を格納したときに置き換える。
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # (material_id, location_id) -> (version, html, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, version):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, version, html):
+        size = len(html.encode('utf-8'))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            if size > self.max_bytes:
+                return
+            self._entries[key] = (version, html, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, material_id):
+        """原料に関するエントリ（全拠点分）を破棄"""
+        with self._lock:
+            for key in [k for k in self._entries if k[0] == material_id]:
+                self._bytes -= self._entries.pop(key)[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+                'evictions': self.evictions
+            }
+
+app.config.setdefault('ROW_CACHE_MAX_BYTES', 8 * 1024 * 1024)
+material_row_cache = FragmentCache(app.config['ROW_CACHE_MAX_BYTES'])
+
+def render_material_row(material, location_id=None):
+    """原料一覧の1行を描画（data_version が変わらない限りキャッシュを再利用）
+
+    material は material_stock_overview() の1要素。拠点ごとに表示内容が異なるため
+    キャッシュキーには拠点IDも含める。
+    """
+    key = (material['id'], location_id)
+    html = material_row_cache.get(key, material['data_version'])
+    if html is None:
+        html = render_template('_material_row.html', material=material)
+        material_row_cache.put(key, material['data_version'], html)
+    return Markup(html)
+
+# 予定在庫タイムライン（原料ごとのセグメント木、timeline.py）
+app.config.setdefault('TIMELINE_HORIZON_DAYS', 730)
+
+def pending_effect(type_, quantity, scheduled_date, executed):
+    """未実行予約がタイムラインに与える影響 (予定日, 増減量, 補充か)。対象外なら None
+
+    予定日のない使用予約は今日の使用とみなす（予測在庫 get_predicted_stock と同じく差し引く）。
+    予定日のない補充予約はいつ入るかわからないので載せない（不足を見逃さない側に倒す）。
+    """
+    if executed or type_ not in ('use', 'replenish'):
+        return None
+    if scheduled_date is None and type_ == 'replenish':
+        return None
+    if type_ == 'replenish':
+        return scheduled_date, quantity, True
+    return scheduled_date, -quantity, False
+
+TIMELINE_BUILD_CHUNK = 500  # まとめて構築する原料数（IN 句の変数の上限に収めるため）
+
+def build_stock_timelines(material_ids, base_date, days):
+    """DBから原料ごとのタイムラインをまとめて構築する（戻り値は {原料ID: (data_version, StockTimeline)}）
+
+    現在量と未実行予約は原料をまとめたクエリで読むので、クエリ数は原料数によらない。
+    """
+    built = {}
+    material_ids = list(material_ids)
+    for start in range(0, len(material_ids), TIMELINE_BUILD_CHUNK):
+        chunk = material_ids[start:start + TIMELINE_BUILD_CHUNK]
+        def current_versions():
+            return dict(db.session.query(RawMaterial.id, RawMaterial.data_version).filter(RawMaterial.id.in_(chunk)))
+        versions = current_versions()
+        current = dict(db.session.query(Lot.material_id, db.func.sum(Lot.weight)).filter(
+            Lot.material_id.in_(chunk)).group_by(Lot.material_id))
+        events = {}
+        for material_id, type_, quantity, scheduled_date in db.session.query(
+            Reservation.material_id, Reservation.type, Reservation.quantity, Reservation.scheduled_date
+        ).filter(Reservation.material_id.in_(chunk), Reservation.executed == False):
+            effect = pending_effect(type_, quantity, scheduled_date, False)
+            if effect:
+                events.setdefault(material_id, []).append(effect)
+        # 読み取り中に別のコミットが入った原料はバージョンを付けずに返す（キャッシュしない）
+        after = current_versions()
+        for material_id in chunk:
+            version = versions.get(material_id)
+            timeline = StockTimeline(base_date, days, current.get(material_id) or 0.0, events.get(material_id, ()))
+            built[material_id] = (version if version is not None and after.get(material_id) == version else None,
+                                  timeline)
+    return built
+
+def build_stock_timeline(material_id, base_date, days):
+    """DBから1原料のタイムラインを構築する（戻り値は (data_version, StockTimeline)）"""
+    return build_stock_timelines([material_id], base_date, days)[material_id]
+
+class StockTimelineIndex:
+    """原料ごとの StockTimeline を data_version つきで保持する
+
+    コミットされた予約・ロットの変更は差分（区間加算）として反映し、原料全体を
+    作り直さない。差分の元バージョンが保持中のバージョンと一致しない場合
+    （別プロセスの書き込みなど）や日付が変わった場合は、次の参照時に作り直す。
+    """
+
+    def __init__(self, horizon_days):
+        self.horizon_days = horizon_days
+        self._entries = {}  # material_id -> (data_version, StockTimeline)
+        self._lock = threading.Lock()
+        self.builds = 0
+        self.updates = 0
+        self.hits = 0
+
+    def get(self, material_id, data_version):
+        return self.get_many({material_id: data_version})[material_id]
+
+    def get_many(self, versions):
+        """{原料ID: data_version} の各原料のタイムライン（保持していない分はまとめて構築する）"""
+        today = date.today()
+        timelines = {}
+        with self._lock:
+            for material_id, data_version in versions.items():
+                entry = self._entries.get(material_id)
+                if entry and entry[0] == data_version and entry[1].base_date == today:
+                    timelines[material_id] = entry[1]
+            self.hits += len(timelines)
+        missing = [material_id for material_id in versions if material_id not in timelines]
+        if not missing:
+            return timelines
+        built = build_stock_timelines(missing, today, self.horizon_days)
+        # 未コミットの変更を含むタイムラインは、ロールバックされると同じバージョンで別の内容になる
+        cacheable = not has_uncommitted_writes(db.session)
+        with self._lock:
+            self.builds += len(built)
+            for material_id, (version, timeline) in built.items():
+                if cacheable and version is not None and version == versions[material_id]:
+                    self._entries[material_id] = (version, timeline)
+                timelines[material_id] = timeline
+        return timelines
+
+    def apply(self, material_id, from_version, to_version, ops):
+        """コミット済みの差分を反映する（ops が None なら原料ごと破棄）"""
+        with self._lock:
+            entry = self._entries.get(material_id)
+            if entry is None:
+                return
+            if ops is None or entry[0] != from_version:
+                del self._entries[material_id]
+                return
+            for day, delta, replenish in ops:
+                entry[1].add(day, delta, replenish)
+            self._entries[material_id] = (to_version, entry[1])
+            self.updates += 1
+
+    def min_from(self, material_id, data_version, day):
+        """原料の day 以降の最小予定在庫と日付（apply() と同時に木を読まないようロック内で問い合わせる）"""
+        return self.min_from_many({material_id: data_version}, day)[material_id]
+
+    def min_from_many(self, versions, day):
+        """{原料ID: data_version} の各原料の day 以降の最小予定在庫と日付"""
+        timelines = self.get_many(versions)
+        with self._lock:
+            return {material_id: timeline.min_from(day) for material_id, timeline in timelines.items()}
+
+    def invalidate(self, material_id):
+        with self._lock:
+            self._entries.pop(material_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'horizon_days': self.horizon_days,
+                    'builds': self.builds, 'updates': self.updates, 'hits': self.hits}
+
+stock_timeline_index = StockTimelineIndex(app.config['TIMELINE_HORIZON_DAYS'])
+
+def material_min_stock_from(material, day):
+    """原料（RawMaterial）の day 以降の最小予定在庫と、それが最初に現れる日付"""
+    return stock_timeline_index.min_from(material.id, material.data_version, day)
+
+@event.listens_for(db.session, 'after_flush')
+def record_timeline_changes(session, flush_context):
+    """flushごとの予定在庫の差分を記録する（反映はコミット後、ロールバックなら破棄）
+
+    bump_material_versions の後に呼ばれるので、data_version は加算済み。
+    加算された原料はすべて（差分がなくても）記録し、バージョンの連続性を保つ。
+    """
+    ops = {}
+    dropped = set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Lot) and obj.material_id:
+            history = db.inspect(obj).attrs.weight.history
+            if obj in session.deleted:
+                delta = -(obj.weight or 0.0)
+            elif obj in session.new:
+                delta = obj.weight or 0.0
+            else:
+                delta = sum(history.added or [0.0]) - sum(history.deleted or [0.0]) if history.has_changes() else 0.0
+            # 現在量の増減は基準日以降のすべての日に効く
+            ops.setdefault(obj.material_id, []).append((None, delta, False))
+        elif isinstance(obj, Reservation) and obj.material_id:
+            changes = ops.setdefault(obj.material_id, [])
+            state = db.inspect(obj)
+            def previous(name):
+                history = state.attrs[name].history
+                return history.deleted[0] if history.deleted else getattr(obj, name)
+            if obj not in session.new:
+                old = pending_effect(previous('type'), previous('quantity'), previous('scheduled_date'), previous('executed'))
+                if old:
+                    changes.append((old[0], -old[1], old[2]))
+            if obj not in session.deleted:
+                new = pending_effect(obj.type, obj.quantity, obj.scheduled_date, obj.executed)
+                if new:
+                    changes.append(new)
+        elif isinstance(obj, RawMaterial) and obj not in session.new:
+            ops.setdefault(obj.id, [])
+            if obj in session.deleted:
+                dropped.add(obj.id)
+    if not ops:
+        return
+    table = RawMaterial.__table__
+    versions = dict(session.connection().execute(
+        db.select(table.c.id, table.c.data_version).where(table.c.id.in_(list(ops)))
+    ).all())
+    pending = session.info.setdefault('timeline_ops', [])
+    for material_id, changes in ops.items():
+        version = versions.get(material_id)
+        if version is None or material_id in dropped:
+            pending.append((material_id, None, None, None))
+        else:
+            pending.append((material_id, version - 1, version, changes))
+
+@event.listens_for(db.session, 'after_commit')
+def apply_timeline_changes(session):
+    for material_id, from_version, to_version, changes in session.info.pop('timeline_ops', []):
+        stock_timeline_index.apply(material_id, from_version, to_version, changes)
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_timeline_changes(session):
+    session.info.pop('timeline_ops', None)
+
+class MaterialForm(FlaskForm):
+    name = StringField('Name', validators=[DataRequired()])
+    weight = FloatField('Weight (g)', validators=[Optional()], default=0.0)
+    min_weight = FloatField('Min Weight (g)', default=0.0)
+    action_type = SelectField('Action Type', choices=[('none', 'なにもしない'), ('email', 'メール連絡'), ('excel', 'エクセルを開く')], default='none')
+    email = StringField('Purchase Email', validators=[Optional(), Email()])
+    excel_path = StringField('Excel File Path', validators=[Optional()])
+    submit = SubmitField('Submit')
+
+class LotForm(FlaskForm):
+    lot_name = StringField('Lot Name', validators=[DataRequired()])
+    weight = FloatField('Weight', validators=[DataRequired()])
+    expiry_date = DateField('Expiry Date (Optional)', format='%Y-%m-%d', validators=[Optional()])
+    version = HiddenField()  # 編集開始時のロットのバージョン
+    location_id = SelectField('Location', coerce=int, validators=[Optional()])
+    submit = SubmitField('Submit')
+
+class ReservationForm(FlaskForm):
+    lot_id = SelectField('Existing Lot (Optional)', coerce=int, validators=[Optional()])
+    lot_name = StringField('New Lot Name (Optional)', validators=[Optional()])
+    quantity = FloatField('Quantity', validators=[DataRequired()])
+
+    user_name = StringField('User Name (Optional)', validators=[Optional()])
+    purpose = StringField('Purpose (Optional)', validators=[Optional()])
+    scheduled_date = DateField('Scheduled Date (Optional)', format='%Y-%m-%d', validators=[Optional()])
+    location_id = SelectField('Location', coerce=int, validators=[Optional()])
+    submit = SubmitField('Reserve')
+
+class LocationForm(FlaskForm):
+    name = StringField('Location Name', validators=[DataRequired()])
+    submit = SubmitField('Add Location')
+
+class TransferForm(FlaskForm):
+    location_id = SelectField('To Location', coerce=int)
+    quantity = FloatField('Quantity', validators=[DataRequired()])
+    submit = SubmitField('Transfer')
+
+def location_choices(blank_label='拠点指定なし'):
+    """拠点選択肢（0 = 指定なし）"""
+    return [(0, blank_label)] + [(loc.id, loc.name) for loc in Location.query.order_by(Location.name)]
+
+def get_current_location_id():
+    """画面で選択中の拠点ID（未選択ならNone = 全拠点）"""
+    return session.get('location_id') or None
+
+@app.context_processor
+def inject_locations():
+    """ナビゲーションの拠点切り替え用"""
+    if 'locations' not in g:
+        g.locations = Location.query.order_by(Location.name).all()
+    location_id = get_current_location_id()
+    current = next((loc for loc in g.locations if loc.id == location_id), None)
+    return {'locations': g.locations, 'current_location': current}
+
+class RecipeForm(FlaskForm):
+    name = StringField('Recipe Name', validators=[DataRequired()])
+    description = StringField('Description (Optional)', validators=[Optional()])
+    submit = SubmitField('Save Recipe')
+
+@app.route('/')
+def index():
+    search = request.args.get('search', '')
+    sort_by = request.args.get('sort_by', 'name')
+    location_id = get_current_location_id()
+    materials = material_stock_overview(search or None, location_id)
+    if sort_by == 'weight':
+        # ロット合計重量の昇順
+        materials = sorted(materials, key=lambda m: m['current'])
+    rows = [render_material_row(material, location_id) for material in materials]
+    purge_jobs = PurgeJob.query.filter(PurgeJob.status.in_(('pending', 'running', 'failed'))).order_by(PurgeJob.id).all()
+    return render_template('index.html', rows=rows, search=search, sort_by=sort_by, purge_jobs=purge_jobs)
+
+@app.route('/admin/db_stats', methods=['GET', 'POST'])
+@csrf.exempt
+def admin_db_stats():
+    """SQLite のロック待ち・ロックエラーの集計（POST で0に戻す）"""
+    if request.method == 'POST':
+        database_stats.reset()
+    return jsonify(database_stats.stats())
+
+@app.route('/admin/cache')
+def admin_cache():
+    """キャッシュの利用状況（ヒット率・メモリ使用量）"""
+    return jsonify({'material_rows': material_row_cache.stats(), 'stock_timelines': stock_timeline_index.stats(),
+                    'stock_views': stock_memo.stats(), 'config': config_store.stats()})
+
+@app.route('/add', methods=['GET', 'POST'])
+def add():
+    form = MaterialForm()
+    if form.validate_on_submit():
+        material = RawMaterial(
+            name=form.name.data, 
+            weight=form.weight.data if form.weight.data is not None else 0.0, 
+            unit='g',  # g固定
+            min_weight=form.min_weight.data,
+            email=form.email.data,
+            excel_path=form.excel_path.data,
+            action_type=form.action_type.data
+        )
+        db.session.add(material)
+        db.session.commit()
+        return redirect(url_for('index'))
+    return render_template('add.html', form=form)
+
+@app.route('/edit/<int:id>', methods=['GET', 'POST'])
+def edit(id):
+    material = RawMaterial.query.get_or_404(id)
+    form = MaterialForm()
+    if form.validate_on_submit():
+        material.name = form.name.data
+        material.weight = form.weight.data
+        material.unit = 'g'  # g固定
+        material.min_weight = form.min_weight.data
+        material.email = form.email.data
+        material.excel_path = form.excel_path.data
+        material.action_type = form.action_type.data
+        db.session.commit()
         return redirect(url_for('index'))
     elif request.method == 'GET':
         form.name.data = material.name
@@ -408,44 +1812,278 @@ def material_stats(id):
     material = RawMaterial.query.get_or_404(id)
     return render_template('material_stats.html', material=material)
 
+# 原料の削除
+#   削除操作では原料に deleted_at を付けるだけ（論理削除）にして、すぐに画面・APIから見えなくする。
+#   予約・履歴・ロットなどの関連データはバックグラウンドのスレッドが PURGE_CHUNK_ROWS 行ずつ
+#   短いトランザクションで削除する（他の書き込みが待たされるのは最大1チャンク分）。
+app.config.setdefault('PURGE_CHUNK_ROWS', 500)
+app.config.setdefault('PURGE_PAUSE_SECONDS', 0.05)  # チャンクの間に他の書き込みへ譲る時間
+
+# 論理削除された原料のID（ORMのエンティティではなくテーブルで参照し、下の条件を再帰的にかけない）
+_deleted_material_ids = db.select(RawMaterial.__table__.c.id).where(RawMaterial.__table__.c.deleted_at.isnot(None))
+
+@event.listens_for(db.session, 'do_orm_execute')
+def hide_deleted_materials(execute_state):
+    """論理削除された原料と、そのロット・予約をすべての ORM クエリから除く（削除処理は SQL で直接消す）"""
+    if not execute_state.is_select:
+        return
+    execute_state.statement = execute_state.statement.options(
+        db.with_loader_criteria(RawMaterial, RawMaterial.deleted_at.is_(None), include_aliases=True),
+        db.with_loader_criteria(Lot, Lot.material_id.not_in(_deleted_material_ids), include_aliases=True),
+        db.with_loader_criteria(Reservation, Reservation.material_id.not_in(_deleted_material_ids), include_aliases=True)
+    )
+
+class PurgeJob(db.Model):
+    """論理削除した原料の関連データを削除するジョブ（進捗を記録し、再起動後も続きから再開する）"""
+    __tablename__ = 'purge_job'
+    id = db.Column(db.Integer, primary_key=True)
+    material_ids = db.Column(db.Text, nullable=False)  # JSON の ID リスト
+    label = db.Column(db.String(200), nullable=False)  # 画面表示用（原料名）
+    status = db.Column(db.String(20), nullable=False, default='pending')  # 'pending' / 'running' / 'done' / 'failed'
+    total_rows = db.Column(db.Integer, nullable=True)  # 開始時に数えた削除対象の行数
+    deleted_rows = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    error = db.Column(db.String(500), nullable=True)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'label': self.label,
+            'material_ids': json.loads(self.material_ids),
+            'status': self.status,
+            'total_rows': self.total_rows,
+            'deleted_rows': self.deleted_rows,
+            'progress': round(self.deleted_rows / self.total_rows, 3) if self.total_rows else (1.0 if self.status == 'done' else 0.0),
+            'created_at': self.created_at.isoformat(timespec='seconds'),
+            'finished_at': self.finished_at.isoformat(timespec='seconds') if self.finished_at else None,
+            'error': self.error
+        }
+
+_purge_wakeup = threading.Event()
+
+def soft_delete_materials(material_ids):
+    """原料を論理削除して削除ジョブを登録する（原料の行を更新するだけの短いトランザクション）
+
+    戻り値は登録したジョブ（対象がなければ None）。
+    """
+    materials = RawMaterial.query.filter(RawMaterial.id.in_(list(material_ids))).order_by(RawMaterial.id).all()
+    if not materials:
+        return None
+    ids = [material.id for material in materials]
+    label = '、'.join(material.name for material in materials[:3]) + (f' ほか{len(materials) - 3}件' if len(materials) > 3 else '')
+    now = datetime.now()
+    for material in materials:
+        material.deleted_at = now
+    job = PurgeJob(material_ids=json.dumps(ids), label=label[:200], created_at=now)
+    db.session.add(job)
+    db.session.commit()
+    for material_id in ids:
+        material_row_cache.invalidate(material_id)
+        stock_timeline_index.invalidate(material_id)
+        stock_memo.invalidate(material_id)
+    _purge_wakeup.set()
+    return job
+
+def purge_steps(material_ids):
+    """削除の順序と、各段階の「次のチャンクの rowid を取る SQL」・削除する SQL
+
+    rowid の昇順に続きから読むので、material_id に索引がない表でも全体で1回の走査で済む。
+    予約（アーカイブを含む）はロット割当を、ロットは予約からの参照をなくしてから消す。
+    """
+    ids = ', '.join(str(int(material_id)) for material_id in material_ids)
+    steps = []
+    for table in ('reservation', 'reservation_archive'):
+        steps.append((table, f'SELECT rowid FROM {table} WHERE rowid > :after AND material_id IN ({ids}) ORDER BY rowid LIMIT :limit',
+                      ['DELETE FROM lot_allocation WHERE reservation_id IN ({chunk})',
+                       f'DELETE FROM {table} WHERE rowid IN ({{chunk}})']))
+    for table in ('lot_trace_link', 'daily_usage_rollup', 'lot'):
+        steps.append((table, f'SELECT rowid FROM {table} WHERE rowid > :after AND material_id IN ({ids}) ORDER BY rowid LIMIT :limit',
+                      [f'DELETE FROM {table} WHERE rowid IN ({{chunk}})']))
+    return steps
+
+def count_purge_rows(material_ids):
+    ids = ', '.join(str(int(material_id)) for material_id in material_ids)
+    return sum(
+        db.session.execute(db.text(f'SELECT count(*) FROM {table} WHERE material_id IN ({ids})')).scalar()
+        for table, _, _ in purge_steps(material_ids)
+    )
+
+def run_purge_job(job_id, chunk_rows=None, pause=None):
+    """削除ジョブを最後まで進める（チャンクごとにコミットし、進捗を記録する）
+
+    途中で止まっても、残っている行を続きから消すだけなので何度実行してもよい。
+    """
+    chunk_rows = chunk_rows or app.config['PURGE_CHUNK_ROWS']
+    pause = app.config['PURGE_PAUSE_SECONDS'] if pause is None else pause
+    job = db.session.get(PurgeJob, job_id)
+    material_ids = json.loads(job.material_ids)
+    if job.total_rows is None:
+        job.total_rows = count_purge_rows(material_ids)
+    job.status = 'running'
+    db.session.commit()
+    try:
+        for table, select_sql, delete_sqls in purge_steps(material_ids):
+            after = 0
+            while True:
+                rowids = db.session.execute(db.text(select_sql), {'after': after, 'limit': chunk_rows}).scalars().all()
+                if not rowids:
+                    break
+                chunk = ', '.join(str(rowid) for rowid in rowids)
+                for delete_sql in delete_sqls:
+                    db.session.execute(db.text(delete_sql.format(chunk=chunk)))
+                PurgeJob.query.filter_by(id=job_id).update(
+                    {'deleted_rows': PurgeJob.deleted_rows + len(rowids)}, synchronize_session=False)
+                db.session.commit()
+                after = rowids[-1]
+                if pause:
+                    time.sleep(pause)
+        db.session.execute(RawMaterial.__table__.delete().where(RawMaterial.__table__.c.id.in_(material_ids)))
+        PurgeJob.query.filter_by(id=job_id).update(
+            {'status': 'done', 'finished_at': datetime.now()}, synchronize_session=False)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        PurgeJob.query.filter_by(id=job_id).update({'status': 'failed', 'error': str(e)[:500]}, synchronize_session=False)
+        db.session.commit()
+        raise
+    finally:
+        db.session.expire_all()
+    return db.session.get(PurgeJob, job_id)
+
+def run_pending_purge_jobs():
+    """未完了の削除ジョブを古い順にすべて実行する（中断された running も再開する）"""
+    job_ids = [job_id for (job_id,) in db.session.query(PurgeJob.id).filter(
+        PurgeJob.status.in_(('pending', 'running'))).order_by(PurgeJob.id)]
+    for job_id in job_ids:
+        run_purge_job(job_id)
+    return len(job_ids)
+
+_purge_worker = None
+_purge_worker_lock = threading.Lock()
+
+@app.before_request
+def start_purge_worker():
+    """削除ジョブを処理するバックグラウンドスレッドを起動（プロセスごとに1回）"""
+    global _purge_worker
+    if _purge_worker is not None or app.testing:
+        return
+    
+    def run():
+        while True:
+            try:
+                with app.app_context():
+                    run_pending_purge_jobs()
+            except Exception as e:
+                app.logger.warning(f'原料の削除処理に失敗しました: {e}')
+            _purge_wakeup.wait(60)
+            _purge_wakeup.clear()
+    
+    with _purge_worker_lock:
+        if _purge_worker is None:
+            _purge_worker = threading.Thread(target=run, name='purge-worker', daemon=True)
+            _purge_worker.start()
+
 @app.route('/delete/<int:id>')
 def delete(id):
     material = RawMaterial.query.get_or_404(id)
     
     try:
-        # 関連する予約を先に削除
-        Reservation.query.filter_by(material_id=id).delete()
-        
-        # 関連するロットを削除（ロットに紐づく予約もカスケード削除される）
-        Lot.query.filter_by(material_id=id).delete()
-        
-        # 原料を削除
-        db.session.delete(material)
-        db.session.commit()
-        flash(f'原料「{material.name}」と関連データを削除しました', 'success')
+        job = soft_delete_materials([id])
+        flash(f'原料「{material.name}」を削除しました（関連データはバックグラウンドで削除します: ジョブ #{job.id}）', 'success')
     except Exception as e:
         db.session.rollback()
         flash(f'削除に失敗しました: {str(e)}', 'danger')
     
     return redirect(url_for('index'))
 
+BULK_EDIT_FIELDS = ('min_weight', 'email', 'action_type')
+
+@app.route('/materials/bulk', methods=['POST'])
+def bulk_materials():
+    """原料一覧で選択した複数の原料をまとめて削除・編集する
+
+    編集は空欄でない項目だけを選択した原料すべてに設定する。
+    """
+    material_ids = [int(value) for value in request.form.getlist('material_ids') if value.isdigit()]
+    if not material_ids:
+        flash('原料を選択してください', 'warning')
+        return redirect(url_for('index'))
+    
+    if request.form.get('bulk_action') == 'delete':
+        job = soft_delete_materials(material_ids)
+        if job:
+            flash(f'{len(json.loads(job.material_ids))}件の原料を削除しました（関連データはバックグラウンドで削除します: ジョブ #{job.id}）', 'success')
+        return redirect(url_for('index'))
+    
+    values = {}
+    try:
+        if request.form.get('min_weight', '').strip():
+            values['min_weight'] = float(request.form['min_weight'])
+    except ValueError:
+        flash('最低量は数値で入力してください', 'danger')
+        return redirect(url_for('index'))
+    if request.form.get('email', '').strip():
+        values['email'] = request.form['email'].strip()
+    if request.form.get('action_type') in ('email', 'excel', 'none'):
+        values['action_type'] = request.form['action_type']
+    if not values:
+        flash('変更する項目を入力してください', 'warning')
+        return redirect(url_for('index'))
+    
+    # 1件ずつ ORM で更新し、data_version の加算（表示キャッシュの無効化）を通常の編集と揃える
+    materials = RawMaterial.query.filter(RawMaterial.id.in_(material_ids)).all()
+    for material in materials:
+        for field, value in values.items():
+            setattr(material, field, value)
+    db.session.commit()
+    flash(f'{len(materials)}件の原料を更新しました', 'success')
+    return redirect(url_for('index'))
+
+@app.route('/admin/purge_jobs')
+def admin_purge_jobs():
+    """原料の削除ジョブの進捗（新しい順）"""
+    jobs = PurgeJob.query.order_by(PurgeJob.id.desc()).limit(50).all()
+    return jsonify({'jobs': [job.to_dict() for job in jobs]})
+
+@app.route('/api/purge_jobs/<int:job_id>')
+def api_purge_job(job_id):
+    job = db.session.get(PurgeJob, job_id)
+    if job is None:
+        return jsonify({'error': '見つかりません'}), 404
+    return jsonify(job.to_dict())
+
+@app.cli.command('purge-deleted')
+def purge_deleted_command():
+    """未完了の原料削除ジョブをその場で最後まで実行する"""
+    db.create_all()
+    count = run_pending_purge_jobs()
+    print(f'✓ 削除ジョブを{count}件実行しました')
+
 @app.route('/reserve_use/<int:id>', methods=['GET', 'POST'])
 def reserve_use(id):
     material = RawMaterial.query.get_or_404(id)
     form = ReservationForm()
     # ロット選択肢を追加（空欄も含む）
     form.lot_id.choices = [(0, '既存ロットから選択しない')] + [(lot.id, lot.lot_name) for lot in material.lots]
+    form.location_id.choices = location_choices()
+    if request.method == 'GET':
+        form.location_id.data = get_current_location_id() or 0
     if form.validate_on_submit():
         lot_id = form.lot_id.data if form.lot_id.data != 0 else None
         
-        # 予約後の予測重量を計算
-        predicted_after_reserve = material.get_predicted_stock() - form.quantity.data
-        
+        # 予定日以降の最小予定在庫（予定日の順序を考慮。予定日なしは今日の使用とみなす）
+        scheduled = form.scheduled_date.data or date.today()
+        lowest, lowest_date = material_min_stock_from(material, scheduled)
+        predicted_after_reserve = lowest - form.quantity.data
+
         # 最低重量を下回る場合は警告
         if predicted_after_reserve < material.min_weight:
             shortage = material.min_weight - predicted_after_reserve
-            warning_msg = f'⚠️ 警告: この予約により予測在庫が最低量を{shortage:.1f}g下回ります（予測: {predicted_after_reserve:.1f}g / 最低: {material.min_weight:.1f}g）'
-            
+            warning_msg = f'⚠️ 警告: この予約により{lowest_date.strftime("%Y-%m-%d")}時点の予測在庫が最低量を{shortage:.1f}g下回ります（予測: {predicted_after_reserve:.1f}g / 最低: {material.min_weight:.1f}g）'
+            if predicted_after_reserve < 0:
+                warning_msg += '。在庫がマイナスになります'
+
             # アクションタイプに応じた対処を促す
             if material.action_type == 'email' and material.email:
                 warning_msg += f' → 購入担当者（{material.email}）にメール連絡してください'
@@ -462,7 +2100,8 @@ def reserve_use(id):
             quantity=form.quantity.data,
             user_name=form.user_name.data,
             purpose=form.purpose.data,
-            scheduled_date=form.scheduled_date.data
+            scheduled_date=form.scheduled_date.data,
+            location_id=form.location_id.data or None
         )
         db.session.add(reservation)
         db.session.commit()
@@ -476,6 +2115,9 @@ def reserve_replenish(id):
     form = ReservationForm()
     # ロット選択肢を追加（空欄も含む）
     form.lot_id.choices = [(0, '既存ロットから選択しない')] + [(lot.id, lot.lot_name) for lot in material.lots]
+    form.location_id.choices = location_choices()
+    if request.method == 'GET':
+        form.location_id.data = get_current_location_id() or 0
     if form.validate_on_submit():
         lot_id = form.lot_id.data if form.lot_id.data != 0 else None
         reservation = Reservation(
@@ -486,7 +2128,8 @@ def reserve_replenish(id):
             quantity=form.quantity.data,
             user_name=form.user_name.data,
             purpose=form.purpose.data,
-            scheduled_date=form.scheduled_date.data
+            scheduled_date=form.scheduled_date.data,
+            location_id=form.location_id.data or None
         )
         db.session.add(reservation)
         db.session.commit()
@@ -500,33 +2143,45 @@ def lots(material_id):
     material = RawMaterial.query.get_or_404(material_id)
     return render_template('lots.html', material=material)
 
+def create_lot(material_id, lot_name, weight, location_id=None, expiry_date=None):
+    """ロットを作成し、統計用にロット追加を補充扱いの実行済み予約として記録する"""
+    lot = Lot(material_id=material_id, lot_name=lot_name, weight=weight,
+              location_id=location_id, expiry_date=expiry_date)
+    db.session.add(lot)
+    db.session.flush()  # lotのIDを取得するため
+    
+    if weight > 0:
+        auto_reservation = Reservation(
+            material_id=material_id,
+            lot_id=lot.id,
+            lot_name=lot_name,
+            type='replenish',
+            quantity=weight,
+            actual_quantity=weight,
+            user_name='システム',
+            purpose=f'ロット追加（{lot_name}）',
+            scheduled_date=datetime.now(),
+            executed=True,
+            executed_date=datetime.now(),
+            location_id=location_id
+        )
+        db.session.add(auto_reservation)
+        db.session.flush()
+        record_daily_usage(auto_reservation)
+        record_lot_trace('produce', lot, auto_reservation, weight)
+    return lot
+
 @app.route('/add_lot/<int:material_id>', methods=['GET', 'POST'])
 def add_lot(material_id):
     """ロット追加"""
     material = RawMaterial.query.get_or_404(material_id)
     form = LotForm()
+    form.location_id.choices = location_choices()
+    if request.method == 'GET':
+        form.location_id.data = get_current_location_id() or 0
     if form.validate_on_submit():
-        lot = Lot(material_id=material_id, lot_name=form.lot_name.data, weight=form.weight.data)
-        db.session.add(lot)
-        db.session.flush()  # lotのIDを取得するため
-        
-        # 統計用に実行済み予約を作成（ロット追加は補充扱い）
-        if form.weight.data > 0:
-            auto_reservation = Reservation(
-                material_id=material_id,
-                lot_id=lot.id,
-                lot_name=form.lot_name.data,
-                type='replenish',
-                quantity=form.weight.data,
-                actual_quantity=form.weight.data,
-                user_name='システム',
-                purpose=f'ロット追加（{form.lot_name.data}）',
-                scheduled_date=datetime.now(),
-                executed=True,
-                executed_date=datetime.now()
-            )
-            db.session.add(auto_reservation)
-        
+        create_lot(material_id, form.lot_name.data, form.weight.data,
+                   location_id=form.location_id.data or None, expiry_date=form.expiry_date.data)
         db.session.commit()
         flash(f'ロット「{form.lot_name.data}」を追加しました', 'success')
         return redirect(url_for('lots', material_id=material_id))
@@ -537,11 +2192,21 @@ def edit_lot(id):
     """ロット編集"""
     lot = Lot.query.get_or_404(id)
     form = LotForm()
+    # 保管場所は移動履歴とトレースを残すため「拠点移動」（transfer_lot）でだけ変更する
+    del form.location_id
     if form.validate_on_submit():
+        if request.form.get('version', type=int) != lot.version:
+            # 画面を開いた後に他の操作（予約の実行など）でロットが更新された
+            # （バージョンのない送信も、確認できないので競合として扱う）
+            flash(f'ロット「{lot.lot_name}」は他の操作で更新されました（現在の重量: {lot.weight}）。内容を確認して再度保存してください', 'warning')
+            form.version.data = lot.version
+            form.weight.data = lot.weight
+            return render_template('edit_lot.html', form=form, lot=lot), 409
         old_weight = lot.weight
         new_weight = form.weight.data
         lot.lot_name = form.lot_name.data
         lot.weight = new_weight
+        lot.expiry_date = form.expiry_date.data
         
         # 重量が変化した場合、統計用に実行済み予約を作成
         weight_diff = new_weight - old_weight
@@ -560,9 +2225,11 @@ def edit_lot(id):
                 purpose=f'ロット直接編集（{lot.lot_name}）',
                 scheduled_date=datetime.now(),
                 executed=True,
-                executed_date=datetime.now()
+                executed_date=datetime.now(),
+                location_id=lot.location_id
             )
             db.session.add(auto_reservation)
+            record_daily_usage(auto_reservation)
         
         db.session.commit()
         flash(f'ロット「{lot.lot_name}」を更新しました', 'success')
@@ -570,6 +2237,8 @@ def edit_lot(id):
     elif request.method == 'GET':
         form.lot_name.data = lot.lot_name
         form.weight.data = lot.weight
+        form.expiry_date.data = lot.expiry_date
+        form.version.data = lot.version
     return render_template('edit_lot.html', form=form, lot=lot)
 
 @app.route('/delete_lot/<int:id>')
@@ -593,108 +2262,688 @@ def delete_lot(id):
             purpose=f'ロット削除（{lot_name}）',
             scheduled_date=datetime.now(),
             executed=True,
-            executed_date=datetime.now()
+            executed_date=datetime.now(),
+            location_id=lot.location_id
         )
         db.session.add(auto_reservation)
+        record_daily_usage(auto_reservation)
     
     db.session.delete(lot)
     db.session.commit()
     flash(f'ロット「{lot_name}」を削除しました', 'success')
     return redirect(url_for('lots', material_id=material_id))
 
+@app.route('/transfer_lot/<int:id>', methods=['GET', 'POST'])
+def transfer_lot(id):
+    """ロットの拠点間移動（移動元を減らし、移動先の同名ロットに加算）"""
+    lot = Lot.query.get_or_404(id)
+    form = TransferForm()
+    form.location_id.choices = [choice for choice in location_choices() if choice[0] != (lot.location_id or 0)]
+    if form.validate_on_submit():
+        quantity = form.quantity.data
+        target_location_id = form.location_id.data or None
+        
+        def run():
+            # 競合時は最新の在庫で再実行する（移動全体が1トランザクションなので二重移動しない）
+            source = db.session.get(Lot, id)
+            if quantity <= 0 or quantity > source.weight:
+                raise ExecutionError(f'移動量は0より大きく、ロットの在庫（{source.weight}）以下にしてください')
+            target = Lot.query.filter_by(
+                material_id=source.material_id, lot_name=source.lot_name, location_id=target_location_id
+            ).first()
+            if target is None:
+                target = Lot(material_id=source.material_id, lot_name=source.lot_name, weight=0,
+                             location_id=target_location_id, expiry_date=source.expiry_date)
+                db.session.add(target)
+            source.weight -= quantity
+            target.weight += quantity
+            db.session.flush()
+            
+            # 移動履歴（日別集計・統計の対象外）
+            now = datetime.now()
+            source_name = source.location.name if source.location else '拠点指定なし'
+            target_name = target.location.name if target.location else '拠点指定なし'
+            movements = []
+            for type_, moved_lot, purpose in (
+                ('transfer_out', source, f'拠点間移動（→ {target_name}）'),
+                ('transfer_in', target, f'拠点間移動（{source_name} →）')
+            ):
+                movements.append(Reservation(
+                    material_id=source.material_id,
+                    lot_id=moved_lot.id,
+                    lot_name=source.lot_name,
+                    type=type_,
+                    quantity=quantity,
+                    actual_quantity=quantity,
+                    user_name='システム',
+                    purpose=purpose,
+                    scheduled_date=now,
+                    executed=True,
+                    executed_date=now,
+                    location_id=moved_lot.location_id
+                ))
+            db.session.add_all(movements)
+            db.session.flush()
+            record_lot_trace('transfer', target, movements[1], quantity, source_lot=source)
+            return target_name
+        
+        try:
+            target_name = commit_with_retry(run)
+        except ExecutionError as e:
+            db.session.rollback()
+            flash(f'エラー: {e}', 'danger')
+            return render_template('transfer_lot.html', form=form, lot=lot)
+        flash(f'ロット「{lot.lot_name}」を{target_name}へ{quantity}{lot.material.unit}移動しました', 'success')
+        return redirect(url_for('lots', material_id=lot.material_id))
+    return render_template('transfer_lot.html', form=form, lot=lot)
+
+@app.route('/set_location/<int:location_id>')
+def set_location(location_id):
+    """表示する拠点を切り替える（0 = 全拠点）"""
+    if location_id and Location.query.get(location_id) is None:
+        flash('拠点が見つかりません', 'danger')
+    else:
+        session['location_id'] = location_id or None
+    return redirect(request.referrer or url_for('index'))
+
+@app.route('/locations', methods=['GET', 'POST'])
+def locations():
+    """拠点管理"""
+    form = LocationForm()
+    if form.validate_on_submit():
+        name = form.name.data.strip()
+        if Location.query.filter_by(name=name).first():
+            flash(f'拠点「{name}」は既に登録されています', 'danger')
+        else:
+            db.session.add(Location(name=name))
+            db.session.commit()
+            flash(f'拠点「{name}」を追加しました', 'success')
+            return redirect(url_for('locations'))
+    
+    lot_counts = dict(db.session.query(Lot.location_id, db.func.count(Lot.id)).group_by(Lot.location_id).all())
+    reservation_counts = dict(db.session.query(
+        Reservation.location_id, db.func.count(Reservation.id)
+    ).filter(Reservation.executed == False).group_by(Reservation.location_id).all())
+    return render_template('locations.html', form=form,
+                           location_list=Location.query.order_by(Location.name).all(),
+                           lot_counts=lot_counts, reservation_counts=reservation_counts)
+
+@app.route('/delete_location/<int:id>', methods=['POST'])
+def delete_location(id):
+    """拠点削除（ロット・予約が残っている拠点は削除しない）"""
+    location = Location.query.get_or_404(id)
+    in_use = Lot.query.filter_by(location_id=id).first() or Reservation.query.filter_by(location_id=id).first()
+    if in_use:
+        flash(f'拠点「{location.name}」にはロットまたは予約履歴があるため削除できません', 'danger')
+    else:
+        db.session.delete(location)
+        db.session.commit()
+        if session.get('location_id') == id:
+            session.pop('location_id')
+        flash(f'拠点「{location.name}」を削除しました', 'success')
+    return redirect(url_for('locations'))
+
+def filter_reservations(query, filters):
+    """予約一覧の絞り込み条件（期間・原料・使用者・期限切れ）を適用"""
+    if filters.get('date_from'):
+        query = query.filter(Reservation.scheduled_date >= filters['date_from'])
+    if filters.get('date_to'):
+        query = query.filter(Reservation.scheduled_date <= filters['date_to'])
+    if filters.get('material_id'):
+        query = query.filter(Reservation.material_id == filters['material_id'])
+    if filters.get('user_name'):
+        query = query.filter(Reservation.user_name.contains(filters['user_name']))
+    if filters.get('overdue'):
+        query = query.filter(Reservation.scheduled_date < date.today())
+    if filters.get('location_id'):
+        query = query.filter(Reservation.location_id == filters['location_id'])
+    return query
+
 @app.route('/reservations')
 def reservations():
     """予約管理ページ"""
-    use_reservations = Reservation.query.filter_by(type='use', executed=False).order_by(Reservation.scheduled_date.asc(), Reservation.date.desc()).all()
-    replenish_reservations = Reservation.query.filter_by(type='replenish', executed=False).order_by(Reservation.scheduled_date.asc(), Reservation.date.desc()).all()
+    from sqlalchemy.orm import selectinload
+    
+    def parse_date(value):
+        try:
+            return datetime.strptime(value, '%Y-%m-%d').date() if value else None
+        except ValueError:
+            return None
+    
+    filters = {
+        'date_from': parse_date(request.args.get('date_from')),
+        'date_to': parse_date(request.args.get('date_to')),
+        'material_id': request.args.get('material_id', type=int),
+        'user_name': request.args.get('user_name', '').strip(),
+        'overdue': request.args.get('overdue') == '1',
+        'location_id': get_current_location_id()
+    }
+    per_page = min(max(request.args.get('per_page', 30, type=int), 1), 200)
+    
+    def pending(type_):
+        query = Reservation.query.filter_by(type=type_, executed=False).options(
+            selectinload(Reservation.material),
+            selectinload(Reservation.lot),
+            selectinload(Reservation.recipe)
+        )
+        return filter_reservations(query, filters).order_by(
+            Reservation.scheduled_date.asc(), Reservation.date.desc()
+        )
     
-    # 期限切れ予約を抽出
-    overdue_reservations = [r for r in use_reservations + replenish_reservations if r.is_overdue()]
+    # 個別の使用予約・補充予約はページング
+    use_pagination = pending('use').filter(Reservation.recipe_id.is_(None)).paginate(
+        page=request.args.get('page', 1, type=int), per_page=per_page, error_out=False)
+    replenish_pagination = pending('replenish').paginate(
+        page=request.args.get('rpage', 1, type=int), per_page=per_page, error_out=False)
+    
+    # レシピ予約は一括実行のためグループ単位で全件表示
+    recipe_reservations = pending('use').filter(Reservation.recipe_id.isnot(None)).all()
+    
+    # 期限切れ予約数（絞り込みに関係なく全体）
+    overdue_count = Reservation.query.filter(
+        Reservation.executed == False,
+        Reservation.scheduled_date < date.today()
+    ).count()
     
     # レシピ予約をグループ化
     recipe_groups = {}
-    for r in use_reservations:
-        if r.recipe_id:
-            if r.recipe_id not in recipe_groups:
-                recipe_groups[r.recipe_id] = {
-                    'recipe': r.recipe,
-                    'scheduled_date': r.scheduled_date,
-                    'user_name': r.user_name,
-                    'purpose': r.purpose,
-                    'reservations': []
-                }
-            recipe_groups[r.recipe_id]['reservations'].append(r)
+    for r in recipe_reservations:
+        if r.recipe_id not in recipe_groups:
+            recipe_groups[r.recipe_id] = {
+                'recipe': r.recipe,
+                'scheduled_date': r.scheduled_date,
+                'user_name': r.user_name,
+                'purpose': r.purpose,
+                'reservations': []
+            }
+        recipe_groups[r.recipe_id]['reservations'].append(r)
+    
+    material_choices = db.session.query(RawMaterial.id, RawMaterial.name).order_by(RawMaterial.name).all()
+    
+    def page_url(**changes):
+        args = request.args.to_dict()
+        args.update(changes)
+        return url_for('reservations', **args)
     
     return render_template('reservations.html', 
-                         use_reservations=use_reservations,
-                         replenish_reservations=replenish_reservations,
-                         overdue_count=len(overdue_reservations),
-                         recipe_groups=recipe_groups)
+                         use_reservations=use_pagination.items,
+                         replenish_reservations=replenish_pagination.items,
+                         use_pagination=use_pagination,
+                         replenish_pagination=replenish_pagination,
+                         use_total=use_pagination.total + len(recipe_reservations),
+                         overdue_count=overdue_count,
+                         recipe_groups=recipe_groups,
+                         filters=filters,
+                         material_choices=material_choices,
+                         page_url=page_url)
 
-@app.route('/execute_reservation/<int:id>', methods=['GET', 'POST'])
-def execute_reservation(id):
-    """予約を実行して在庫に反映"""
-    reservation = Reservation.query.get_or_404(id)
-    material = reservation.material
-    
-    # POSTリクエストの場合、実際の量とロット情報を取得
-    if request.method == 'POST':
-        actual_quantity = float(request.form.get('actual_quantity', reservation.quantity))
-        reservation.actual_quantity = actual_quantity
-        quantity_to_use = actual_quantity
-        
-        # 使用予約の場合はロット選択を取得
-        if reservation.type == 'use':
-            lot_id = request.form.get('lot_id')
+# ロット自動割当の既定方式（'fefo' = 使用期限の近い順 / 'fifo' = 登録の古い順）
+app.config.setdefault('LOT_ALLOCATION_STRATEGY', 'fefo')
+
+# 楽観ロック（Lot / Reservation の version 列）の競合時に再実行する回数
+app.config.setdefault('CONFLICT_RETRY_ATTEMPTS', 3)
+
+class ConcurrencyConflict(Exception):
+    """他の操作と同時に更新され、処理を反映できなかった場合のエラー"""
+    def __init__(self, message='他の操作と同時に更新されたため処理できませんでした。画面を更新して内容を確認してからやり直してください'):
+        super().__init__(message)
+
+def commit_with_retry(operation, attempts=None):
+    """operation() を実行してコミットし、楽観ロックの競合時は最新の状態で再実行する
+
+    operation は何度実行しても同じ結果になる（冪等な）処理に限ること。
+    対象の行は operation の中で読み直す（ロールバックで属性は失効し、再読込される）。
+    """
+    attempts = attempts or app.config['CONFLICT_RETRY_ATTEMPTS']
+    for attempt in range(attempts):
+        try:
+            result = operation()
+            db.session.commit()
+            return result
+        except StaleDataError:
+            db.session.rollback()
+            database_stats.count('conflict_retries')
+            time.sleep(0.01 * (attempt + 1))
+            claim_idempotency_key()  # ロールバックで消えた仮レコードを入れ直す
+    raise ConcurrencyConflict()
+
+@app.errorhandler(ConcurrencyConflict)
+@app.errorhandler(StaleDataError)
+def handle_concurrency_conflict(error):
+    """再試行しない更新で競合した場合は 409 / 元の画面に戻して通知する"""
+    db.session.rollback()
+    message = str(ConcurrencyConflict()) if isinstance(error, StaleDataError) else str(error)
+    if request.path.startswith('/api/'):
+        return jsonify({'error': message, 'conflict': True}), 409
+    flash(message, 'warning')
+    return redirect(request.referrer or url_for('index'))
+
+class ExecutionError(Exception):
+    """予約を実行できない場合のエラー（メッセージは画面にそのまま表示する）"""
+
+class AllocationError(ExecutionError):
+    """ロット割当ができない場合のエラー"""
+
+def allocation_order(strategy):
+    """割当順の ORDER BY（ix_lot_material_expiry の並びに合わせる）"""
+    if strategy == 'fifo':
+        return (Lot.date_created, Lot.id)
+    # 期限なしのロットは期限ありのロットの後に FIFO で使う
+    return (Lot.expiry_date.is_(None), Lot.expiry_date, Lot.date_created, Lot.id)
+
+def allocate_lots(material_id, quantity, strategy=None, location_id=None, preferred_lot_id=None):
+    """使用量を原料のロットに割り当てる
+
+    preferred_lot_id があればそのロットから優先して引き当て、不足分を
+    FEFO/FIFO 順に他のロットから補う。(material_id, expiry_date, date_created) の
+    インデックス順に在庫のあるロットを先頭から読むだけなので、割当に使う k 件だけを取得する。
+    戻り値は [(lot, 引当量), ...]。在庫が足りない場合は AllocationError。
+    """
+    strategy = strategy or app.config['LOT_ALLOCATION_STRATEGY']
+    remaining = quantity
+    split = []
+    
+    if preferred_lot_id:
+        lot = db.session.get(Lot, preferred_lot_id)
+        if lot is None or lot.material_id != material_id:
+            raise AllocationError('選択したロットが見つかりません')
+        take = min(lot.weight, remaining)
+        if take > 0:
+            split.append((lot, take))
+            remaining -= take
+    
+    if remaining > 1e-9:
+        query = Lot.query.filter(Lot.material_id == material_id, Lot.weight > 0)
+        if preferred_lot_id:
+            query = query.filter(Lot.id != preferred_lot_id)
+        if location_id:
+            query = query.filter(Lot.location_id == location_id)
+        for lot in query.order_by(*allocation_order(strategy)).yield_per(16):
+            take = min(lot.weight, remaining)
+            split.append((lot, take))
+            remaining -= take
+            if remaining <= 1e-9:
+                break
+    
+    if remaining > 1e-9:
+        available = quantity - remaining
+        raise AllocationError(f'在庫が不足しています（必要: {quantity:g} / 引当可能: {available:g}）')
+    return split
+
+def execute_use_reservation(reservation, quantity, preferred_lot_id=None, strategy=None, recipe_run_id=None):
+    """使用予約を実行し、ロットから在庫を引き落として割当内訳を記録する
+
+    recipe_run_id はレシピの一括実行（RecipeRun）の中で実行する場合に渡す（トレース用）。
+    実績0（使わなかった）の場合はロットを引き落とさず、予約のロット指定もそのまま残す。
+    """
+    split = allocate_lots(reservation.material_id, quantity, strategy=strategy,
+                          location_id=reservation.location_id, preferred_lot_id=preferred_lot_id)
+    for lot, take in split:
+        lot.weight -= take
+        reservation.allocations.append(LotAllocation(lot_id=lot.id, lot_name=lot.lot_name, quantity=take))
+    if split:
+        reservation.lot_id = split[0][0].id
+    reservation.actual_quantity = quantity
+    reservation.executed = True
+    reservation.executed_date = datetime.now()
+    record_daily_usage(reservation)
+    for lot, take in split:
+        record_lot_trace('consume', lot, reservation, take, recipe_run_id=recipe_run_id)
+    return split
+
+def execute_replenish_reservation(reservation, quantity, lot_name=None):
+    """補充予約を実行し、同じ拠点の同名ロットに合算（なければ新規ロット作成）する"""
+    if lot_name:
+        reservation.lot_name = lot_name
+    if not reservation.lot_name:
+        raise ExecutionError('ロット名を入力してください')
+    
+    lot = Lot.query.filter_by(
+        material_id=reservation.material_id, lot_name=reservation.lot_name, location_id=reservation.location_id
+    ).first()
+    if lot:
+        lot.weight += quantity
+    else:
+        lot = Lot(material_id=reservation.material_id, lot_name=reservation.lot_name, weight=quantity,
+                  location_id=reservation.location_id)
+        db.session.add(lot)
+        db.session.flush()  # トレース用にロットIDを確定
+    
+    # 予約を実行済みにマーク
+    reservation.actual_quantity = quantity
+    reservation.executed = True
+    reservation.executed_date = datetime.now()
+    record_daily_usage(reservation)
+    # 既存ロットへの合算も「このロットに入った」として記録する
+    record_lot_trace('produce', lot, reservation, quantity)
+    return lot
+
+# ロットのトレーサビリティ
+#   consume  -- ロット → 製造（使用予約の実行。レシピの一括実行なら recipe_run_id つき）
+#   produce  -- 補充・ロット追加 → ロット（既存ロットへの合算を含む）
+#   transfer -- ロット（source_lot_id）→ ロット（拠点間移動で移動先の同名ロットに合算）
+# lot_id は外部キーにしないので、ロットを削除してもリンクは残る。
+
+class RecipeRun(db.Model):
+    """レシピの一括実行1回分（製造ロットのトレース単位）"""
+    __tablename__ = 'recipe_run'
+    id = db.Column(db.Integer, primary_key=True)
+    recipe_id = db.Column(db.Integer, nullable=False, index=True)
+    executed_date = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+class LotTraceLink(db.Model):
+    """ロットと製造・補充・移動のつながり"""
+    __tablename__ = 'lot_trace_link'
+    __table_args__ = (
+        db.Index('ix_lot_trace_link_lot', 'lot_id', 'kind', 'created_at'),
+        db.Index('ix_lot_trace_link_source', 'source_lot_id', 'created_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(10), nullable=False)  # 'consume' / 'produce' / 'transfer'
+    lot_id = db.Column(db.Integer, nullable=False)  # 使われた（consume）・入った（produce/transfer）ロット
+    source_lot_id = db.Column(db.Integer, nullable=True)  # transfer の移動元ロット
+    lot_name = db.Column(db.String(100), nullable=False)  # ロット削除後も表示できるよう名前を保持
+    material_id = db.Column(db.Integer, nullable=False)
+    reservation_id = db.Column(db.Integer, nullable=False, index=True)  # アーカイブ後も同じID
+    recipe_run_id = db.Column(db.Integer, nullable=True, index=True)
+    quantity = db.Column(db.Float, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+
+def record_lot_trace(kind, lot, reservation, quantity, source_lot=None, recipe_run_id=None):
+    """トレース用のリンクを1件記録する（呼び出し元のトランザクション内で実行）"""
+    db.session.add(LotTraceLink(
+        kind=kind, lot_id=lot.id, source_lot_id=source_lot.id if source_lot else None,
+        lot_name=lot.lot_name, material_id=lot.material_id, reservation_id=reservation.id,
+        recipe_run_id=recipe_run_id, quantity=quantity,
+        created_at=reservation.executed_date or datetime.now()
+    ))
+
+def trace_run_key(link):
+    """製造の単位: レシピの一括実行ならその RecipeRun、そうでなければ使用予約1件"""
+    return ('recipe_run', link.recipe_run_id) if link.recipe_run_id else ('reservation', link.reservation_id)
+
+def describe_trace_runs(links):
+    """consume リンクを製造ごとにまとめる（予約・レシピの情報はアーカイブも含めて1回ずつ取得）"""
+    reservation_ids = {link.reservation_id for link in links}
+    run_ids = {link.recipe_run_id for link in links if link.recipe_run_id}
+    history = executed_history()
+    reservations = {row.id: row for row in db.session.query(
+        history.c.id, history.c.material_id, history.c.user_name, history.c.purpose,
+        history.c.executed_date, history.c.recipe_id
+    ).filter(history.c.id.in_(reservation_ids))} if reservation_ids else {}
+    recipe_runs = {run.id: run for run in RecipeRun.query.filter(RecipeRun.id.in_(run_ids))} if run_ids else {}
+    recipe_ids = {run.recipe_id for run in recipe_runs.values()} | {r.recipe_id for r in reservations.values() if r.recipe_id}
+    recipe_names = dict(db.session.query(Recipe.id, Recipe.name).filter(Recipe.id.in_(recipe_ids))) if recipe_ids else {}
+    material_names = dict(db.session.query(RawMaterial.id, RawMaterial.name).filter(
+        RawMaterial.id.in_({link.material_id for link in links}))) if links else {}
+    
+    runs = OrderedDict()
+    for link in sorted(links, key=lambda link: (link.created_at, link.id)):
+        kind, key = trace_run_key(link)
+        run = runs.get((kind, key))
+        if run is None:
+            reservation = reservations.get(link.reservation_id)
+            recipe_id = recipe_runs[key].recipe_id if kind == 'recipe_run' and key in recipe_runs else (
+                reservation.recipe_id if reservation else None)
+            run = runs[(kind, key)] = {
+                'run_type': kind,
+                'run_id': key,
+                'recipe_id': recipe_id,
+                'recipe_name': recipe_names.get(recipe_id),
+                'executed_date': link.created_at.isoformat(timespec='seconds'),
+                'user_name': reservation.user_name if reservation else None,
+                'purpose': reservation.purpose if reservation else None,
+                'reservation_ids': [],
+                'lots': []
+            }
+        if link.reservation_id not in run['reservation_ids']:
+            run['reservation_ids'].append(link.reservation_id)
+        run['lots'].append({'lot_id': link.lot_id, 'lot_name': link.lot_name,
+                            'material': material_names.get(link.material_id), 'quantity': round(link.quantity, 3)})
+    return list(runs.values())
+
+def trace_forward(lot_id):
+    """ロット → それを使った製造（移動先のロットに合算された分も、移動後の使用をたどる）
+
+    戻り値は (たどったロット {lot_id: 材料が入った時刻 or None}, 製造の一覧)。
+    """
+    reached = {lot_id: None}
+    frontier = [lot_id]
+    while frontier:
+        moved = LotTraceLink.query.filter(
+            LotTraceLink.kind == 'transfer', LotTraceLink.source_lot_id.in_(frontier)
+        ).all()
+        frontier = []
+        for link in moved:
+            since = reached[link.source_lot_id]
+            if since is not None and link.created_at < since:
+                continue  # 移動元に材料が入る前の移動
+            if link.lot_id not in reached or (reached[link.lot_id] is not None and link.created_at < reached[link.lot_id]):
+                reached[link.lot_id] = link.created_at
+                frontier.append(link.lot_id)
+    
+    consumed = [
+        link for link in LotTraceLink.query.filter(
+            LotTraceLink.kind == 'consume', LotTraceLink.lot_id.in_(list(reached))
+        )
+        if reached[link.lot_id] is None or link.created_at >= reached[link.lot_id]
+    ]
+    return reached, describe_trace_runs(consumed)
+
+def trace_backward(recipe_run_id=None, reservation_id=None):
+    """製造 → 使われたロットと、そのロットに入った補充・移動元（使用時点より前のもの）を再帰的にたどる"""
+    query = LotTraceLink.query.filter(LotTraceLink.kind == 'consume')
+    if recipe_run_id is not None:
+        query = query.filter(LotTraceLink.recipe_run_id == recipe_run_id)
+    else:
+        query = query.filter(LotTraceLink.reservation_id == reservation_id)
+    consumed = query.all()
+    
+    until = {}  # lot_id -> この時刻までに入ったものが対象
+    for link in consumed:
+        until[link.lot_id] = max(until.get(link.lot_id, link.created_at), link.created_at)
+    lots = {}
+    frontier = list(until)
+    while frontier:
+        sources = LotTraceLink.query.filter(
+            LotTraceLink.kind.in_(('produce', 'transfer')), LotTraceLink.lot_id.in_(frontier)
+        ).order_by(LotTraceLink.created_at, LotTraceLink.id).all()
+        frontier = []
+        for link in sources:
+            if link.created_at > until[link.lot_id]:
+                continue  # 使用後に入った分は関係しない
+            entry = lots.setdefault(link.lot_id, {'lot_id': link.lot_id, 'lot_name': link.lot_name,
+                                                  'material_id': link.material_id, 'inputs': []})
+            entry['inputs'].append({
+                'kind': link.kind,
+                'reservation_id': link.reservation_id,
+                'source_lot_id': link.source_lot_id,
+                'quantity': round(link.quantity, 3),
+                'date': link.created_at.isoformat(timespec='seconds')
+            })
+            if link.kind == 'transfer' and (link.source_lot_id not in until or until[link.source_lot_id] < link.created_at):
+                until[link.source_lot_id] = link.created_at
+                frontier.append(link.source_lot_id)
+    for lot_id in until:
+        lots.setdefault(lot_id, {'lot_id': lot_id, 'lot_name': None, 'material_id': None, 'inputs': []})
+    existing = {row.id for row in db.session.query(Lot.id).filter(Lot.id.in_(list(lots)))}
+    used = {link.lot_id: link for link in consumed}
+    for entry in lots.values():
+        if entry['lot_id'] in used:
+            entry['lot_name'] = entry['lot_name'] or used[entry['lot_id']].lot_name
+            entry['material_id'] = entry['material_id'] or used[entry['lot_id']].material_id
+        entry['deleted'] = entry['lot_id'] not in existing
+    return {
+        'runs': describe_trace_runs(consumed),
+        'lots': sorted(lots.values(), key=lambda entry: entry['lot_id'])
+    }
+
+def rebuild_lot_trace():
+    """既存の履歴からトレース用リンクを作り直す（導入前のデータ用）
+
+    ロット割当の記録（なければ予約のロット）を consume、補充を produce、
+    同時刻・同量の transfer_out / transfer_in の組を transfer とする。
+    在庫調整の履歴（is_stock_adjustment）は実行時と同じくリンクを作らない。
+    導入前のレシピ実行はまとめられないため、使用予約1件ずつの製造として扱う
+    （記録済みのレシピ実行との対応は引き継ぐ）。
+    """
+    recipe_runs = dict(db.session.query(LotTraceLink.reservation_id, LotTraceLink.recipe_run_id).filter(
+        LotTraceLink.recipe_run_id.isnot(None)))
+    LotTraceLink.query.delete()
+    history = executed_history()
+    rows = db.session.query(
+        history.c.id, history.c.material_id, history.c.lot_id, history.c.lot_name, history.c.type,
+        history.c.quantity, history.c.actual_quantity, history.c.executed_date, history.c.location_id,
+        history.c.user_name, history.c.purpose
+    ).order_by(history.c.executed_date, history.c.id).all()
+    allocations = {}
+    for allocation in LotAllocation.query.filter(LotAllocation.lot_id.isnot(None)):
+        allocations.setdefault(allocation.reservation_id, []).append(allocation)
+    lots_by_name = {(lot.material_id, lot.lot_name, lot.location_id): lot.id for lot in Lot.query}
+    
+    links = []
+    pending_out = {}
+    for row in rows:
+        if is_stock_adjustment(row.user_name, row.purpose):
+            continue
+        when = row.executed_date or datetime.now()
+        quantity = row.actual_quantity if row.actual_quantity is not None else row.quantity
+        def link(kind, lot_id, lot_name, amount, source_lot_id=None):
+            links.append({'kind': kind, 'lot_id': lot_id, 'source_lot_id': source_lot_id, 'lot_name': lot_name or '',
+                          'material_id': row.material_id, 'reservation_id': row.id,
+                          'recipe_run_id': recipe_runs.get(row.id) if kind == 'consume' else None,
+                          'quantity': amount, 'created_at': when})
+        if row.type == 'use':
+            if row.id in allocations:
+                for allocation in allocations[row.id]:
+                    link('consume', allocation.lot_id, allocation.lot_name, allocation.quantity)
+            elif row.lot_id:
+                link('consume', row.lot_id, row.lot_name, quantity)
+        elif row.type == 'replenish':
+            lot_id = row.lot_id or lots_by_name.get((row.material_id, row.lot_name, row.location_id))
             if lot_id:
-                reservation.lot_id = int(lot_id)
+                link('produce', lot_id, row.lot_name, quantity)
+        elif row.type == 'transfer_out':
+            pending_out[(row.material_id, row.lot_name, when, quantity)] = row.lot_id
+        elif row.type == 'transfer_in':
+            source_lot_id = pending_out.pop((row.material_id, row.lot_name, when, quantity), None)
+            if source_lot_id and row.lot_id:
+                link('transfer', row.lot_id, row.lot_name, quantity, source_lot_id)
+    if links:
+        db.session.execute(LotTraceLink.__table__.insert(), links)
+    db.session.commit()
+    return len(links)
+
+@app.cli.command('rebuild-lot-trace')
+def rebuild_lot_trace_command():
+    """既存の履歴からロットのトレース用リンクを作り直す"""
+    db.create_all()
+    count = rebuild_lot_trace()
+    print(f'✓ トレース用リンクを{count}件作成しました')
+
+@app.route('/api/trace/lot/<int:lot_id>')
+def api_trace_lot(lot_id):
+    """前方トレース: ロット（移動先を含む）を使った製造の一覧"""
+    reached, runs = trace_forward(lot_id)
+    return jsonify({
+        'lot_id': lot_id,
+        'lots': [{'lot_id': key, 'since': since.isoformat(timespec='seconds') if since else None}
+                 for key, since in reached.items()],
+        'total': len(runs),
+        'runs': runs
+    })
+
+@app.route('/api/trace/recipe_run/<int:run_id>')
+def api_trace_recipe_run(run_id):
+    """後方トレース: レシピ実行に使われたロットと、その入荷元・移動元"""
+    return jsonify(trace_backward(recipe_run_id=run_id))
+
+@app.route('/api/trace/reservation/<int:reservation_id>')
+def api_trace_reservation(reservation_id):
+    """後方トレース: 使用予約1件に使われたロットと、その入荷元・移動元"""
+    return jsonify(trace_backward(reservation_id=reservation_id))
+
+@app.route('/trace/lot/<int:lot_id>')
+def lot_trace(lot_id):
+    """ロットの前方トレース画面"""
+    lot = db.session.get(Lot, lot_id)
+    link = LotTraceLink.query.filter_by(lot_id=lot_id).first()
+    if lot is None and link is None:
+        flash('ロットが見つかりません', 'danger')
+        return redirect(url_for('index'))
+    reached, runs = trace_forward(lot_id)
+    return render_template('lot_trace.html', lot=lot, lot_id=lot_id,
+                           lot_name=lot.lot_name if lot else link.lot_name,
+                           transferred=len(reached) - 1, runs=runs)
+
+def describe_split(split, unit):
+    """割当内訳の表示用文字列"""
+    return '、'.join(f'{lot.lot_name}: {take:g}{unit}' for lot, take in split) or f'0{unit}'
+
+def parse_lot_choice(value):
+    """ロット選択欄の値（'auto' または空欄は自動割当）"""
+    if not value or value == 'auto':
+        return None
+    return int(value)
+
+@app.route('/api/material_lots/<int:material_id>')
+def api_material_lots(material_id):
+    """実行ダイアログ用のロット選択肢（自動割当で使われる順）"""
+    lots = db.session.query(Lot.id, Lot.lot_name, Lot.weight, Lot.expiry_date).filter(
+        Lot.material_id == material_id
+    ).order_by(*allocation_order(app.config['LOT_ALLOCATION_STRATEGY'])).all()
+    return jsonify([
+        {'id': lot.id, 'lot_name': lot.lot_name, 'weight': round(lot.weight, 3),
+         'expiry_date': lot.expiry_date.isoformat() if lot.expiry_date else None}
+        for lot in lots
+    ])
+
+@app.route('/execute_reservation/<int:id>', methods=['GET', 'POST'])
+def execute_reservation(id):
+    reservation = Reservation.query.get_or_404(id)
+    
+    # POSTリクエストの場合、実際の量とロット情報を取得
+    preferred_lot_id = reservation.lot_id
+    lot_name = None
+    if request.method == 'POST':
+        quantity_to_use = float(request.form.get('actual_quantity', reservation.quantity))
+        
+        # 使用予約の場合はロット選択を取得（未選択は自動割当）
+        if reservation.type == 'use':
+            preferred_lot_id = parse_lot_choice(request.form.get('lot_id'))
         # 補充予約の場合はロット名を取得
         elif reservation.type == 'replenish':
-            lot_name = request.form.get('lot_name', '').strip()
-            if lot_name:
-                reservation.lot_name = lot_name
+            lot_name = request.form.get('lot_name', '').strip() or None
     else:
         # GETリクエストの場合は予約量を使用（後方互換性のため）
         quantity_to_use = reservation.quantity
         if reservation.actual_quantity:
             quantity_to_use = reservation.actual_quantity
     
-    try:
-        if reservation.type == 'use':
-            # 使用予約の実行
-            if not reservation.lot_id:
-                flash('エラー: ロットを選択してください', 'danger')
-                return redirect(url_for('reservations'))
-            
-            lot = reservation.lot
-            if lot.weight >= quantity_to_use:
-                lot.weight -= quantity_to_use
-            else:
-                flash(f'エラー: ロット「{lot.lot_name}」の在庫が不足しています', 'danger')
-                return redirect(url_for('reservations'))
+    def run():
+        # 競合時は最新の状態で再実行されるため、予約はここで読み直す
+        reservation = db.session.get(Reservation, id)
+        material = reservation.material
+        if reservation.executed:
+            return 'info', f'この予約は既に実行済みです: {material.name}'
         
-        elif reservation.type == 'replenish':
-            # 補充予約の実行
-            if not reservation.lot_name:
-                flash('エラー: ロット名を入力してください', 'danger')
-                return redirect(url_for('reservations'))
-            
-            # 新規ロット名が指定されている場合
-            existing_lot = Lot.query.filter_by(material_id=material.id, lot_name=reservation.lot_name).first()
-            if existing_lot:
-                # 既存ロットに追加
-                existing_lot.weight += quantity_to_use
-            else:
-                # 新規ロット作成
-                new_lot = Lot(material_id=material.id, lot_name=reservation.lot_name, weight=quantity_to_use)
-                db.session.add(new_lot)
+        if reservation.type == 'use':
+            # 使用予約の実行（不足分は他のロットから自動で引き当てる）
+            split = execute_use_reservation(reservation, quantity_to_use, preferred_lot_id)
+            return 'success', f'予約を実行しました: {material.name} ({describe_split(split, material.unit)})'
         
-        # 予約を実行済みにマーク
-        reservation.executed = True
-        reservation.executed_date = datetime.now()
-        db.session.commit()
-        flash(f'予約を実行しました: {material.name} ({quantity_to_use} {material.unit})', 'success')
+        # 補充予約の実行
+        execute_replenish_reservation(reservation, quantity_to_use, lot_name)
+        return 'success', f'予約を実行しました: {material.name} ({quantity_to_use} {material.unit})'
     
+    try:
+        category, message = commit_with_retry(run)
+        flash(message, category)
+    except ExecutionError as e:
+        db.session.rollback()
+        flash(f'エラー: {reservation.material.name}の{e}', 'danger')
+    except ConcurrencyConflict as e:
+        flash(str(e), 'warning')
     except Exception as e:
         db.session.rollback()
         flash(f'エラーが発生しました: {str(e)}', 'danger')
@@ -706,69 +2955,88 @@ def execute_recipe(recipe_id):
     """レシピ予約を一括実行"""
     recipe = Recipe.query.get_or_404(recipe_id)
     
-    # このレシピに紐づく未実行の使用予約を取得
-    reservations = Reservation.query.filter_by(
-        recipe_id=recipe_id,
-        type='use',
-        executed=False
-    ).all()
-    
-    if not reservations:
-        flash('実行する予約が見つかりません', 'warning')
-        return redirect(url_for('reservations'))
-    
-    try:
-        # 各原料の実績値を取得して実行
+    def run():
+        # このレシピに紐づく未実行の使用予約を取得
+        reservations = Reservation.query.filter_by(
+            recipe_id=recipe_id,
+            type='use',
+            executed=False
+        ).all()
+        if not reservations:
+            return 'warning', '実行する予約が見つかりません'
+        
+        # この一括実行を1回の製造（レシピ実行）として記録する
+        recipe_run = RecipeRun(recipe_id=recipe_id, executed_date=datetime.now())
+        db.session.add(recipe_run)
+        db.session.flush()
+        
+        # 各原料の実績値を取得して実行（ロット未選択は自動割当）
         for reservation in reservations:
-            material = reservation.material
             actual_quantity_key = f'actual_quantity_{reservation.id}'
             actual_quantity = float(request.form.get(actual_quantity_key, reservation.quantity))
-            
-            # ロット選択を取得
-            lot_id_key = f'lot_id_{reservation.id}'
-            lot_id = request.form.get(lot_id_key)
-            
-            if not lot_id:
-                flash(f'エラー: {material.name}のロットを選択してください', 'danger')
-                db.session.rollback()
-                return redirect(url_for('reservations'))
-            
-            reservation.actual_quantity = actual_quantity
-            reservation.lot_id = int(lot_id)
-            
-            # 在庫を減少
-            lot = Lot.query.get(reservation.lot_id)
-            if not lot:
-                flash(f'エラー: ロットが見つかりません', 'danger')
-                db.session.rollback()
-                return redirect(url_for('reservations'))
-            
-            if lot.weight >= actual_quantity:
-                lot.weight -= actual_quantity
-            else:
-                flash(f'エラー: ロット「{lot.lot_name}」の在庫が不足しています', 'danger')
-                db.session.rollback()
-                return redirect(url_for('reservations'))
-            
-            # 予約を実行済みにマーク
-            reservation.executed = True
-            reservation.executed_date = datetime.now()
-        
-        db.session.commit()
-        flash(f'レシピ「{recipe.name}」の予約を一括実行しました', 'success')
+            lot_id = parse_lot_choice(request.form.get(f'lot_id_{reservation.id}'))
+            try:
+                execute_use_reservation(reservation, actual_quantity, lot_id, recipe_run_id=recipe_run.id)
+            except ExecutionError as e:
+                raise ExecutionError(f'{reservation.material.name}の{e}')
+        return 'success', f'レシピ「{recipe.name}」の予約を一括実行しました'
     
+    try:
+        category, message = commit_with_retry(run)
+        flash(message, category)
+    except ExecutionError as e:
+        db.session.rollback()
+        flash(f'エラー: {e}', 'danger')
+    except ConcurrencyConflict as e:
+        flash(str(e), 'warning')
     except Exception as e:
         db.session.rollback()
         flash(f'エラーが発生しました: {str(e)}', 'danger')
     
     return redirect(url_for('reservations'))
 
+@app.route('/execute_bulk', methods=['POST'])
+def execute_bulk():
+    """選択した使用予約を予約量のまま自動割当で一括実行（1件でも割当できなければ全件取り消し）"""
+    ids = [int(value) for value in request.form.getlist('reservation_ids') if value.isdigit()]
+    
+    def run():
+        reservations = Reservation.query.filter(
+            Reservation.id.in_(ids), Reservation.type == 'use', Reservation.executed == False
+        ).order_by(Reservation.scheduled_date, Reservation.id).all()
+        if not reservations:
+            return 'warning', '実行する予約が選択されていません'
+        for reservation in reservations:
+            try:
+                execute_use_reservation(reservation, reservation.quantity, reservation.lot_id)
+            except ExecutionError as e:
+                raise ExecutionError(f'{reservation.material.name}の{e}（一括実行を取り消しました）')
+        return 'success', f'{len(reservations)}件の使用予約を一括実行しました'
+    
+    try:
+        category, message = commit_with_retry(run)
+        flash(message, category)
+    except ExecutionError as e:
+        db.session.rollback()
+        flash(f'エラー: {e}', 'danger')
+    except ConcurrencyConflict as e:
+        flash(str(e), 'warning')
+    except Exception as e:
+        db.session.rollback()
+        flash(f'エラーが発生しました: {str(e)}', 'danger')
+    return redirect(url_for('reservations'))
+
 @app.route('/edit_reservation/<int:id>', methods=['GET', 'POST'])
 def edit_reservation(id):
     """予約編集"""
     reservation = Reservation.query.get_or_404(id)
     
     if request.method == 'POST':
+        # バージョンのない送信も、他の操作との競合を確認できないので競合として扱う
+        version = request.form.get('version', type=int)
+        if reservation.executed or version != reservation.version:
+            flash('この予約は他の操作で更新または実行されました。最新の内容を確認してください', 'warning')
+            return redirect(url_for('reservations') if reservation.executed else url_for('edit_reservation', id=id))
         reservation.user_name = request.form.get('user_name', '')
         reservation.purpose = request.form.get('purpose', '')
         reservation.quantity = float(request.form.get('quantity', reservation.quantity))
@@ -792,200 +3060,1303 @@ def edit_reservation(id):
         flash('予約を更新しました', 'success')
         return redirect(url_for('reservations'))
     
-    return render_template('edit_reservation.html', reservation=reservation)
+    return render_template('edit_reservation.html', reservation=reservation)
+
+@app.route('/delete_reservation/<int:id>')
+def delete_reservation(id):
+    """予約削除"""
+    reservation = Reservation.query.get_or_404(id)
+    db.session.delete(reservation)
+    db.session.commit()
+    flash('予約を削除しました', 'success')
+    return redirect(url_for('reservations'))
+
+@app.route('/export')
+@read_only_route
+def export():
+    materials = RawMaterial.query.all()
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(['ID', '名前', '現在重量', '単位', '最低量', '予測在庫'])
+    for material in materials:
+        current_weight = material.get_total_lot_weight()
+        predicted = material.get_predicted_stock()
+        writer.writerow([material.id, material.name, round(current_weight, 2), material.unit, material.min_weight, round(predicted, 2)])
+    output.seek(0)
+    # BOM付きUTF-8でエンコードして日本語文字化けを防止
+    csv_data = '\ufeff' + output.getvalue()
+    response = make_response(csv_data)
+    response.headers['Content-Disposition'] = 'attachment; filename=inventory.csv'
+    response.headers['Content-type'] = 'text/csv; charset=utf-8-sig'
+    return response
+
+# 分析用の列指向エクスポート（Parquet / Arrow IPC）
+#   movements    -- 実行済みの入出庫履歴（アーカイブ含む）。差分の基準は (実行日時, ID)
+#   reservations -- 予約（未実行を含む）。更新されるので常に全件
+#   lots         -- ロット。更新されるので常に全件
+app.config.setdefault('COLUMNAR_CHUNK_ROWS', 50000)  # 1行グループ（1回の読み出し）あたりの行数
+
+class ExportWatermark(db.Model):
+    """CLIの差分エクスポートで、前回どこまで書き出したか（名前ごと）"""
+    __tablename__ = 'export_watermark'
+    name = db.Column(db.String(100), primary_key=True)
+    watermark = db.Column(db.String(100), nullable=False)
+    row_count = db.Column(db.Integer, nullable=False, default=0)  # 前回書き出した行数
+    updated_at = db.Column(db.DateTime, default=datetime.now)
+
+def columnar_dataset(name):
+    """データセットの (列定義, SELECT, 並び順の列) を返す
+
+    列定義は (列名, 型) のリスト。型 'dict' は辞書エンコードする文字列列。
+    差分エクスポート（INCREMENTAL_DATASETS）では並び順の列が差分の基準になる。
+    """
+    if name == 'movements':
+        history = executed_history()
+        moved_at = db.func.coalesce(history.c.executed_date, history.c.date)
+        columns = [('id', 'int'), ('executed_date', 'timestamp'), ('material_id', 'int'), ('material', 'dict'),
+                   ('type', 'dict'), ('quantity', 'float'), ('actual_quantity', 'float'), ('lot_id', 'int'),
+                   ('lot_name', 'dict'), ('location', 'dict'), ('recipe_id', 'int'), ('user_name', 'dict'),
+                   ('purpose', 'dict'), ('scheduled_date', 'date'), ('date', 'timestamp')]
+        stmt = db.select(
+            history.c.id, moved_at, history.c.material_id, RawMaterial.name, history.c.type, history.c.quantity,
+            history.c.actual_quantity, history.c.lot_id, history.c.lot_name, Location.name, history.c.recipe_id,
+            history.c.user_name, history.c.purpose, history.c.scheduled_date, history.c.date
+        ).select_from(history).outerjoin(RawMaterial, RawMaterial.id == history.c.material_id) \
+         .outerjoin(Location, Location.id == history.c.location_id)
+        return columns, stmt, (moved_at, history.c.id)
+    if name == 'reservations':
+        columns = [('id', 'int'), ('material_id', 'int'), ('material', 'dict'), ('type', 'dict'),
+                   ('quantity', 'float'), ('actual_quantity', 'float'), ('lot_id', 'int'), ('lot_name', 'dict'),
+                   ('location', 'dict'), ('recipe_id', 'int'), ('user_name', 'dict'), ('purpose', 'dict'),
+                   ('scheduled_date', 'date'), ('date', 'timestamp'), ('executed', 'bool'), ('executed_date', 'timestamp')]
+        stmt = db.select(
+            Reservation.id, Reservation.material_id, RawMaterial.name, Reservation.type, Reservation.quantity,
+            Reservation.actual_quantity, Reservation.lot_id, Reservation.lot_name, Location.name, Reservation.recipe_id,
+            Reservation.user_name, Reservation.purpose, Reservation.scheduled_date, Reservation.date,
+            Reservation.executed, Reservation.executed_date
+        ).outerjoin(RawMaterial, RawMaterial.id == Reservation.material_id) \
+         .outerjoin(Location, Location.id == Reservation.location_id)
+        return columns, stmt, (Reservation.id,)
+    if name == 'lots':
+        columns = [('id', 'int'), ('material_id', 'int'), ('material', 'dict'), ('lot_name', 'str'),
+                   ('weight', 'float'), ('location', 'dict'), ('expiry_date', 'date'), ('date_created', 'timestamp')]
+        stmt = db.select(
+            Lot.id, Lot.material_id, RawMaterial.name, Lot.lot_name, Lot.weight, Location.name,
+            Lot.expiry_date, Lot.date_created
+        ).outerjoin(RawMaterial, RawMaterial.id == Lot.material_id).outerjoin(Location, Location.id == Lot.location_id)
+        return columns, stmt, (Lot.id,)
+    raise ValueError(f'不明なデータセットです: {name}')
+
+COLUMNAR_DATASETS = ('movements', 'reservations', 'lots')
+# 差分エクスポートできるのは追記だけのデータセット。予約・ロットは既存行が更新されるので
+# ID のウォーターマークでは変更を取りこぼす
+INCREMENTAL_DATASETS = ('movements',)
+
+def parse_watermark(value, key_columns):
+    """ウォーターマーク文字列（"ID" または "実行日時|ID"）を基準列の値に戻す"""
+    if not value:
+        return None
+    parts = value.split('|')
+    if len(parts) != len(key_columns):
+        raise ValueError(f'ウォーターマークの形式が正しくありません: {value}')
+    if len(parts) == 2:
+        return datetime.fromisoformat(parts[0]), int(parts[1])
+    return (int(parts[0]),)
+
+def format_watermark(key):
+    return '|'.join(part.isoformat() if isinstance(part, datetime) else str(part) for part in key)
+
+class DictionaryEncoder:
+    """バッチをまたいで辞書を共有する辞書エンコーダー
+
+    辞書は追記だけなので、各バッチの辞書は前のバッチの辞書の拡張になる
+    （Arrow IPC ファイルの辞書デルタとして書ける）。
+    """
+
+    def __init__(self):
+        self.values = []
+        self.index = {}
+
+    def encode(self, column):
+        pyarrow = optional_import('pyarrow')
+        indices = []
+        for value in column:
+            if value is None:
+                indices.append(None)
+                continue
+            position = self.index.get(value)
+            if position is None:
+                position = self.index[value] = len(self.values)
+                self.values.append(value)
+            indices.append(position)
+        return pyarrow.DictionaryArray.from_arrays(
+            pyarrow.array(indices, type=pyarrow.int32()), pyarrow.array(self.values, type=pyarrow.string())
+        )
+
+def arrow_type(kind):
+    pyarrow = optional_import('pyarrow')
+    return {
+        'int': pyarrow.int64(), 'float': pyarrow.float64(), 'str': pyarrow.string(), 'bool': pyarrow.bool_(),
+        'date': pyarrow.date32(), 'timestamp': pyarrow.timestamp('us'),
+        'dict': pyarrow.dictionary(pyarrow.int32(), pyarrow.string())
+    }[kind]
+
+def write_columnar_export(dataset, fileobj, fmt='parquet', since=None, chunk_rows=None):
+    """データセットを Parquet / Arrow IPC で fileobj に書き出す
+
+    サーバー側カーソルから chunk_rows 行ずつ読み、そのまま1行グループ（1バッチ）として書く。
+    since（ウォーターマーク文字列）を指定するとそれより後の行だけを書き出す（INCREMENTAL_DATASETS のみ）。
+    戻り値は (行数, 新しいウォーターマーク)。行がなければウォーターマークは since のまま。
+    差分エクスポートできないデータセットのウォーターマークは None。
+    """
+    incremental = dataset in INCREMENTAL_DATASETS
+    if since and not incremental:
+        raise ValueError(f'{dataset} は差分エクスポートに対応していません（全件のみ）')
+    pyarrow = optional_import('pyarrow')
+    if pyarrow is None:
+        raise RuntimeError('列指向エクスポートには pyarrow が必要です（pip install pyarrow）')
+    from pyarrow import parquet
+
+    chunk_rows = chunk_rows or app.config['COLUMNAR_CHUNK_ROWS']
+    columns, stmt, key_columns = columnar_dataset(dataset)
+    key = parse_watermark(since, key_columns)
+    if key is not None:
+        if len(key_columns) == 2:
+            stmt = stmt.where(db.or_(key_columns[0] > key[0], db.and_(key_columns[0] == key[0], key_columns[1] > key[1])))
+        else:
+            stmt = stmt.where(key_columns[0] > key[0])
+    stmt = stmt.order_by(*key_columns)
+    key_positions = [0] if len(key_columns) == 1 else [1, 0]  # 基準列の位置（SELECT内）
+
+    schema = pyarrow.schema([(name, arrow_type(kind)) for name, kind in columns])
+    encoders = {name: DictionaryEncoder() for name, kind in columns if kind == 'dict'}
+    if fmt == 'parquet':
+        writer = parquet.ParquetWriter(fileobj, schema, compression='zstd',
+                                               use_dictionary=[name for name, kind in columns if kind in ('dict', 'str')])
+    elif fmt == 'arrow':
+        writer = pyarrow.ipc.new_file(fileobj, schema, options=pyarrow.ipc.IpcWriteOptions(emit_dictionary_deltas=True))
+    else:
+        raise ValueError(f'形式は parquet または arrow です: {fmt}')
+
+    total = 0
+    last_key = None
+    try:
+        result = db.session.execute(stmt.execution_options(yield_per=chunk_rows))
+        for rows in result.partitions():
+            values = list(zip(*rows))
+            arrays = []
+            for (name, kind), column in zip(columns, values):
+                if kind == 'dict':
+                    arrays.append(encoders[name].encode(column))
+                elif kind == 'timestamp':
+                    # SQLite の文字列日時が混ざる場合に備えて datetime にそろえる
+                    arrays.append(pyarrow.array([datetime.fromisoformat(v) if isinstance(v, str) else v for v in column],
+                                                type=arrow_type(kind)))
+                else:
+                    arrays.append(pyarrow.array(column, type=arrow_type(kind)))
+            batch = pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+            if fmt == 'parquet':
+                writer.write_batch(batch, row_group_size=chunk_rows)
+            else:
+                writer.write_batch(batch)
+            total += len(rows)
+            last_row = rows[-1]
+            last_key = tuple(last_row[i] for i in key_positions)
+    finally:
+        writer.close()
+    if not incremental:
+        return total, None
+    if last_key is None:
+        return total, since
+    if isinstance(last_key[0], str):
+        last_key = (datetime.fromisoformat(last_key[0]),) + last_key[1:]
+    return total, format_watermark(last_key)
+
+@app.route('/export/columnar/<dataset>.<fmt>')
+@read_only_route
+def export_columnar(dataset, fmt):
+    """列指向エクスポートのダウンロード（movements は ?since=<前回の X-Export-Watermark> で差分のみ）"""
+    if dataset not in COLUMNAR_DATASETS or fmt not in ('parquet', 'arrow'):
+        return jsonify({'error': f'データセットは {", ".join(COLUMNAR_DATASETS)}、形式は parquet / arrow です'}), 404
+    if optional_import('pyarrow') is None:
+        return jsonify({'error': '列指向エクスポートには pyarrow が必要です'}), 501
+    import tempfile
+    output = tempfile.TemporaryFile()
+    try:
+        count, watermark = write_columnar_export(dataset, output, fmt, since=request.args.get('since'))
+    except ValueError as e:
+        output.close()
+        return jsonify({'error': str(e)}), 400
+    output.seek(0)
+    response = send_file(output, mimetype='application/vnd.apache.parquet' if fmt == 'parquet'
+                         else 'application/vnd.apache.arrow.file',
+                         as_attachment=True, download_name=f'{dataset}_{date.today().strftime("%Y%m%d")}.{fmt}')
+    response.headers['X-Export-Rows'] = str(count)
+    if watermark:
+        response.headers['X-Export-Watermark'] = watermark
+    return response
+
+@app.cli.command('export-columnar')
+@click.argument('dataset', type=click.Choice(COLUMNAR_DATASETS))
+@click.option('--format', 'fmt', type=click.Choice(['parquet', 'arrow']), default='parquet')
+@click.option('--output', '-o', default=None, help='出力ファイル（既定: <dataset>_<日時>.<形式>）')
+@click.option('--full', is_flag=True, help='前回のウォーターマークを無視して全件を書き出す')
+@click.option('--name', default=None, help='ウォーターマークの名前（既定: データセット名）')
+def export_columnar_command(dataset, fmt, output, full, name):
+    """入出庫履歴・予約・ロットを Parquet / Arrow で書き出す（入出庫履歴の既定は前回からの差分）"""
+    name = name or dataset
+    mark = None if full or dataset not in INCREMENTAL_DATASETS else db.session.get(ExportWatermark, name)
+    output = output or f'{dataset}_{datetime.now().strftime("%Y%m%d_%H%M%S")}.{fmt}'
+    temp_path = output + '.tmp'
+    try:
+        with open(temp_path, 'wb') as f:
+            count, watermark = write_columnar_export(dataset, f, fmt, since=mark.watermark if mark else None)
+    except (RuntimeError, ValueError) as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise click.ClickException(str(e))
+    # 書き出しが完了してからファイルを置き換え、ウォーターマークを進める
+    os.replace(temp_path, output)
+    if watermark:
+        mark = db.session.get(ExportWatermark, name) or ExportWatermark(name=name)
+        mark.watermark = watermark
+        mark.row_count = count
+        mark.updated_at = datetime.now()
+        db.session.add(mark)
+        db.session.commit()
+    click.echo(f'{output}: {count}行（ウォーターマーク: {watermark or "なし"}）')
+
+@app.route('/send_alert_email/<int:id>', methods=['POST'])
+def send_alert_email(id):
+    """アラートメールを送信"""
+    material = RawMaterial.query.get_or_404(id)
+    
+    if not material.email:
+        flash('購入担当者のメールアドレスが登録されていません。', 'warning')
+        return redirect(url_for('index'))
+    
+    try:
+        import smtplib
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
+        
+        # メール内容
+        current_weight = material.get_total_lot_weight()
+        predicted_stock = material.get_predicted_stock()
+        subject = f"【在庫アラート】{material.name}の補充が必要です"
+        body = f"""
+在庫管理システムからの自動通知
+
+原料名: {material.name}
+現在量: {current_weight:.2f} {material.unit}
+最低量: {material.min_weight} {material.unit}
+予測在庫量: {predicted_stock:.2f} {material.unit}
+
+予測在庫量が最低量を下回る見込みです。
+至急、補充の手配をお願いします。
+
+※このメールは在庫管理システムから自動送信されています。
+        """
+        
+        # 実際のメール送信（Gmail使用例）
+        # 注意: 本番環境では環境変数やconfigファイルで設定してください
+        sender_email = "your-email@gmail.com"  # 送信元メール
+        sender_password = "your-app-password"  # アプリパスワード
+        
+        msg = MIMEMultipart()
+        msg['From'] = sender_email
+        msg['To'] = material.email
+        msg['Subject'] = subject
+        msg.attach(MIMEText(body, 'plain', 'utf-8'))
+        
+        # Gmail SMTPサーバー経由で送信（実際の送信を有効にする場合はコメント解除）
+        # server = smtplib.SMTP('smtp.gmail.com', 587)
+        # server.starttls()
+        # server.login(sender_email, sender_password)
+        # server.send_message(msg)
+        # server.quit()
+        
+        # デモ用: 実際には送信せずにメッセージのみ表示
+        flash(f'アラートメールを {material.email} に送信しました（デモモード）', 'success')
+        
+    except Exception as e:
+        flash(f'メール送信に失敗しました: {str(e)}', 'danger')
+    
+    return redirect(url_for('index'))
+
+@app.route('/dashboard')
+def dashboard():
+    return render_template('dashboard.html')
+
+def serialize_periods(critical_periods):
+    """危機期間の日付をJSON互換形式に変換"""
+    return [{
+        'start_date': period['start_date'].isoformat() if period['start_date'] else None,
+        'end_date': period['end_date'].isoformat() if period['end_date'] else None,
+        'min_stock': round(period['min_stock'], 2),
+        'shortage': round(period['shortage'], 2)
+    } for period in critical_periods]
+
+def material_stock_overview(search=None, location_id=None, material_ids=None):
+    """全原料の現在量・予測在庫・危機期間を集計クエリでまとめて計算
+
+    原料ごとにロット・予約をロードせず、ロット合計と未実行予約を
+    それぞれ1回のクエリで取得して原料IDごとに振り分ける。
+    location_id を指定した場合はその拠点のロット・予約だけで計算し、
+    その拠点にロットも予約もない原料は含めない。
+    material_ids を指定した場合はその原料だけを計算する。
+    """
+    lot_query = db.session.query(Lot.material_id, db.func.sum(Lot.weight), db.func.count(Lot.id))
+    pending_query = db.session.query(
+        Reservation.material_id, Reservation.type, Reservation.quantity, Reservation.scheduled_date
+    ).filter(Reservation.executed == False)
+    if material_ids is not None:
+        material_ids = list(material_ids)
+        lot_query = lot_query.filter(Lot.material_id.in_(material_ids))
+        pending_query = pending_query.filter(Reservation.material_id.in_(material_ids))
+    if location_id:
+        lot_query = lot_query.filter(Lot.location_id == location_id)
+        pending_query = pending_query.filter(Reservation.location_id == location_id)
+    
+    current = {}
+    lot_counts = {}
+    for material_id, total, count in lot_query.group_by(Lot.material_id):
+        current[material_id] = total
+        lot_counts[material_id] = count
+    
+    pending = {}
+    for material_id, type_, quantity, scheduled_date in pending_query.order_by(
+        Reservation.material_id, Reservation.scheduled_date, Reservation.id
+    ):
+        pending.setdefault(material_id, []).append((scheduled_date, type_, quantity))
+    
+    query = db.session.query(
+        RawMaterial.id, RawMaterial.name, RawMaterial.unit, RawMaterial.min_weight,
+        RawMaterial.email, RawMaterial.excel_path, RawMaterial.action_type, RawMaterial.data_version
+    )
+    if search:
+        query = query.filter(RawMaterial.id.in_(search_material_ids(search)))
+    if material_ids is not None:
+        query = query.filter(RawMaterial.id.in_(material_ids))
+    if location_id:
+        query = query.filter(RawMaterial.id.in_(set(current) | set(pending)))
+    materials = query.order_by(RawMaterial.name).all()
+    
+    overview = []
+    for m in materials:
+        total_weight = current.get(m.id) or 0.0
+        rows = pending.get(m.id, [])
+        predicted = total_weight + sum(q if t == 'replenish' else -q for _, t, q in rows if t in ('use', 'replenish'))
+        critical_periods = compute_critical_periods(total_weight, m.min_weight, [r for r in rows if r[0]])
+        min_weight = m.min_weight or 0.0
+        overview.append({
+            'id': m.id,
+            'name': m.name,
+            'current': round(total_weight, 2),
+            'predicted': round(predicted, 2),
+            'min_weight': m.min_weight,
+            'unit': m.unit,
+            'email': m.email,
+            'excel_path': m.excel_path,
+            'action_type': m.action_type,
+            'data_version': m.data_version,
+            'lot_count': lot_counts.get(m.id, 0),
+            'critical_periods': critical_periods,
+            'shortage': round(max(max((p['shortage'] for p in critical_periods), default=0.0), 0.0), 2),
+            # 最低量に対する予測在庫の割合（小さいほど危険）
+            'ratio': predicted / min_weight if min_weight > 0 else float('inf')
+        })
+    return overview
+
+def sort_overview(overview, sort_by):
+    """ダッシュボード用の並び替え（shortage: 不足が大きい順）"""
+    if sort_by == 'name':
+        return sorted(overview, key=lambda m: m['name'])
+    if sort_by == 'current':
+        return sorted(overview, key=lambda m: -m['current'])
+    if sort_by == 'predicted':
+        return sorted(overview, key=lambda m: -m['predicted'])
+    if sort_by == 'danger':
+        return sorted(overview, key=lambda m: m['ratio'])
+    return sorted(overview, key=lambda m: (-m['shortage'], m['ratio']))
+
+def get_limit_arg(default, maximum=500):
+    """limitパラメータ（0または'all'で無制限）"""
+    value = request.args.get('limit', str(default))
+    if value == 'all' or value == '0':
+        return None
+    try:
+        return min(max(int(value), 1), maximum)
+    except ValueError:
+        return default
+
+def dashboard_counters(location_id=None, overview=None):
+    """ダッシュボード上部のカウンター類（overview は取得済みの material_stock_overview(location_id)）"""
+    from datetime import timedelta
+    
+    today = date.today()
+    week_later = today + timedelta(days=7)
+    pending = Reservation.query.filter(Reservation.executed == False)
+    if location_id:
+        pending = pending.filter(Reservation.location_id == location_id)
+    if overview is None:
+        overview = material_stock_overview(location_id=location_id)
+    return {
+        'total_materials': len(overview),
+        'low_stock_count': sum(1 for m in overview if m['critical_periods']),
+        'overdue_count': pending.filter(Reservation.scheduled_date < today).count(),
+        'week_reservations': pending.filter(
+            Reservation.scheduled_date >= today, Reservation.scheduled_date <= week_later
+        ).count()
+    }
+
+def recent_reservations(type_, limit, location_id=None):
+    """最近登録された予約（ダッシュボードのアクティビティ表示用）"""
+    from sqlalchemy.orm import joinedload
+    
+    query = Reservation.query.filter_by(type=type_)
+    if location_id:
+        query = query.filter(Reservation.location_id == location_id)
+    rows = query.options(
+        joinedload(Reservation.material), joinedload(Reservation.lot)
+    ).order_by(Reservation.date.desc()).limit(limit).all()
+    return [{
+        'material': r.material.name,
+        'lot': r.lot.lot_name if r.lot else '原料全体',
+        'quantity': r.quantity,
+        'date': r.date.strftime('%Y/%m/%d %H:%M') if r.date else 'N/A'
+    } for r in rows]
+
+def timeline_alert_material_ids(day=None):
+    """day（既定は今日）以降に予定在庫が最低量を下回るおそれのある原料のID（タイムラインで判定）
+
+    タイムラインは日中に取りうる最小値で判定するので、compute_critical_periods が
+    危機期間を持つ原料はすべて含まれる（含まれても危機期間がないことはある）。
+    """
+    day = day or date.today()
+    materials = db.session.query(RawMaterial.id, RawMaterial.data_version, RawMaterial.min_weight).all()
+    # 保持していないタイムライン（起動直後・キャッシュ破棄後）はまとめて構築する
+    lowest = stock_timeline_index.min_from_many({material_id: version for material_id, version, _ in materials}, day)
+    return [material_id for material_id, _, min_weight in materials if lowest[material_id][0] < (min_weight or 0.0)]
+
+def alert_entry(m, forecasts=None):
+    return {
+        'id': m['id'],
+        'name': m['name'],
+        'current': m['current'],
+        'predicted': m['predicted'],
+        'min_weight': m['min_weight'],
+        'unit': m['unit'],
+        'email': m['email'],
+        'excel_path': m['excel_path'],
+        'action_type': m['action_type'],
+        'shortage': m['shortage'],
+        'critical_periods': serialize_periods(m['critical_periods']),
+        'forecast': (forecasts or {}).get(m['id'])
+    }
+
+def chart_entry(m):
+    return {
+        'id': m['id'],
+        'name': m['name'],
+        'current': m['current'],
+        'predicted': m['predicted'],
+        'min_weight': m['min_weight'],
+        'unit': m['unit']
+    }
+
+# 消費予測（実行済み履歴からの需要推定）
+app.config.setdefault('FORECAST_HISTORY_DAYS', 90)
+app.config.setdefault('FORECAST_REFRESH_SECONDS', 15 * 60)
+_forecast_lock = threading.Lock()
+_forecast_state = {'generated_at': None, 'by_material': {}}
+
+def build_usage_matrix(history_days):
+    """日別ロールアップから (原料 × 日) の使用量行列を作る
+
+    ロットの直接編集・削除による在庫調整は需要ではないので、使用量から除く。
+    """
+    from datetime import timedelta
+    
+    end_day = date.today()
+    start_day = end_day - timedelta(days=history_days - 1)
+    material_ids = np.array([row[0] for row in db.session.query(RawMaterial.id).order_by(RawMaterial.id)], dtype=np.int64)
+    # 行数が多いためORMを通さずにドライバーから直接取得し、そのままNumPy配列にする
+    cursor = db.session.connection().connection.cursor()
+    try:
+        rows = cursor.execute(
+            'SELECT material_id, CAST(julianday(day) - julianday(?) AS INTEGER), used - adjusted '
+            'FROM daily_usage_rollup WHERE day >= ? AND day <= ?',
+            (start_day.isoformat(), start_day.isoformat(), end_day.isoformat())
+        ).fetchall()
+    finally:
+        cursor.close()
+    
+    usage = np.zeros((len(material_ids), history_days))
+    if rows and len(material_ids):
+        data = np.array(rows, dtype=float)
+        ids = data[:, 0].astype(np.int64)
+        offsets = data[:, 1].astype(np.int64)
+        positions = np.searchsorted(material_ids, ids)
+        valid = (positions < len(material_ids)) & (material_ids[np.minimum(positions, len(material_ids) - 1)] == ids)
+        np.add.at(usage, (positions[valid], offsets[valid]), data[valid, 2])
+    return material_ids, usage
+
+def refresh_forecasts():
+    """全原料の消費予測を再計算して保持する"""
+    from datetime import timedelta
+    
+    material_ids, usage = build_usage_matrix(app.config['FORECAST_HISTORY_DAYS'])
+    current = dict(db.session.query(Lot.material_id, db.func.sum(Lot.weight)).group_by(Lot.material_id).all())
+    stock = np.array([current.get(int(i)) or 0.0 for i in material_ids])
+    
+    rate, sigma, method = forecast.fit_demand(usage)
+    expected, early, late = forecast.days_until_depleted(stock, rate, sigma)
+    
+    today = date.today()
+    
+    def to_date(days):
+        return (today + timedelta(days=int(np.ceil(days)))).isoformat() if np.isfinite(days) else None
+    
+    by_material = {}
+    for i, material_id in enumerate(material_ids):
+        by_material[int(material_id)] = {
+            'method': str(method[i]),
+            'daily_rate': round(float(rate[i]), 3),
+            'daily_sigma': round(float(sigma[i]), 3),
+            'days_to_stockout': round(float(expected[i]), 1) if np.isfinite(expected[i]) else None,
+            'stockout_date': to_date(expected[i]),
+            'stockout_earliest': to_date(early[i]),
+            'stockout_latest': to_date(late[i])
+        }
+    with _forecast_lock:
+        _forecast_state['generated_at'] = datetime.now()
+        _forecast_state['by_material'] = by_material
+    return by_material
+
+def get_forecasts():
+    """保持している消費予測（未計算または古すぎる場合はその場で再計算）"""
+    with _forecast_lock:
+        generated_at = _forecast_state['generated_at']
+        by_material = _forecast_state['by_material']
+    max_age = app.config['FORECAST_REFRESH_SECONDS'] * 2
+    if generated_at is None or (datetime.now() - generated_at).total_seconds() > max_age:
+        by_material = refresh_forecasts()
+    return by_material
+
+_forecast_worker = None
+
+@app.before_request
+def start_forecast_worker():
+    """消費予測を定期的に再計算するバックグラウンドスレッドを起動（プロセスごとに1回）
+
+    リローダーの親プロセスなどリクエストを処理しないプロセスでは起動しない。
+    """
+    global _forecast_worker
+    if _forecast_worker is not None or app.testing:
+        return
+    
+    def run():
+        while True:
+            try:
+                with app.app_context():
+                    refresh_forecasts()
+            except Exception as e:
+                app.logger.warning(f'消費予測の更新に失敗しました: {e}')
+            time.sleep(app.config['FORECAST_REFRESH_SECONDS'])
+    
+    with _forecast_lock:
+        if _forecast_worker is None:
+            _forecast_worker = threading.Thread(target=run, name='forecast-worker', daemon=True)
+            _forecast_worker.start()
+
+# 在庫イベントの Webhook 通知（トランザクショナル・アウトボックス）
+#   在庫変更と同じコミットで outbox_event に書き込み、バックグラウンドの配信スレッドが
+#   署名付きの JSON をまとめて POST する。失敗時は指数バックオフで再送し、上限を超えたら dead にする。
+#   config.json の "webhooks": [{"url": ..., "secret": ..., "events": ["stock.below_minimum", ...]}] で設定。
+app.config.setdefault('WEBHOOK_ENDPOINTS', get_config().get('webhooks') or [])
+app.config.setdefault('WEBHOOK_BATCH_SIZE', 50)
+app.config.setdefault('WEBHOOK_MAX_ATTEMPTS', 8)
+app.config.setdefault('WEBHOOK_BACKOFF_SECONDS', 10)  # 再送間隔の初期値（失敗ごとに2倍、最大1時間）
+app.config.setdefault('WEBHOOK_POLL_SECONDS', 5)
+app.config.setdefault('WEBHOOK_TIMEOUT', 10)
+
+WEBHOOK_EVENT_TYPES = ('reservation.executed', 'stock.below_minimum', 'stock.recovered')
+
+class OutboxEvent(db.Model):
+    """配信待ちの Webhook イベント（配信先ごとに1行）"""
+    __tablename__ = 'outbox_event'
+    __table_args__ = (
+        db.Index('ix_outbox_event_pending', 'status', 'endpoint', 'next_attempt_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    endpoint = db.Column(db.String(500), nullable=False)  # 配信先URL
+    event_type = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    status = db.Column(db.String(20), nullable=False, default='pending')  # 'pending' / 'delivered' / 'dead'
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    delivered_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.String(500), nullable=True)
+
+    def __repr__(self):
+        return f'<OutboxEvent {self.event_type} {self.status}>'
+
+_outbox_wakeup = threading.Event()
+
+def webhook_endpoints(event_type=None):
+    """設定された配信先（event_type を購読しているものだけ）"""
+    endpoints = [e for e in app.config['WEBHOOK_ENDPOINTS'] if e.get('url')]
+    if event_type is None:
+        return endpoints
+    return [e for e in endpoints if event_type in e.get('events', WEBHOOK_EVENT_TYPES)]
+
+@event.listens_for(db.session, 'after_flush')
+def enqueue_stock_events(session, flush_context):
+    """予約の実行と最低量の上下を検知し、同じトランザクションで outbox_event に書き込む"""
+    if not webhook_endpoints():
+        return
+    
+    events = []
+    weight_deltas = {}
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Lot):
+            history = db.inspect(obj).attrs.weight.history
+            if obj in session.deleted:
+                delta = -(obj.weight or 0.0)
+            elif obj in session.new:
+                delta = obj.weight or 0.0
+            elif history.has_changes():
+                delta = sum(history.added or [0.0]) - sum(history.deleted or [0.0])
+            else:
+                continue
+            weight_deltas[obj.material_id] = weight_deltas.get(obj.material_id, 0.0) + delta
+        elif isinstance(obj, Reservation) and obj not in session.deleted and obj.executed:
+            history = db.inspect(obj).attrs.executed.history
+            if obj in session.new or (history.has_changes() and not any(history.deleted)):
+                # 読み込み済みの割当内訳だけを載せる（flush中に遅延ロードしない）
+                allocations = db.inspect(obj).dict.get('allocations') or []
+                events.append(('reservation.executed', {
+                    'reservation_id': obj.id,
+                    'material_id': obj.material_id,
+                    'type': obj.type,
+                    'quantity': obj.actual_quantity or obj.quantity,
+                    'lot_name': obj.lot_name,
+                    'location_id': obj.location_id,
+                    'user_name': obj.user_name,
+                    'executed_date': obj.executed_date.isoformat() if obj.executed_date else None,
+                    'allocations': [{'lot_name': a.lot_name, 'quantity': a.quantity} for a in allocations]
+                }))
+    
+    changed = {material_id: delta for material_id, delta in weight_deltas.items() if abs(delta) > 1e-9}
+    if changed:
+        connection = session.connection()
+        lot_table = Lot.__table__
+        material_table = RawMaterial.__table__
+        totals = dict(connection.execute(
+            db.select(lot_table.c.material_id, db.func.sum(lot_table.c.weight))
+            .where(lot_table.c.material_id.in_(list(changed))).group_by(lot_table.c.material_id)
+        ).all())
+        for material_id, name, unit, min_weight in connection.execute(
+            db.select(material_table.c.id, material_table.c.name, material_table.c.unit, material_table.c.min_weight)
+            .where(material_table.c.id.in_(list(changed)))
+        ):
+            current = totals.get(material_id) or 0.0
+            previous = current - changed[material_id]
+            min_weight = min_weight or 0.0
+            if previous >= min_weight > current:
+                event_type = 'stock.below_minimum'
+            elif previous < min_weight <= current:
+                event_type = 'stock.recovered'
+            else:
+                continue
+            events.append((event_type, {
+                'material_id': material_id, 'name': name, 'unit': unit,
+                'previous': round(previous, 3), 'current': round(current, 3), 'min_weight': min_weight
+            }))
+    
+    rows = []
+    now = datetime.now()
+    for event_type, payload in events:
+        body = json.dumps(payload, ensure_ascii=False)
+        for endpoint in webhook_endpoints(event_type):
+            rows.append({'endpoint': endpoint['url'], 'event_type': event_type, 'payload': body,
+                         'created_at': now, 'status': 'pending', 'attempts': 0, 'next_attempt_at': now})
+    if rows:
+        session.connection().execute(OutboxEvent.__table__.insert(), rows)
+        session.info['outbox_pending'] = True
+
+@event.listens_for(db.session, 'after_commit')
+def wake_webhook_dispatcher(session):
+    """コミットされたイベントをすぐ配信するよう配信スレッドを起こす（リクエストは待たない）"""
+    if session.info.pop('outbox_pending', False):
+        _outbox_wakeup.set()
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_outbox_flag(session):
+    session.info.pop('outbox_pending', None)
+
+def sign_webhook(secret, timestamp, body):
+    """署名 = HMAC-SHA256(secret, "<timestamp>.<本文>") の16進表記"""
+    import hashlib
+    import hmac
+    return hmac.new((secret or '').encode('utf-8'), timestamp.encode() + b'.' + body, hashlib.sha256).hexdigest()
+
+def deliver_webhook_batch(endpoint, events):
+    """イベントをまとめて1回の POST で送る（2xx 以外は例外）"""
+    import urllib.request
+    
+    body = json.dumps({'events': [
+        {'id': e.id, 'type': e.event_type, 'created_at': e.created_at.isoformat(), 'data': json.loads(e.payload)}
+        for e in events
+    ]}, ensure_ascii=False).encode('utf-8')
+    timestamp = str(int(time.time()))
+    req = urllib.request.Request(endpoint['url'], data=body, method='POST', headers={
+        'Content-Type': 'application/json',
+        'X-Webhook-Timestamp': timestamp,
+        'X-Webhook-Signature': 'sha256=' + sign_webhook(endpoint.get('secret'), timestamp, body)
+    })
+    with urllib.request.urlopen(req, timeout=app.config['WEBHOOK_TIMEOUT']) as response:
+        if not 200 <= response.status < 300:
+            raise RuntimeError(f'HTTP {response.status}')
+
+def dispatch_outbox_once():
+    """配信時刻を過ぎたイベントを配信先ごとに1バッチずつ送る。戻り値は状態ごとの件数"""
+    from datetime import timedelta
+    
+    summary = {'delivered': 0, 'retry': 0, 'dead': 0}
+    now = datetime.now()
+    for endpoint in webhook_endpoints():
+        events = OutboxEvent.query.filter(
+            OutboxEvent.status == 'pending',
+            OutboxEvent.endpoint == endpoint['url'],
+            OutboxEvent.next_attempt_at <= now
+        ).order_by(OutboxEvent.id).limit(app.config['WEBHOOK_BATCH_SIZE']).all()
+        if not events:
+            continue
+        try:
+            deliver_webhook_batch(endpoint, events)
+        except Exception as e:
+            for outbox_event in events:
+                outbox_event.attempts += 1
+                outbox_event.last_error = str(e)[:500]
+                if outbox_event.attempts >= app.config['WEBHOOK_MAX_ATTEMPTS']:
+                    outbox_event.status = 'dead'
+                    summary['dead'] += 1
+                else:
+                    delay = min(app.config['WEBHOOK_BACKOFF_SECONDS'] * 2 ** (outbox_event.attempts - 1), 3600)
+                    outbox_event.next_attempt_at = now + timedelta(seconds=delay)
+                    summary['retry'] += 1
+        else:
+            for outbox_event in events:
+                outbox_event.status = 'delivered'
+                outbox_event.delivered_at = now
+                outbox_event.last_error = None
+            summary['delivered'] += len(events)
+        db.session.commit()
+    return summary
+
+_webhook_dispatcher = None
+_webhook_dispatcher_lock = threading.Lock()
+
+@app.before_request
+def start_webhook_dispatcher():
+    """Webhook 配信スレッドを起動（配信先が設定されている場合のみ・プロセスごとに1回）"""
+    global _webhook_dispatcher
+    if _webhook_dispatcher is not None or app.testing or not webhook_endpoints():
+        return
+    
+    def run():
+        while True:
+            _outbox_wakeup.wait(app.config['WEBHOOK_POLL_SECONDS'])
+            _outbox_wakeup.clear()
+            try:
+                with app.app_context():
+                    # 1バッチより多く溜まっている場合は続けて送る
+                    while dispatch_outbox_once()['delivered'] >= app.config['WEBHOOK_BATCH_SIZE']:
+                        pass
+            except Exception as e:
+                app.logger.warning(f'Webhook の配信に失敗しました: {e}')
+    
+    with _webhook_dispatcher_lock:
+        if _webhook_dispatcher is None:
+            _webhook_dispatcher = threading.Thread(target=run, name='webhook-dispatcher', daemon=True)
+            _webhook_dispatcher.start()
+
+@app.route('/admin/outbox')
+def admin_outbox():
+    """Webhook 配信状況（状態ごとの件数と dead になったイベント）"""
+    counts = dict(db.session.query(OutboxEvent.status, db.func.count(OutboxEvent.id)).group_by(OutboxEvent.status).all())
+    dead = OutboxEvent.query.filter_by(status='dead').order_by(OutboxEvent.id.desc()).limit(50).all()
+    return jsonify({
+        'counts': counts,
+        'dead': [{'id': e.id, 'endpoint': e.endpoint, 'type': e.event_type, 'attempts': e.attempts,
+                  'last_error': e.last_error, 'created_at': e.created_at.isoformat()} for e in dead]
+    })
+
+@app.cli.command('dispatch-webhooks')
+def dispatch_webhooks_command():
+    """配信待ちの Webhook イベントを1回配信する"""
+    summary = dispatch_outbox_once()
+    print(f"✓ 配信 {summary['delivered']}件 / 再送待ち {summary['retry']}件 / dead {summary['dead']}件")
+
+@app.cli.command('webhook-redeliver')
+def webhook_redeliver_command():
+    """dead になったイベントを配信待ちに戻す"""
+    count = OutboxEvent.query.filter_by(status='dead').update(
+        {'status': 'pending', 'attempts': 0, 'next_attempt_at': datetime.now()})
+    db.session.commit()
+    print(f'✓ {count}件を配信待ちに戻しました')
+
+@app.cli.command('webhook-receiver')
+@click.option('--port', type=int, default=8765)
+@click.option('--secret', default='', help='署名の検証に使う secret')
+@click.option('--fail', is_flag=True, help='常に 500 を返す（再送・dead の確認用）')
+def webhook_receiver_command(port, secret, fail):
+    """動作確認用のローカル Webhook 受信サーバー（受信内容と署名の検証結果を表示）"""
+    import hmac
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            expected = 'sha256=' + sign_webhook(secret, self.headers.get('X-Webhook-Timestamp', ''), body)
+            valid = hmac.compare_digest(expected, self.headers.get('X-Webhook-Signature', ''))
+            for item in json.loads(body).get('events', []):
+                print(f"{'✓' if valid else '✗ 署名不一致'} #{item['id']} {item['type']} {json.dumps(item['data'], ensure_ascii=False)}")
+            self.send_response(500 if fail else 204)
+            self.end_headers()
+        
+        def log_message(self, format, *args):
+            pass
+    
+    print(f'Webhook 受信待ち: http://127.0.0.1:{port}/')
+    HTTPServer(('127.0.0.1', port), Handler).serve_forever()
+
+# 発注点・推奨発注量
+app.config.setdefault('REORDER_SERVICE_Z', 1.65)  # 欠品許容率 約5%
+app.config.setdefault('REORDER_COVER_DAYS', 30)
+app.config.setdefault('REORDER_DEFAULT_LEAD_DAYS', 7.0)
+
+def compute_reorder_plan():
+    """全原料の発注点・安全在庫・推奨発注量を一括計算する
+
+    需要のばらつきは日別ロールアップ、リードタイムは補充予約の登録日から
+    実行日までの日数（ロット操作で自動作成された予約は除く）から求める。
+    """
+    material_ids, usage = build_usage_matrix(app.config['FORECAST_HISTORY_DAYS'])
+    demand_mean, demand_std = forecast.demand_statistics(usage)
+    
+    history = executed_history()
+    lead_days = db.func.julianday(history.c.executed_date) - db.func.julianday(history.c.date)
+    lead_rows = db.session.query(
+        history.c.material_id,
+        db.func.avg(lead_days),
+        db.func.avg(lead_days * lead_days),
+        db.func.count(history.c.id)
+    ).filter(
+        history.c.type == 'replenish',
+        history.c.executed_date.isnot(None),
+        history.c.date.isnot(None),
+        db.or_(history.c.user_name.is_(None), history.c.user_name != 'システム')
+    ).group_by(history.c.material_id).all()
+    lead_stats = {row[0]: row[1:] for row in lead_rows}
+    
+    current = dict(db.session.query(Lot.material_id, db.func.sum(Lot.weight)).group_by(Lot.material_id).all())
+    pending = dict(db.session.query(
+        Reservation.material_id,
+        db.func.sum(db.case((Reservation.type == 'replenish', Reservation.quantity), else_=-Reservation.quantity))
+    ).filter(Reservation.executed == False).group_by(Reservation.material_id).all())
+    
+    default_lead = app.config['REORDER_DEFAULT_LEAD_DAYS']
+    lead_mean = np.full(len(material_ids), default_lead)
+    lead_std = np.zeros(len(material_ids))
+    lead_samples = np.zeros(len(material_ids), dtype=np.int64)
+    position = np.zeros(len(material_ids))
+    stock = np.zeros(len(material_ids))
+    for i, material_id in enumerate(material_ids.tolist()):
+        stock[i] = current.get(material_id) or 0.0
+        position[i] = stock[i] + (pending.get(material_id) or 0.0)
+        if material_id in lead_stats:
+            mean, mean_sq, count = lead_stats[material_id]
+            lead_mean[i] = max(mean, 0.0)
+            lead_std[i] = np.sqrt(max(mean_sq - mean * mean, 0.0))
+            lead_samples[i] = count
+    
+    safety_stock, reorder_point, order_quantity = forecast.reorder_policy(
+        demand_mean, demand_std, lead_mean, lead_std, position,
+        z=app.config['REORDER_SERVICE_Z'], cover_days=app.config['REORDER_COVER_DAYS']
+    )
+    
+    info = {row.id: row for row in db.session.query(
+        RawMaterial.id, RawMaterial.name, RawMaterial.unit, RawMaterial.min_weight, RawMaterial.email
+    )}
+    plan = []
+    for i, material_id in enumerate(material_ids.tolist()):
+        m = info[material_id]
+        plan.append({
+            'id': material_id,
+            'name': m.name,
+            'unit': m.unit,
+            'email': m.email,
+            'min_weight': m.min_weight,
+            'current': round(float(stock[i]), 2),
+            'position': round(float(position[i]), 2),
+            'daily_demand': round(float(demand_mean[i]), 3),
+            'daily_demand_std': round(float(demand_std[i]), 3),
+            'lead_time_days': round(float(lead_mean[i]), 1),
+            'lead_time_std': round(float(lead_std[i]), 1),
+            'lead_time_samples': int(lead_samples[i]),
+            'safety_stock': round(float(safety_stock[i]), 2),
+            'reorder_point': round(float(reorder_point[i]), 2),
+            'order_quantity': round(float(order_quantity[i]), 2)
+        })
+    return plan
 
-@app.route('/delete_reservation/<int:id>')
-def delete_reservation(id):
-    """予約削除"""
-    reservation = Reservation.query.get_or_404(id)
-    db.session.delete(reservation)
-    db.session.commit()
-    flash('予約を削除しました', 'success')
-    return redirect(url_for('reservations'))
+@app.route('/api/reorder')
+def api_reorder():
+    """発注点と推奨発注量（all=1 で発注不要の原料も含める）"""
+    plan = compute_reorder_plan()
+    if request.args.get('all') != '1':
+        plan = [p for p in plan if p['order_quantity'] > 0]
+    plan.sort(key=lambda p: -p['order_quantity'])
+    return jsonify({'total': len(plan), 'suggestions': plan})
 
-@app.route('/export')
-def export():
-    materials = RawMaterial.query.all()
+@app.route('/reorder/suggestions.csv')
+def reorder_suggestions_csv():
+    """購入提案リストをCSVでダウンロード"""
+    plan = [p for p in compute_reorder_plan() if p['order_quantity'] > 0]
+    plan.sort(key=lambda p: ((p['email'] or ''), p['name']))
     output = io.StringIO()
     writer = csv.writer(output)
-    writer.writerow(['ID', '名前', '現在重量', '単位', '最低量', '予測在庫'])
-    for material in materials:
-        current_weight = material.get_total_lot_weight()
-        predicted = material.get_predicted_stock()
-        writer.writerow([material.id, material.name, round(current_weight, 2), material.unit, material.min_weight, round(predicted, 2)])
-    output.seek(0)
-    # BOM付きUTF-8でエンコードして日本語文字化けを防止
+    writer.writerow(['ID', '名前', '購入担当者', '単位', '現在量', '在庫ポジション', '1日平均使用量',
+                     '平均リードタイム(日)', '安全在庫', '発注点', '現在の最低量', '推奨発注量'])
+    for p in plan:
+        writer.writerow([p['id'], p['name'], p['email'] or '', p['unit'], p['current'], p['position'],
+                         p['daily_demand'], p['lead_time_days'], p['safety_stock'], p['reorder_point'],
+                         p['min_weight'], p['order_quantity']])
     csv_data = '\ufeff' + output.getvalue()
     response = make_response(csv_data)
-    response.headers['Content-Disposition'] = 'attachment; filename=inventory.csv'
+    response.headers['Content-Disposition'] = f'attachment; filename=purchase_suggestions_{date.today().strftime("%Y%m%d")}.csv'
     response.headers['Content-type'] = 'text/csv; charset=utf-8-sig'
     return response
 
-@app.route('/send_alert_email/<int:id>', methods=['POST'])
-def send_alert_email(id):
-    """アラートメールを送信"""
-    material = RawMaterial.query.get_or_404(id)
-    
-    if not material.email:
-        flash('購入担当者のメールアドレスが登録されていません。', 'warning')
-        return redirect(url_for('index'))
-    
-    try:
-        # メール内容
-        current_weight = material.get_total_lot_weight()
-        predicted_stock = material.get_predicted_stock()
-        subject = f"【在庫アラート】{material.name}の補充が必要です"
-        body = f"""
-在庫管理システムからの自動通知
+# 発注書ワークブック（アラート中の全原料を購入担当者ごとにまとめる）
+NO_PURCHASER = '（担当者未登録）'
+PURCHASE_ORDER_COLUMNS = ['購入担当者', 'ID', '原料名', '単位', '現在量', '予測在庫', '最低量', '不足量',
+                          '推奨発注量', '不足開始日', '不足終了日', '期間中の最小在庫', '危機期間', '発注用エクセル']
 
-原料名: {material.name}
-現在量: {current_weight:.2f} {material.unit}
-最低量: {material.min_weight} {material.unit}
-予測在庫量: {predicted_stock:.2f} {material.unit}
+def purchase_order_alerts():
+    """アラート中の原料（全拠点）と、その集合を表すキー（原料ID・data_version・日付）"""
+    alerts = [m for m in material_stock_overview(None, None, timeline_alert_material_ids()) if m['critical_periods']]
+    key = (date.today(), tuple((m['id'], m['data_version']) for m in alerts))
+    return alerts, key
 
-予測在庫量が最低量を下回る見込みです。
-至急、補充の手配をお願いします。
+def purchase_order_rows(alerts):
+    """購入担当者ごと（担当者名順・原料名順）の発注書の行"""
+    order_quantities = {p['id']: p['order_quantity'] for p in compute_reorder_plan()}
+    rows = []
+    for m in sorted(alerts, key=lambda m: (m['email'] is None, m['email'] or '', m['name'])):
+        periods = serialize_periods(m['critical_periods'])
+        first = periods[0]
+        rows.append([
+            m['email'] or NO_PURCHASER, m['id'], m['name'], m['unit'], m['current'], m['predicted'],
+            m['min_weight'], m['shortage'],
+            round(max(m['shortage'], order_quantities.get(m['id']) or 0.0), 2),
+            first['start_date'] or '', first['end_date'] or '未定', round(min(p['min_stock'] for p in periods), 2),
+            ' / '.join(f"{p['start_date']}〜{p['end_date'] or '未定'}" for p in periods),
+            m['excel_path'] or ''
+        ])
+    return rows
 
-※このメールは在庫管理システムから自動送信されています。
-        """
-        
-        # 実際のメール送信（Gmail使用例）
-        # 注意: 本番環境では環境変数やconfigファイルで設定してください
-        sender_email = "your-email@gmail.com"  # 送信元メール
-        sender_password = "your-app-password"  # アプリパスワード
-        
-        msg = MIMEMultipart()
-        msg['From'] = sender_email
-        msg['To'] = material.email
-        msg['Subject'] = subject
-        msg.attach(MIMEText(body, 'plain', 'utf-8'))
-        
-        # Gmail SMTPサーバー経由で送信（実際の送信を有効にする場合はコメント解除）
-        # server = smtplib.SMTP('smtp.gmail.com', 587)
-        # server.starttls()
-        # server.login(sender_email, sender_password)
-        # server.send_message(msg)
-        # server.quit()
-        
-        # デモ用: 実際には送信せずにメッセージのみ表示
-        flash(f'アラートメールを {material.email} に送信しました（デモモード）', 'success')
-        
-    except Exception as e:
-        flash(f'メール送信に失敗しました: {str(e)}', 'danger')
+def purchase_order_csv(rows):
+    output = io.StringIO()
+    writer = csv.writer(output)
+    writer.writerow(PURCHASE_ORDER_COLUMNS)
+    writer.writerows(rows)
+    return ('\ufeff' + output.getvalue()).encode('utf-8')
+
+def purchase_order_xlsx(rows):
+    """xlsx を write-only（ストリーミング）モードで書き出す
+
+    先頭に全件の「一覧」シート、続けて購入担当者ごとのシートを作る。
+    """
+    workbook = optional_import('openpyxl').Workbook(write_only=True)
+    summary = workbook.create_sheet('一覧')
+    summary.append([f'発注書（{date.today().strftime("%Y-%m-%d")} 作成）'])
+    summary.append(PURCHASE_ORDER_COLUMNS)
+    for row in rows:
+        summary.append(row)
+
+    groups = OrderedDict()
+    for row in rows:
+        groups.setdefault(row[0], []).append(row)
+    used_titles = {'一覧'}
+    for purchaser, group in groups.items():
+        # シート名は31文字まで、[]:*?/\ は使えない
+        title = ''.join('_' if c in '[]:*?/\\' else c for c in purchaser)[:28]
+        base, n = title, 2
+        while title in used_titles:
+            title = f'{base[:25]}({n})'
+            n += 1
+        used_titles.add(title)
+        sheet = workbook.create_sheet(title)
+        sheet.append(['購入担当者', purchaser])
+        sheet.append(PURCHASE_ORDER_COLUMNS[1:])
+        for row in group:
+            sheet.append(row[1:])
+        sheet.append([])
+        sheet.append(['', '合計', '', '', '', '', round(sum(r[7] for r in group), 2), round(sum(r[8] for r in group), 2)])
+
+    output = io.BytesIO()
+    workbook.save(output)
+    return output.getvalue()
+
+class PurchaseOrderCache:
+    """生成済みの発注書（形式ごとに1件）。アラートの集合が変わるまで再利用する"""
+
+    def __init__(self):
+        self._entries = {}  # fmt -> (key, etag, data)
+        self._lock = threading.Lock()
+
+    def get(self, fmt, alerts, key):
+        with self._lock:
+            entry = self._entries.get(fmt)
+        if entry and entry[0] == key:
+            return entry[1], entry[2]
+        rows = purchase_order_rows(alerts)
+        data = purchase_order_xlsx(rows) if fmt == 'xlsx' else purchase_order_csv(rows)
+        import hashlib
+        etag = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        with self._lock:
+            self._entries[fmt] = (key, etag, data)
+        return etag, data
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+purchase_order_cache = PurchaseOrderCache()
+
+@app.route('/purchase_orders.<fmt>')
+def purchase_orders(fmt):
+    """アラート中の全原料の発注書をダウンロード（xlsx / csv）"""
+    if fmt not in ('xlsx', 'csv'):
+        return jsonify({'error': '形式は xlsx または csv です'}), 404
+    if fmt == 'xlsx' and optional_import('openpyxl') is None:
+        flash('xlsx の作成には openpyxl が必要です（CSVでダウンロードしてください）', 'warning')
+        return redirect(url_for('dashboard'))
+    alerts, key = purchase_order_alerts()
+    if not alerts:
+        flash('現在アラート中の原料はありません', 'info')
+        return redirect(url_for('dashboard'))
+    etag, data = purchase_order_cache.get(fmt, alerts, key)
+    mimetype = ('application/vnd.openxmlformats-officedocument.spreadsheetml.sheet' if fmt == 'xlsx'
+                else 'text/csv; charset=utf-8-sig')
+    return send_file(io.BytesIO(data), mimetype=mimetype, as_attachment=True, etag=etag,
+                     download_name=f'purchase_orders_{date.today().strftime("%Y%m%d")}.{fmt}',
+                     conditional=True, max_age=0)
+
+# 拠点別DBを ATTACH して集計する際の1回あたりの最大数（SQLiteの既定上限は10）
+SITE_ATTACH_BATCH = 8
+
+def group_stock_report():
+    """グループ全体の拠点別在庫を原料名ごとに集計する
+
+    config.json に "site_databases": {"拠点名": "DBファイルのパス", ...} がある場合は、
+    各拠点のDBファイルを読み取り専用で ATTACH して1本のクエリで集計する。
+    設定がない場合は、このDBのロットを拠点ごとに集計する。
+    """
+    site_databases = get_config().get('site_databases') or {}
+    rows = []
+    if site_databases:
+        items = list(site_databases.items())
+        conn = sqlite3.connect(':memory:', uri=True)
+        try:
+            for start in range(0, len(items), SITE_ATTACH_BATCH):
+                batch = items[start:start + SITE_ATTACH_BATCH]
+                selects = []
+                params = []
+                for i, (site, path) in enumerate(batch):
+                    uri = Path(os.path.abspath(path)).as_uri() + '?mode=ro'
+                    conn.execute(f'ATTACH DATABASE ? AS site{i}', (uri,))
+                    selects.append(
+                        f'SELECT ?, m.name, m.unit, COALESCE(SUM(l.weight), 0) '
+                        f'FROM site{i}.raw_material m LEFT JOIN site{i}.lot l ON l.material_id = m.id '
+                        f'GROUP BY m.id'
+                    )
+                    params.append(site)
+                try:
+                    rows.extend(conn.execute(' UNION ALL '.join(selects), params).fetchall())
+                finally:
+                    for i in range(len(batch)):
+                        conn.execute(f'DETACH DATABASE site{i}')
+        finally:
+            conn.close()
+        sites = [site for site, _ in items]
+    else:
+        query = db.session.query(
+            db.func.coalesce(Location.name, '拠点指定なし'), RawMaterial.name, RawMaterial.unit,
+            db.func.coalesce(db.func.sum(Lot.weight), 0)
+        ).select_from(Lot).join(RawMaterial, Lot.material_id == RawMaterial.id).outerjoin(
+            Location, Lot.location_id == Location.id
+        ).group_by(Lot.location_id, RawMaterial.id)
+        rows = query.all()
+        sites = sorted({row[0] for row in rows})
     
-    return redirect(url_for('index'))
+    materials = {}
+    for site, name, unit, weight in rows:
+        entry = materials.setdefault((name, unit), {'name': name, 'unit': unit, 'total': 0.0, 'sites': {}})
+        entry['sites'][site] = entry['sites'].get(site, 0.0) + weight
+        entry['total'] += weight
+    return {'sites': sites, 'materials': sorted(materials.values(), key=lambda m: m['name'])}
 
-@app.route('/dashboard')
-def dashboard():
-    return render_template('dashboard.html')
+@app.route('/api/reports/group_stock')
+def api_group_stock():
+    """拠点別在庫のグループ集計"""
+    try:
+        return jsonify(group_stock_report())
+    except sqlite3.Error as e:
+        return jsonify({'error': f'拠点DBの集計に失敗しました: {e}'}), 500
+
+@app.cli.command('group-stock-report')
+def group_stock_report_command():
+    """拠点別在庫のグループ集計をCSVで標準出力に書き出す"""
+    import sys
+    report = group_stock_report()
+    writer = csv.writer(sys.stdout)
+    writer.writerow(['名前', '単位'] + report['sites'] + ['合計'])
+    for m in report['materials']:
+        writer.writerow([m['name'], m['unit']] + [m['sites'].get(site, 0) for site in report['sites']] + [m['total']])
 
 @app.route('/api/stats')
+@read_only_route
 def api_stats():
-    materials = RawMaterial.query.all()
-    
-    # 総在庫数
-    total_materials = len(materials)
-    
-    # 低在庫アラート数（予測在庫で判定）
-    low_stock_count = sum(1 for m in materials if m.is_low_stock_alert())
-    
-    # アラート一覧
-    alert_materials = []
-    for material in materials:
-        if material.is_low_stock_alert():
-            total_weight = material.get_total_lot_weight()
-            predicted = material.get_predicted_stock()
-            critical_periods = material.get_critical_periods()
-            
-            # 日付をJSON互換形式に変換
-            serialized_periods = []
-            for period in critical_periods:
-                serialized_periods.append({
-                    'start_date': period['start_date'].isoformat() if period['start_date'] else None,
-                    'end_date': period['end_date'].isoformat() if period['end_date'] else None,
-                    'min_stock': round(period['min_stock'], 2),
-                    'shortage': round(period['shortage'], 2)
-                })
-            
-            alert_materials.append({
-                'id': material.id,
-                'name': material.name,
-                'current': round(total_weight, 2),
-                'predicted': round(predicted, 2),
-                'min_weight': material.min_weight,
-                'unit': material.unit,
-                'email': material.email,
-                'excel_path': material.excel_path,
-                'action_type': material.action_type,
-                'critical_periods': serialized_periods
-            })
+    """ダッシュボード全体の統計（互換用。ダッシュボード画面は /api/dashboard/* を使用）"""
+    overview = material_stock_overview()
+    counters = dashboard_counters(overview=overview)
+    return jsonify({
+        'total_materials': counters['total_materials'],
+        'low_stock_count': counters['low_stock_count'],
+        'alert_materials': [alert_entry(m) for m in overview if m['critical_periods']],
+        'materials': [chart_entry(m) for m in overview],
+        'use_reservations': recent_reservations('use', 5),
+        'replenish_reservations': recent_reservations('replenish', 5),
+        'overdue_count': counters['overdue_count'],
+        'week_reservations': counters['week_reservations']
+    })
+
+@app.route('/api/dashboard/counters')
+def api_dashboard_counters():
+    """カウンターと最近の予約"""
+    location_id = get_current_location_id()
+    counters = dashboard_counters(location_id)
+    limit = get_limit_arg(5, maximum=50) or 50
+    counters['use_reservations'] = recent_reservations('use', limit, location_id)
+    counters['replenish_reservations'] = recent_reservations('replenish', limit, location_id)
+    return jsonify(counters)
+
+@app.route('/api/dashboard/alerts')
+def api_dashboard_alerts():
+    """低在庫アラート一覧（不足量の大きい順、limit件まで）
+
+    全拠点表示ではタイムラインで最低量を下回る原料だけを先に絞り込み、
+    危機期間の計算はその原料に限る。
+    """
+    location_id = get_current_location_id()
+    candidates = None if location_id else timeline_alert_material_ids()
+    alerts = [m for m in material_stock_overview(request.args.get('q'), location_id, candidates) if m['critical_periods']]
+    alerts = sort_overview(alerts, request.args.get('sort', 'shortage'))
+    limit = get_limit_arg(50)
+    forecasts = get_forecasts()
+    return jsonify({
+        'total': len(alerts),
+        'alerts': [alert_entry(m, forecasts) for m in alerts[:limit]]
+    })
+
+@app.route('/api/dashboard/forecast')
+def api_dashboard_forecast():
+    """消費予測による欠品予測日（近い順）"""
+    horizon = request.args.get('horizon', 90, type=int)
+    limit = get_limit_arg(10)
+    forecasts = get_forecasts()
+    names = dict(db.session.query(RawMaterial.id, RawMaterial.name).all())
     
-    # 在庫状況データ
-    materials_data = []
-    for material in materials:
-        total_weight = material.get_total_lot_weight()
-        predicted_stock = material.get_predicted_stock()
-        materials_data.append({
-            'name': material.name,
-            'current': round(total_weight, 2),
-            'predicted': round(predicted_stock, 2),
-            'min_weight': material.min_weight,
-            'unit': material.unit
+    items = [
+        dict(forecast_, id=material_id, name=names.get(material_id))
+        for material_id, forecast_ in forecasts.items()
+        if forecast_['days_to_stockout'] is not None and forecast_['days_to_stockout'] <= horizon
+        and material_id in names
+    ]
+    items.sort(key=lambda f: f['days_to_stockout'])
+    with _forecast_lock:
+        generated_at = _forecast_state['generated_at']
+    return jsonify({
+        'generated_at': generated_at.isoformat(timespec='seconds') if generated_at else None,
+        'horizon_days': horizon,
+        'total': len(items),
+        'forecasts': items[:limit]
+    })
+
+@app.route('/api/dashboard/materials')
+def api_dashboard_materials():
+    """グラフ・在庫一覧用の原料データ（並び替え・状態で絞り込み・上位N件）"""
+    overview = material_stock_overview(request.args.get('q'), get_current_location_id())
+    status = request.args.get('status')
+    if status == 'low':
+        overview = [m for m in overview if m['ratio'] < 0.5]
+    elif status == 'warning':
+        overview = [m for m in overview if 0.5 <= m['ratio'] < 1]
+    elif status == 'ok':
+        overview = [m for m in overview if m['ratio'] >= 1]
+    elif status == 'alert':
+        overview = [m for m in overview if m['critical_periods']]
+    overview = sort_overview(overview, request.args.get('sort', 'shortage'))
+    limit = get_limit_arg(20)
+    if request.args.get('other') == '1':
+        # グラフ用: 上位 limit 件 + 残りを合計した「その他」
+        shown, other = downsample.top_n_with_other(overview, limit, ('current', 'predicted', 'min_weight'))
+        return jsonify({
+            'total': len(overview),
+            'materials': [chart_entry(m) for m in shown],
+            'other': other
         })
-    
-    # 予約情報の集計
-    use_reservations = Reservation.query.filter_by(type='use').order_by(Reservation.date.desc()).limit(5).all()
-    replenish_reservations = Reservation.query.filter_by(type='replenish').order_by(Reservation.date.desc()).limit(5).all()
-    
-    use_list = [{
-        'material': r.material.name,
-        'lot': r.lot.lot_name if r.lot else '原料全体',
-        'quantity': r.quantity,
-        'date': r.date.strftime('%Y/%m/%d %H:%M') if r.date else 'N/A'
-    } for r in use_reservations]
-    
-    replenish_list = [{
-        'material': r.material.name,
-        'lot': r.lot.lot_name if r.lot else '原料全体',
-        'quantity': r.quantity,
-        'date': r.date.strftime('%Y/%m/%d %H:%M') if r.date else 'N/A'
-    } for r in replenish_reservations]
-    
-    # 期限切れ予約数を計算
-    from datetime import date, timedelta
-    today = date.today()
-    all_reservations = Reservation.query.filter_by(executed=False).all()
-    overdue_count = sum(1 for r in all_reservations if r.scheduled_date and r.scheduled_date < today)
-    
-    # 今週（7日以内）の予約数を計算
-    week_later = today + timedelta(days=7)
-    week_reservations = sum(1 for r in all_reservations if r.scheduled_date and today <= r.scheduled_date <= week_later)
-    
     return jsonify({
-        'total_materials': total_materials,
-        'low_stock_count': low_stock_count,
-        'alert_materials': alert_materials,
-        'materials': materials_data,
-        'use_reservations': use_list,
-        'replenish_reservations': replenish_list,
-        'overdue_count': overdue_count,
-        'week_reservations': week_reservations
+        'total': len(overview),
+        'materials': [chart_entry(m) for m in overview[:limit]]
     })
 
+# 原料統計の期間: キー -> (日数, 最小の集計単位)
+STATS_PERIODS = {
+    '1d': (1, 'day'), '7d': (7, 'day'), '1m': (30, 'day'),
+    '3m': (90, 'day'), '6m': (180, 'week'), '1y': (365, 'month')
+}
+BUCKET_DAYS = {'day': 1, 'week': 7, 'month': 31}
+app.config.setdefault('CHART_MAX_POINTS', 60)
+
+def chart_bucket(period_days, minimum, points):
+    """棒の本数が points 以下になる最も細かい集計単位（minimum より細かくはしない）"""
+    buckets = ['day', 'week', 'month']
+    for bucket in buckets[buckets.index(minimum):]:
+        if period_days / BUCKET_DAYS[bucket] <= points:
+            return bucket
+    return 'month'
+
 @app.route('/api/material_stats/<int:id>')
+@read_only_route
 def api_material_stats(id):
     """原料の期間別統計データを取得"""
     material = RawMaterial.query.get_or_404(id)
+    points = min(max(request.args.get('points', app.config['CHART_MAX_POINTS'], type=int), 3), 1000)
+    periods = STATS_PERIODS
+    if request.args.get('period') in STATS_PERIODS:
+        periods = {request.args['period']: STATS_PERIODS[request.args['period']]}
     
-    # 各期間の統計を取得
-    stats = {
-        '1d': material.get_usage_stats(1),
-        '7d': material.get_usage_stats(7),
-        '1m': material.get_usage_stats(30),
-        '3m': material.get_usage_stats(90),
-        '6m': material.get_usage_stats(180),
-        '1y': material.get_usage_stats(365)
-    }
+    # 各期間の統計を取得（6ヶ月は週単位以上、1年は月単位。棒の本数が points を超えないよう粗くする）
+    stats = {}
+    for key, (days, bucket) in periods.items():
+        stats[key] = material.get_usage_stats(days, bucket=chart_bucket(days, bucket, points), points=points)
     
     return jsonify({
         'material_id': material.id,
@@ -995,7 +4366,674 @@ def api_material_stats(id):
         'stats': stats
     })
 
+@app.route('/api/search')
+def api_search():
+    """原料・ロット・レシピ名のインクリメンタル検索"""
+    query = request.args.get('q', '')
+    kinds = request.args.get('kind')
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = min(max(request.args.get('per_page', 10, type=int), 1), 50)
+    
+    rows = search_entries(
+        query,
+        kinds=kinds.split(',') if kinds else None,
+        limit=per_page + 1,
+        offset=(page - 1) * per_page
+    )
+    
+    results = []
+    for row in rows[:per_page]:
+        if row.kind == 'recipe':
+            url = url_for('edit_recipe', id=row.ref_id)
+        else:
+            url = url_for('lots', material_id=row.material_id)
+        results.append({
+            'kind': row.kind,
+            'id': row.ref_id,
+            'material_id': row.material_id,
+            'label': row.label,
+            'url': url
+        })
+    
+    return jsonify({
+        'query': query,
+        'page': page,
+        'per_page': per_page,
+        'has_next': len(rows) > per_page,
+        'results': results
+    })
+
 # Recipe Management Routes
+# 外部システム連携用 JSON API（/api/v1）
+#   認証: Authorization: Bearer <トークン>（`flask --app app create-api-token <名前>` で発行）
+#   一覧: ?limit=&cursor= のカーソルページング、?fields=id,name のように返す項目を選択
+#   作成・実行: JSON配列でまとめて送信（1件でも不正なら全件取り消し）、Idempotency-Key ヘッダーで再送を安全にする
+app.config.setdefault('API_MAX_BATCH', 500)
+app.config.setdefault('API_PAGE_SIZE', 100)
+app.config.setdefault('IDEMPOTENCY_TTL_HOURS', 24)
+
+class ApiToken(db.Model):
+    """APIトークン（平文は発行時にのみ表示し、SHA-256 ハッシュだけを保存）"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)  # 連携先の名前
+    token_hash = db.Column(db.String(64), nullable=False, unique=True)
+    date_created = db.Column(db.DateTime, default=db.func.current_timestamp())
+
+    def __repr__(self):
+        return f'<ApiToken {self.name}>'
+
+class IdempotencyRecord(db.Model):
+    """Idempotency-Key ごとの処理結果（同じキーの再送には保存した結果を返す）"""
+    __tablename__ = 'idempotency_record'
+    key = db.Column(db.String(200), primary_key=True)
+    token_id = db.Column(db.Integer, db.ForeignKey('api_token.id'), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)  # メソッド・パス・本文のハッシュ
+    status_code = db.Column(db.Integer, nullable=False)
+    response_body = db.Column(db.Text, nullable=False)
+    date_created = db.Column(db.DateTime, default=datetime.now, index=True)
+
+class ApiError(Exception):
+    """APIのエラー応答（index はバッチ内で問題のあった要素の位置）"""
+    def __init__(self, message, status=400, index=None):
+        super().__init__(message)
+        self.status = status
+        self.index = index
+
+@app.errorhandler(ApiError)
+def handle_api_error(error):
+    db.session.rollback()
+    body = {'error': str(error)}
+    if error.index is not None:
+        body['index'] = error.index
+    return jsonify(body), error.status
+
+def hash_token(token):
+    import hashlib
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+def api_token_required(view):
+    """Bearer トークンを検証するデコレーター（APIはCSRF対象外のため必須）"""
+    from functools import wraps
+    
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        header = request.headers.get('Authorization', '')
+        token = header[7:].strip() if header.startswith('Bearer ') else ''
+        api_token = ApiToken.query.filter_by(token_hash=hash_token(token)).first() if token else None
+        if api_token is None:
+            return jsonify({'error': 'APIトークンが無効です'}), 401
+        g.api_token = api_token
+        return view(*args, **kwargs)
+    return wrapper
+
+def claim_idempotency_key():
+    """処理中の Idempotency-Key の仮レコード（status_code 0）を現在のトランザクションに追加する
+
+    仮レコードは処理本体と同じコミットで保存されるので、同じキーの同時リクエストは
+    主キーの重複で止まり、処理は1回しか実行されない。ロールバックした後に処理を
+    やり直す場合（commit_with_retry）は呼び直す。
+    """
+    from sqlalchemy.exc import IntegrityError
+    claim = g.get('idempotency_claim') if has_app_context() else None
+    if claim is None:
+        return
+    key, token_id, request_hash = claim
+    db.session.add(IdempotencyRecord(key=key, token_id=token_id, request_hash=request_hash,
+                                     status_code=0, response_body=''))
+    try:
+        db.session.flush()
+    except IntegrityError:
+        db.session.rollback()
+        raise ApiError('この Idempotency-Key のリクエストは処理中です', 409)
+
+def idempotent(view):
+    """Idempotency-Key ヘッダー付きのリクエストは1回だけ処理し、再送には同じ結果を返す"""
+    from functools import wraps
+    from datetime import timedelta
+    from sqlalchemy.exc import IntegrityError
+    import hashlib
+    
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > 200:
+            raise ApiError('Idempotency-Key は200文字以内にしてください')
+        
+        request_hash = hashlib.sha256(
+            request.method.encode() + b' ' + request.path.encode() + b'\n' + request.get_data()
+        ).hexdigest()
+        record = db.session.get(IdempotencyRecord, (key, g.api_token.id))
+        expires = datetime.now() - timedelta(hours=app.config['IDEMPOTENCY_TTL_HOURS'])
+        if record is not None and record.date_created < expires:
+            db.session.delete(record)
+            db.session.commit()
+            record = None
+        if record is not None:
+            if record.request_hash != request_hash:
+                raise ApiError('この Idempotency-Key は別の内容のリクエストで使用済みです', 422)
+            if record.status_code == 0:
+                raise ApiError('この Idempotency-Key のリクエストは処理中です', 409)
+            response = app.response_class(record.response_body, status=record.status_code,
+                                          mimetype='application/json')
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+        
+        # 仮レコードを先に入れてから処理する（確認と実行の間に同じキーが割り込まない）
+        IdempotencyRecord.query.filter(IdempotencyRecord.date_created < expires).delete()
+        g.idempotency_claim = (key, g.api_token.id, request_hash)
+        try:
+            claim_idempotency_key()
+            response = make_response(view(*args, **kwargs))
+        finally:
+            g.pop('idempotency_claim', None)
+        record = db.session.get(IdempotencyRecord, (key, g.api_token.id))
+        if response.status_code >= 500:
+            # 再送で処理をやり直せるよう仮レコードを残さない
+            if record is not None:
+                db.session.delete(record)
+                db.session.commit()
+            return response
+        if record is None:
+            # 処理の途中でロールバックされて仮レコードが消えた
+            record = IdempotencyRecord(key=key, token_id=g.api_token.id, request_hash=request_hash)
+            db.session.add(record)
+        record.status_code = response.status_code
+        record.response_body = response.get_data(as_text=True)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # 同じキーの同時リクエスト（先に保存された方を正とする）
+            db.session.rollback()
+        return response
+    return wrapper
+
+def encode_cursor(last_id):
+    import base64
+    return base64.urlsafe_b64encode(json.dumps({'after': last_id}, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    import base64
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(padded))['after'])
+    except (ValueError, KeyError, TypeError):
+        raise ApiError('cursor が不正です')
+
+def paginate_by_id(query, model):
+    """ID順のカーソルページング（OFFSETを使わないので深いページでも一定の速さ）"""
+    limit = min(max(request.args.get('limit', app.config['API_PAGE_SIZE'], type=int), 1), 1000)
+    after = decode_cursor(request.args.get('cursor'))
+    if after is not None:
+        query = query.filter(model.id > after)
+    rows = query.order_by(model.id).limit(limit + 1).all()
+    next_cursor = encode_cursor(rows[limit - 1].id) if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def select_fields(item):
+    """?fields= で指定された項目だけを返す"""
+    fields = request.args.get('fields')
+    if not fields:
+        return item
+    wanted = {f.strip() for f in fields.split(',') if f.strip()}
+    return {k: v for k, v in item.items() if k in wanted}
+
+def api_list(items, next_cursor=None):
+    return jsonify({'data': [select_fields(item) for item in items], 'next_cursor': next_cursor})
+
+def batch_items():
+    """リクエスト本文をオブジェクトの配列として取り出す（単一オブジェクトも可）"""
+    payload = request.get_json(silent=True)
+    if isinstance(payload, dict):
+        payload = [payload]
+    if not isinstance(payload, list) or not payload or not all(isinstance(item, dict) for item in payload):
+        raise ApiError('本文にはJSONオブジェクトまたはその配列を指定してください')
+    if len(payload) > app.config['API_MAX_BATCH']:
+        raise ApiError(f'一度に送信できるのは{app.config["API_MAX_BATCH"]}件までです', 413)
+    return payload
+
+def item_value(item, key, index, kind=str, required=False, default=None):
+    """バッチ要素の値を型変換して取り出す（不正ならその要素の位置付きで 400）"""
+    value = item.get(key)
+    if isinstance(value, (dict, list)):
+        raise ApiError(f'{key} の値が不正です', index=index)
+    if value is None or value == '':
+        if required:
+            raise ApiError(f'{key} は必須です', index=index)
+        return default
+    try:
+        if kind is date:
+            return date.fromisoformat(value)
+        if kind is float:
+            value = float(value)
+            if value != value or value in (float('inf'), float('-inf')):
+                raise ValueError
+            return value
+        if kind is int:
+            if isinstance(value, bool) or int(value) != value:
+                raise ValueError
+            return int(value)
+        return str(value).strip()
+    except (TypeError, ValueError):
+        raise ApiError(f'{key} の値が不正です', index=index)
+
+def stock_by_material(material_ids):
+    """原料ごとの現在量と未実行予約の増減（1回ずつの集計クエリ）"""
+    current = dict(db.session.query(Lot.material_id, db.func.sum(Lot.weight)).filter(
+        Lot.material_id.in_(material_ids)).group_by(Lot.material_id).all())
+    pending = dict(db.session.query(
+        Reservation.material_id,
+        db.func.sum(db.case((Reservation.type == 'replenish', Reservation.quantity), else_=-Reservation.quantity))
+    ).filter(Reservation.executed == False, Reservation.material_id.in_(material_ids)).group_by(
+        Reservation.material_id).all())
+    return current, pending
+
+def serialize_material(material, current, pending):
+    stock = current.get(material.id) or 0.0
+    return {
+        'id': material.id,
+        'name': material.name,
+        'unit': material.unit,
+        'min_weight': material.min_weight,
+        'email': material.email,
+        'action_type': material.action_type,
+        'current': round(stock, 3),
+        'predicted': round(stock + (pending.get(material.id) or 0.0), 3),
+        'data_version': material.data_version
+    }
+
+def serialize_lot(lot):
+    return {
+        'id': lot.id,
+        'material_id': lot.material_id,
+        'lot_name': lot.lot_name,
+        'weight': round(lot.weight, 3),
+        'location_id': lot.location_id,
+        'expiry_date': lot.expiry_date.isoformat() if lot.expiry_date else None,
+        'version': lot.version
+    }
+
+def serialize_reservation(reservation):
+    return {
+        'id': reservation.id,
+        'material_id': reservation.material_id,
+        'type': reservation.type,
+        'quantity': reservation.quantity,
+        'actual_quantity': reservation.actual_quantity,
+        'lot_id': reservation.lot_id,
+        'lot_name': reservation.lot_name,
+        'recipe_id': reservation.recipe_id,
+        'location_id': reservation.location_id,
+        'user_name': reservation.user_name,
+        'purpose': reservation.purpose,
+        'scheduled_date': reservation.scheduled_date.isoformat() if reservation.scheduled_date else None,
+        'executed': bool(reservation.executed),
+        'executed_date': reservation.executed_date.isoformat() if reservation.executed_date else None,
+        'version': reservation.version
+    }
+
+def serialize_recipe(recipe):
+    return {
+        'id': recipe.id,
+        'name': recipe.name,
+        'description': recipe.description,
+        'items': [
+            {'material_id': item.material_id, 'quantity': item.quantity, 'lot_name': item.lot_name}
+            for item in recipe.items
+        ]
+    }
+
+def api_get_or_404(model, id):
+    obj = db.session.get(model, id)
+    if obj is None:
+        raise ApiError('見つかりません', 404)
+    return obj
+
+@app.route('/api/v1/materials')
+@csrf.exempt
+@api_token_required
+def api_v1_materials():
+    """原料一覧（?q= で検索）"""
+    query = RawMaterial.query
+    if request.args.get('q'):
+        query = query.filter(RawMaterial.id.in_(search_material_ids(request.args['q'])))
+    materials, next_cursor = paginate_by_id(query, RawMaterial)
+    current, pending = stock_by_material([m.id for m in materials])
+    return api_list([serialize_material(m, current, pending) for m in materials], next_cursor)
+
+@app.route('/api/v1/materials/<int:id>')
+@csrf.exempt
+@api_token_required
+def api_v1_material(id):
+    material = api_get_or_404(RawMaterial, id)
+    current, pending = stock_by_material([id])
+    return jsonify(select_fields(serialize_material(material, current, pending)))
+
+@app.route('/api/v1/materials', methods=['POST'])
+@csrf.exempt
+@api_token_required
+@idempotent
+def api_v1_create_materials():
+    """原料の一括登録"""
+    materials = []
+    for index, item in enumerate(batch_items()):
+        action_type = item_value(item, 'action_type', index, default='none')
+        if action_type not in ('email', 'excel', 'none'):
+            raise ApiError('action_type は email / excel / none のいずれかです', index=index)
+        materials.append(RawMaterial(
+            name=item_value(item, 'name', index, required=True),
+            weight=0.0,
+            unit='g',  # g固定
+            min_weight=item_value(item, 'min_weight', index, float, default=0.0),
+            email=item_value(item, 'email', index),
+            excel_path=item_value(item, 'excel_path', index),
+            action_type=action_type
+        ))
+    db.session.add_all(materials)
+    db.session.commit()
+    current, pending = stock_by_material([m.id for m in materials])
+    return jsonify({'data': [serialize_material(m, current, pending) for m in materials]}), 201
+
+@app.route('/api/v1/lots')
+@csrf.exempt
+@api_token_required
+def api_v1_lots():
+    """ロット一覧（?material_id= / ?location_id= で絞り込み）"""
+    query = Lot.query
+    for column in ('material_id', 'location_id'):
+        value = request.args.get(column, type=int)
+        if value:
+            query = query.filter(getattr(Lot, column) == value)
+    lots, next_cursor = paginate_by_id(query, Lot)
+    return api_list([serialize_lot(lot) for lot in lots], next_cursor)
+
+@app.route('/api/v1/lots', methods=['POST'])
+@csrf.exempt
+@api_token_required
+@idempotent
+def api_v1_create_lots():
+    """ロットの一括登録（画面からのロット追加と同じく補充として記録）"""
+    items = batch_items()
+    material_ids = {id for (id,) in db.session.query(RawMaterial.id)}
+    lots = []
+    for index, item in enumerate(items):
+        material_id = item_value(item, 'material_id', index, int, required=True)
+        if material_id not in material_ids:
+            raise ApiError('material_id の原料が見つかりません', index=index)
+        weight = item_value(item, 'weight', index, float, required=True)
+        if weight < 0:
+            raise ApiError('weight は0以上にしてください', index=index)
+        lots.append(create_lot(
+            material_id,
+            item_value(item, 'lot_name', index, required=True),
+            weight,
+            location_id=item_value(item, 'location_id', index, int),
+            expiry_date=item_value(item, 'expiry_date', index, date)
+        ))
+    db.session.commit()
+    return jsonify({'data': [serialize_lot(lot) for lot in lots]}), 201
+
+@app.route('/api/v1/reservations')
+@csrf.exempt
+@api_token_required
+def api_v1_reservations():
+    """予約一覧（?status=pending|executed, ?type=, ?material_id= で絞り込み）"""
+    query = Reservation.query
+    status = request.args.get('status')
+    if status in ('pending', 'executed'):
+        query = query.filter(Reservation.executed == (status == 'executed'))
+    if request.args.get('type'):
+        query = query.filter(Reservation.type == request.args['type'])
+    if request.args.get('material_id', type=int):
+        query = query.filter(Reservation.material_id == request.args.get('material_id', type=int))
+    reservations, next_cursor = paginate_by_id(query, Reservation)
+    return api_list([serialize_reservation(r) for r in reservations], next_cursor)
+
+@app.route('/api/v1/reservations', methods=['POST'])
+@csrf.exempt
+@api_token_required
+@idempotent
+def api_v1_create_reservations():
+    """使用・補充予約の一括登録"""
+    items = batch_items()
+    material_ids = {id for (id,) in db.session.query(RawMaterial.id)}
+    reservations = []
+    for index, item in enumerate(items):
+        material_id = item_value(item, 'material_id', index, int, required=True)
+        if material_id not in material_ids:
+            raise ApiError('material_id の原料が見つかりません', index=index)
+        type_ = item_value(item, 'type', index, required=True)
+        if type_ not in ('use', 'replenish'):
+            raise ApiError('type は use / replenish のいずれかです', index=index)
+        quantity = item_value(item, 'quantity', index, float, required=True)
+        if quantity <= 0:
+            raise ApiError('quantity は0より大きくしてください', index=index)
+        lot_id = item_value(item, 'lot_id', index, int)
+        if lot_id is not None:
+            lot = db.session.get(Lot, lot_id)
+            if lot is None or lot.material_id != material_id:
+                raise ApiError('lot_id のロットが見つかりません', index=index)
+        reservations.append(Reservation(
+            material_id=material_id,
+            type=type_,
+            quantity=quantity,
+            lot_id=lot_id,
+            lot_name=item_value(item, 'lot_name', index),
+            user_name=item_value(item, 'user_name', index),
+            purpose=item_value(item, 'purpose', index),
+            scheduled_date=item_value(item, 'scheduled_date', index, date),
+            location_id=item_value(item, 'location_id', index, int)
+        ))
+    db.session.add_all(reservations)
+    db.session.commit()
+    return jsonify({'data': [serialize_reservation(r) for r in reservations]}), 201
+
+@app.route('/api/v1/reservations/execute', methods=['POST'])
+@csrf.exempt
+@api_token_required
+@idempotent
+def api_v1_execute_reservations():
+    """予約の一括実行（使用予約はロットを自動割当。1件でも実行できなければ全件取り消し）
+
+    要素: {"id": 予約ID, "quantity": 実際の量（省略時は予約量）, "lot_id": 優先ロット, "lot_name": 補充先ロット名}
+    """
+    items = batch_items()
+    requests_ = [(index, item_value(item, 'id', index, int, required=True), item) for index, item in enumerate(items)]
+    
+    def run():
+        results = []
+        for index, reservation_id, item in requests_:
+            reservation = db.session.get(Reservation, reservation_id)
+            if reservation is None:
+                raise ApiError('予約が見つかりません', 404, index)
+            if reservation.executed:
+                results.append({'id': reservation.id, 'status': 'already_executed'})
+                continue
+            quantity = item_value(item, 'quantity', index, float, default=reservation.quantity)
+            if quantity <= 0:
+                raise ApiError('quantity は0より大きくしてください', index=index)
+            try:
+                if reservation.type == 'use':
+                    split = execute_use_reservation(reservation, quantity,
+                                                    item_value(item, 'lot_id', index, int, default=reservation.lot_id))
+                    allocations = [{'lot_id': lot.id, 'lot_name': lot.lot_name, 'quantity': take} for lot, take in split]
+                else:
+                    lot = execute_replenish_reservation(reservation, quantity, item_value(item, 'lot_name', index))
+                    allocations = [{'lot_id': lot.id, 'lot_name': lot.lot_name, 'quantity': quantity}]
+            except ExecutionError as e:
+                raise ApiError(str(e), 409, index)
+            results.append({'id': reservation.id, 'status': 'executed', 'allocations': allocations})
+        db.session.flush()
+        return results
+    
+    return jsonify({'data': commit_with_retry(run)})
+
+@app.route('/api/v1/recipes')
+@csrf.exempt
+@api_token_required
+def api_v1_recipes():
+    from sqlalchemy.orm import selectinload
+    recipes, next_cursor = paginate_by_id(Recipe.query.options(selectinload(Recipe.items)), Recipe)
+    return api_list([serialize_recipe(recipe) for recipe in recipes], next_cursor)
+
+@app.route('/api/v1/recipes/<int:id>')
+@csrf.exempt
+@api_token_required
+def api_v1_recipe(id):
+    return jsonify(select_fields(serialize_recipe(api_get_or_404(Recipe, id))))
+
+@app.route('/api/v1/recipes/<int:id>/reservations', methods=['POST'])
+@csrf.exempt
+@api_token_required
+@idempotent
+def api_v1_reserve_recipe(id):
+    """レシピから使用予約を作成（配列で複数回分をまとめて登録可）
+
+    要素: {"user_name", "purpose", "scheduled_date", "location_id", "multiplier": 倍率（省略時1）}
+    """
+    recipe = api_get_or_404(Recipe, id)
+    reservations = []
+    for index, item in enumerate(batch_items()):
+        multiplier = item_value(item, 'multiplier', index, float, default=1.0)
+        if multiplier <= 0:
+            raise ApiError('multiplier は0より大きくしてください', index=index)
+        for recipe_item in recipe.items:
+            reservations.append(Reservation(
+                material_id=recipe_item.material_id,
+                recipe_id=recipe.id,
+                lot_name=recipe_item.lot_name,
+                type='use',
+                quantity=recipe_item.quantity * multiplier,
+                user_name=item_value(item, 'user_name', index),
+                purpose=item_value(item, 'purpose', index),
+                scheduled_date=item_value(item, 'scheduled_date', index, date),
+                location_id=item_value(item, 'location_id', index, int)
+            ))
+    db.session.add_all(reservations)
+    db.session.commit()
+    return jsonify({'data': [serialize_reservation(r) for r in reservations]}), 201
+
+def simulate_plan(items, location_id=None):
+    """仮の予約・レシピ実行を現在の予約に重ね、影響する原料の危機期間を計算する（DBには書き込まない）
+
+    要素は {"material_id", "type": "use"|"replenish", "quantity", "scheduled_date"} または
+    {"recipe_id", "scheduled_date", "multiplier"}。scheduled_date を省略した場合は今日とする。
+    """
+    hypothetical = []
+    recipe_ids = set()
+    for index, item in enumerate(items):
+        scheduled = item_value(item, 'scheduled_date', index, date, default=date.today())
+        if item.get('recipe_id') is not None:
+            multiplier = item_value(item, 'multiplier', index, float, default=1.0)
+            if multiplier <= 0:
+                raise ApiError('multiplier は0より大きくしてください', index=index)
+            recipe_id = item_value(item, 'recipe_id', index, int)
+            recipe_ids.add(recipe_id)
+            hypothetical.append((index, ('recipe', recipe_id), scheduled, multiplier))
+        else:
+            material_id = item_value(item, 'material_id', index, int, required=True)
+            type_ = item_value(item, 'type', index, default='use')
+            if type_ not in ('use', 'replenish'):
+                raise ApiError('type は use / replenish のいずれかです', index=index)
+            quantity = item_value(item, 'quantity', index, float, required=True)
+            if quantity <= 0:
+                raise ApiError('quantity は0より大きくしてください', index=index)
+            hypothetical.append((index, ('material', material_id, type_), scheduled, quantity))
+    
+    recipe_items = {}
+    for recipe_id, material_id, quantity in db.session.query(
+        RecipeItem.recipe_id, RecipeItem.material_id, RecipeItem.quantity
+    ).filter(RecipeItem.recipe_id.in_(recipe_ids)):
+        recipe_items.setdefault(recipe_id, []).append((material_id, quantity))
+    
+    # 仮の予約を原料ごとの (予定日, 種類, 量) に展開
+    added = {}
+    for index, target, scheduled, amount in hypothetical:
+        if target[0] == 'recipe':
+            if target[1] not in recipe_items:
+                raise ApiError('recipe_id のレシピが見つかりません', index=index)
+            for material_id, quantity in recipe_items[target[1]]:
+                added.setdefault(material_id, []).append((scheduled, 'use', quantity * amount))
+        else:
+            added.setdefault(target[1], []).append((scheduled, target[2], amount))
+    
+    materials = {m.id: m for m in db.session.query(
+        RawMaterial.id, RawMaterial.name, RawMaterial.unit, RawMaterial.min_weight
+    ).filter(RawMaterial.id.in_(list(added)))}
+    missing = set(added) - set(materials)
+    if missing:
+        raise ApiError(f'原料が見つかりません: {sorted(missing)}', 404)
+    
+    lot_query = db.session.query(Lot.material_id, db.func.sum(Lot.weight)).filter(Lot.material_id.in_(list(added)))
+    pending_query = db.session.query(
+        Reservation.material_id, Reservation.scheduled_date, Reservation.type, Reservation.quantity
+    ).filter(Reservation.executed == False, Reservation.material_id.in_(list(added)))
+    if location_id:
+        lot_query = lot_query.filter(Lot.location_id == location_id)
+        pending_query = pending_query.filter(Reservation.location_id == location_id)
+    current = dict(lot_query.group_by(Lot.material_id).all())
+    pending = {}
+    for material_id, scheduled, type_, quantity in pending_query.order_by(Reservation.scheduled_date, Reservation.id):
+        pending.setdefault(material_id, []).append((scheduled, type_, quantity))
+    
+    def net(rows):
+        return sum(q if t == 'replenish' else -q for _, t, q in rows if t in ('use', 'replenish'))
+    
+    results = []
+    for material_id, extra in added.items():
+        m = materials[material_id]
+        stock = current.get(material_id) or 0.0
+        existing = pending.get(material_id, [])
+        dated = [r for r in existing if r[0]]
+        # 同じ日付では既存の予約を先に適用する（sorted は安定ソート）
+        simulated = sorted(dated + extra, key=lambda r: r[0])
+        before = compute_critical_periods(stock, m.min_weight, dated)
+        after = compute_critical_periods(stock, m.min_weight, simulated)
+        results.append({
+            'material_id': material_id,
+            'name': m.name,
+            'unit': m.unit,
+            'min_weight': m.min_weight,
+            'current': round(stock, 2),
+            'predicted_before': round(stock + net(existing), 2),
+            'predicted_after': round(stock + net(existing) + net(extra), 2),
+            'critical_periods_before': serialize_periods(before),
+            'critical_periods': serialize_periods(after),
+            'becomes_critical': bool(after) and not before,
+            'first_shortage_date': after[0]['start_date'].isoformat() if after and after[0]['start_date'] else None
+        })
+    results.sort(key=lambda r: (not r['critical_periods'], r['first_shortage_date'] or '', r['name']))
+    return results
+
+@app.route('/api/simulate', methods=['POST'])
+def api_simulate():
+    """画面からの what-if シミュレーション（X-CSRFToken ヘッダーが必要・選択中の拠点で計算）"""
+    return jsonify({'materials': simulate_plan(batch_items(), get_current_location_id())})
+
+@app.route('/api/v1/simulate', methods=['POST'])
+@csrf.exempt
+@api_token_required
+def api_v1_simulate():
+    """外部連携用の what-if シミュレーション（?location_id= で拠点を指定）"""
+    return jsonify({'materials': simulate_plan(batch_items(), request.args.get('location_id', type=int))})
+
+@app.cli.command('create-api-token')
+@click.argument('name')
+def create_api_token_command(name):
+    """外部連携用のAPIトークンを発行する（トークンはこの1回だけ表示）"""
+    import secrets
+    db.create_all()
+    if ApiToken.query.filter_by(name=name).first():
+        print(f'エラー: 「{name}」のトークンは既に存在します')
+        return
+    token = secrets.token_urlsafe(32)
+    db.session.add(ApiToken(name=name, token_hash=hash_token(token)))
+    db.session.commit()
+    print(f'✓ APIトークンを発行しました（{name}）: {token}')
+
 @app.route('/recipes')
 def recipes():
     recipes = Recipe.query.order_by(Recipe.date_created.desc()).all()
@@ -1114,8 +5152,8 @@ def use_recipe(recipe_id):
 # Backup Management Routes
 def get_backup_folder():
     """バックアップフォルダのパスを取得"""
-    config = load_config()
-    if 'database_folder' in config:
+    config = get_config()
+    if config.get('database_folder'):
         return os.path.join(config['database_folder'], 'backups')
     return 'backups'
 
@@ -1153,6 +5191,8 @@ def backup_management():
 @app.route('/backup/create', methods=['POST'])
 def create_backup():
     """新規バックアップを作成"""
+    import shutil
+    
     try:
         ensure_backup_folder()
         timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -1171,9 +5211,24 @@ def create_backup():
     
     return redirect(url_for('backup_management'))
 
+def reset_caches():
+    """データベースを丸ごと差し替えた後に、プロセス内のキャッシュをすべて破棄する
+
+    復元したDBの data_version は古い値に戻るため、以後の更新で同じバージョンに
+    なったときに別の内容のキャッシュを返さないようにする。
+    """
+    global _search_index_ready
+    material_row_cache.clear()
+    stock_timeline_index.clear()
+    stock_memo.clear()
+    purchase_order_cache.clear()
+    _search_index_ready = None
+
 @app.route('/backup/restore/<filename>', methods=['POST'])
 def restore_backup(filename):
     """バックアップから復元"""
+    import shutil
+    
     try:
         backup_folder = get_backup_folder()
         backup_path = os.path.join(backup_folder, filename)
@@ -1190,7 +5245,9 @@ def restore_backup(filename):
             shutil.copy2(db_path, safety_backup)
         
         # バックアップから復元
+        db.session.remove()
         shutil.copy2(backup_path, db_path)
+        reset_caches()
         flash(f'バックアップから復元しました: {filename}', 'success')
     except Exception as e:
         flash(f'復元に失敗しました: {str(e)}', 'danger')
@@ -1263,8 +5320,8 @@ def open_excel(id):
 @app.route('/settings')
 def settings():
     """設定画面"""
-    config = load_config()
-    current_db_folder = config.get('database_folder', 'デフォルト（instance）')
+    config = get_config()
+    current_db_folder = config.get('database_folder') or 'デフォルト（instance）'
     current_db_path = app.config['SQLALCHEMY_DATABASE_URI'].replace('sqlite:///', '')
     
     return render_template('settings.html', 
@@ -1275,7 +5332,7 @@ def settings():
 def change_database_folder():
     """データベースフォルダを変更"""
     try:
-        from tkinter import Tk, filedialog, messagebox
+        from tkinter import Tk, filedialog
         
         root = Tk()
         root.withdraw()
@@ -1301,7 +5358,54 @@ def change_database_folder():
     
     return redirect(url_for('settings'))
 
-if __name__ == '__main__':
+@app.cli.command('precompile-templates')
+def precompile_templates_command():
+    """全テンプレートを事前にコンパイルしてバイトコードキャッシュに保存する"""
+    names = precompile_templates()
+    click.echo(f'{len(names)}件のテンプレートをコンパイルしました（キャッシュ: {app.config["JINJA_CACHE_DIR"] or "なし"}）')
+
+# 配布版（PyInstaller）の起動設定
+app.config.setdefault('SERVER_HOST', '127.0.0.1')
+app.config.setdefault('SERVER_PORT', 5000)
+app.config.setdefault('OPEN_BROWSER', True)
+
+def run_desktop():
+    """配布版向けの起動（デバッグ・自動リロードなし）
+
+    待ち受けを開始したら「READY <URL>」を出力してスプラッシュを閉じ、ブラウザを開く。
+    テンプレートのコンパイルは待ち受け開始後にバックグラウンドで済ませる。
+    """
+    from werkzeug.serving import make_server
+    
     with app.app_context():
         db.create_all()
-    app.run(debug=True)
+        ensure_search_index()
+    host, port = app.config['SERVER_HOST'], app.config['SERVER_PORT']
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=precompile_templates, name='template-warmup', daemon=True).start()
+    
+    url = f'http://{host}:{port}/'
+    print(f'READY {url}', flush=True)
+    try:
+        import pyi_splash  # PyInstaller のスプラッシュ画面（spec で有効にした場合のみ存在）
+        pyi_splash.close()
+    except ImportError:
+        pass
+    if app.config['OPEN_BROWSER']:
+        import webbrowser
+        webbrowser.open(url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    import sys
+    
+    if getattr(sys, 'frozen', False) or '--desktop' in sys.argv:
+        run_desktop()
+    else:
+        with app.app_context():
+            db.create_all()
+            ensure_search_index()
+        app.run(debug=True)
@@ -5,12 +5,19 @@
 1. PyInstallerをインストール: pip install pyinstaller
 2. このスクリプトを実行: python build_exe.py
 3. distフォルダ内に実行ファイルが作成されます
+
+オプション:
+  --onedir          1ファイルにまとめず、フォルダ形式でビルドする（起動時の展開が不要で速い）
+  --benchmark [N]   onefile / onedir の両方をビルドし、起動時間をN回ずつ計測して比較する
+
+splash.png があれば、起動中にスプラッシュ画面を表示する（起動完了時に閉じる）。
 """
 
 import os
 import subprocess
 import sys
 import shutil
+import time
 
 def install_pyinstaller():
     """PyInstallerをインストール"""
@@ -45,9 +52,9 @@ def clean_build_folders():
         os.remove('app.spec')
         print("✓ app.spec を削除しました")
 
-def create_spec_file():
-    """PyInstaller用の.specファイルを作成"""
-    print("\n.specファイルを作成しています...")
+def create_spec_file(layout='onefile'):
+    """PyInstaller用の.specファイルを作成（layout: 'onefile' / 'onedir'）"""
+    print(f"\n.specファイルを作成しています...（{layout}）")
     
     # アイコンファイルの検索
     icon_path = None
@@ -63,6 +70,11 @@ def create_spec_file():
     # iconパラメータの設定
     icon_param = f"'{icon_path}'" if icon_path else "None"
     
+    # スプラッシュ画面（画像があるときだけ）
+    use_splash = os.path.exists('splash.png')
+    if use_splash:
+        print("✓ スプラッシュ画像を検出: splash.png")
+    
     spec_content = """# -*- mode: python ; coding: utf-8 -*-
 
 block_cipher = None
@@ -83,6 +95,9 @@ a = Analysis(
         'email.mime.text',
         'email.mime.multipart',
         'tkinter',
+        # optional_import() で遅延読み込みするため静的解析では検出されない
+        'openpyxl',
+        'pyarrow',
     ],
     hookspath=[],
     hooksconfig={},
@@ -95,14 +110,11 @@ a = Analysis(
 )
 
 pyz = PYZ(a.pure, a.zipped_data, cipher=block_cipher)
-
+SPLASH_DEFINITION
 exe = EXE(
     pyz,
     a.scripts,
-    a.binaries,
-    a.zipfiles,
-    a.datas,
-    [],
+EXE_CONTENTS
     name='在庫管理システム',
     debug=False,
     bootloader_ignore_signals=False,
@@ -118,17 +130,54 @@ exe = EXE(
     entitlements_file=None,
     icon=ICON_PATH,  # アイコンファイルがあれば指定
 )
+COLLECT_DEFINITION"""
+    
+    splash_definition = ''
+    splash_items = ''
+    if use_splash:
+        splash_definition = """
+splash = Splash(
+    'splash.png',
+    binaries=a.binaries,
+    datas=a.datas,
+    text_pos=(10, 20),
+    text_size=10,
+    text_default='起動中...',
+)
 """
+        splash_items = "    splash,\n" + ("    splash.binaries,\n" if layout == 'onefile' else '')
+    
+    if layout == 'onedir':
+        # 実行ファイルには本体だけを入れ、ライブラリは同じフォルダに並べる（起動時の展開なし）
+        exe_contents = splash_items + "    [],\n    exclude_binaries=True,"
+        collect_definition = """
+coll = COLLECT(
+    exe,
+    a.binaries,
+    a.zipfiles,
+    a.datas,
+SPLASH_BINARIES    strip=False,
+    upx=True,
+    upx_exclude=[],
+    name='在庫管理システム',
+)
+""".replace('SPLASH_BINARIES', "    splash.binaries,\n" if use_splash else '')
+    else:
+        exe_contents = "    a.binaries,\n    a.zipfiles,\n    a.datas,\n" + splash_items + "    [],"
+        collect_definition = ''
     
-    # icon_paramを実際の値に置き換え
-    spec_content = spec_content.replace('ICON_PATH', icon_param)
+    # プレースホルダーを実際の値に置き換え
+    spec_content = (spec_content.replace('ICON_PATH', icon_param)
+                    .replace('SPLASH_DEFINITION', splash_definition)
+                    .replace('EXE_CONTENTS', exe_contents)
+                    .replace('COLLECT_DEFINITION', collect_definition))
     
     with open('app.spec', 'w', encoding='utf-8') as f:
         f.write(spec_content)
     
     print("✓ app.spec を作成しました")
 
-def build_exe():
+def build_exe(distpath='dist'):
     """PyInstallerで実行ファイルをビルド"""
     print("\n実行ファイルをビルドしています...")
     print("（数分かかる場合があります）\n")
@@ -137,7 +186,8 @@ def build_exe():
         subprocess.check_call([
             sys.executable, "-m", "PyInstaller",
             "app.spec",
-            "--clean"
+            "--clean",
+            "--distpath", distpath
         ])
         print("\n✓ ビルド完了！")
         return True
@@ -189,7 +239,77 @@ def create_readme():
             f.write(readme_content)
         print(f"✓ {readme_path} を作成しました")
 
-def main():
+def free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def measure_startup(command, runs):
+    """起動から最初のページ（/）が返るまでの秒数を runs 回計測する
+
+    毎回新しい空のデータベースフォルダとポートを使い、ブラウザは開かない。
+    1回目はテンプレートのバイトコードキャッシュも空の状態（コールドスタート）。
+    """
+    import tempfile
+    import urllib.request
+    
+    timings = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for _ in range(runs):
+            with tempfile.TemporaryDirectory() as db_dir:
+                port = free_port()
+                env = dict(os.environ, ZAIKO_DATABASE_FOLDER=db_dir, ZAIKO_SERVER_PORT=str(port),
+                           ZAIKO_OPEN_BROWSER='false', ZAIKO_JINJA_CACHE_DIR=cache_dir)
+                started = time.perf_counter()
+                process = subprocess.Popen(command, env=env, cwd=db_dir,
+                                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                try:
+                    while True:
+                        if process.poll() is not None:
+                            raise RuntimeError(f"起動に失敗しました（終了コード {process.returncode}）: {command}")
+                        if time.perf_counter() - started > 120:
+                            raise RuntimeError(f"120秒以内に起動しませんでした: {command}")
+                        try:
+                            with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1) as response:
+                                if response.status == 200:
+                                    break
+                        except OSError:
+                            time.sleep(0.05)
+                    timings.append(time.perf_counter() - started)
+                finally:
+                    process.terminate()
+                    process.wait()
+    return timings
+
+def print_benchmark(results):
+    print("\n" + "=" * 60)
+    print("起動時間（起動 → 最初のページ表示まで）")
+    print("=" * 60)
+    print(f"{'形式':<10}{'初回':>10}{'2回目以降（中央値）':>20}{'最小':>10}{'最大':>10}")
+    for name, timings in results.items():
+        warm = sorted(timings[1:]) or timings
+        median = warm[len(warm) // 2]
+        print(f"{name:<10}{timings[0]:>9.2f}s{median:>19.2f}s{min(timings):>9.2f}s{max(timings):>9.2f}s")
+
+def benchmark(runs=5):
+    """onefile / onedir をそれぞれビルドして起動時間を比較する（参考としてソース実行も計測）"""
+    exe_name = '在庫管理システム' + ('.exe' if sys.platform == 'win32' else '')
+    results = {'source': measure_startup([sys.executable, os.path.abspath('app.py'), '--desktop'], runs)}
+    for layout in ('onefile', 'onedir'):
+        create_spec_file(layout)
+        distpath = os.path.join('dist', layout)
+        if not build_exe(distpath):
+            print(f"\n{layout} のビルドに失敗したため計測をスキップします")
+            continue
+        if layout == 'onefile':
+            exe_path = os.path.join(distpath, exe_name)
+        else:
+            exe_path = os.path.join(distpath, '在庫管理システム', exe_name)
+        results[layout] = measure_startup([os.path.abspath(exe_path)], runs)
+    print_benchmark(results)
+
+def main(layout='onefile'):
     print("=" * 60)
     print("在庫管理システム - 実行ファイルビルドツール")
     print("=" * 60)
@@ -212,7 +332,7 @@ def main():
     clean_build_folders()
     
     # .specファイル作成
-    create_spec_file()
+    create_spec_file(layout)
     
     # ビルド実行
     if build_exe():
@@ -239,8 +359,13 @@ def main():
         print("3. templates と static フォルダが存在するか確認")
 
 if __name__ == '__main__':
+    if '--benchmark' in sys.argv:
+        position = sys.argv.index('--benchmark')
+        runs = int(sys.argv[position + 1]) if len(sys.argv) > position + 1 else 5
+        benchmark(runs)
+        sys.exit(0)
     try:
-        main()
+        main('onedir' if '--onedir' in sys.argv else 'onefile')
         input("\nEnterキーを押して終了...")
     except KeyboardInterrupt:
         print("\n\nビルドをキャンセルしました")
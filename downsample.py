@@ -0,0 +1,62 @@
+"""グラフ用の間引き - 長い時系列や多数の原料をグラフに渡す前に点数を抑える
+
+折れ線は LTTB（Largest-Triangle-Three-Buckets）で形を保ったまま点を選び、
+棒グラフは上位N件と「その他」にまとめる。
+"""
+import numpy as np
+
+
+def lttb_indices(y, threshold):
+    """LTTB で残す点の位置（昇順）を返す
+
+    x は等間隔（0, 1, 2, ...）とみなす。先頭と末尾は必ず残し、間を threshold-2 個の
+    区間に分けて、各区間から「前に選んだ点」と「次の区間の平均」とで作る三角形の
+    面積が最大になる点を1つずつ選ぶ。
+    """
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    threshold = max(int(threshold), 3)
+    if threshold >= n:
+        return np.arange(n)
+
+    x = np.arange(n, dtype=float)
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    selected = np.empty(threshold, dtype=int)
+    selected[0] = 0
+    selected[-1] = n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        start, end = edges[i], max(edges[i + 1], edges[i] + 1)
+        next_start, next_end = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        next_x = x[next_start:max(next_end, next_start + 1)].mean()
+        next_y = y[next_start:max(next_end, next_start + 1)].mean()
+        area = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        previous = start + int(np.argmax(area))
+        selected[i + 1] = previous
+    return selected
+
+
+def downsample_series(labels, series, points):
+    """共通のラベルを持つ複数の折れ線を points 点程度に間引く
+
+    各系列で LTTB が選んだ位置の和集合を使うので、どの系列の山・谷も残る
+    （点数は最大で系列数 × points）。戻り値は (labels, {名前: 値のリスト})。
+    """
+    if not points or len(labels) <= points:
+        return list(labels), {name: list(values) for name, values in series.items()}
+    keep = np.unique(np.concatenate([lttb_indices(values, points) for values in series.values()]))
+    return ([labels[i] for i in keep],
+            {name: [values[i] for i in keep] for name, values in series.items()})
+
+
+def top_n_with_other(items, n, fields):
+    """先頭 n 件と、残りを fields について合計した「その他」（残りがなければ None）"""
+    if not n or len(items) <= n:
+        return items, None
+    rest = items[n:]
+    other = {field: round(sum(item[field] or 0.0 for item in rest), 2) for field in fields}
+    other['count'] = len(rest)
+    return items[:n], other
@@ -0,0 +1,120 @@
+"""消費予測エンジン - 実行済みの入出庫履歴から原料ごとの需要を推定し、欠品予測日を求める
+
+全原料をまとめて NumPy 配列で計算する（原料ごとのループは行わない）。
+入力は (原料数 × 日数) の日別使用量行列で、列は古い日から新しい日の順。
+"""
+import numpy as np
+
+# 信頼区間（約80%）に使う正規分布の分位点
+Z_80 = 1.2816
+
+
+def moving_average_forecasts(usage, window):
+    """移動平均による1期先予測（各日の予測 = 直前window日の平均）
+
+    戻り値は usage と同じ形の配列。先頭列は履歴がないため0。
+    """
+    n_days = usage.shape[1]
+    cumsum = np.concatenate([np.zeros((usage.shape[0], 1)), np.cumsum(usage, axis=1)], axis=1)
+    end = np.arange(n_days)
+    start = np.maximum(end - window, 0)
+    counts = np.maximum(end - start, 1)
+    return (cumsum[:, end] - cumsum[:, start]) / counts
+
+
+def exponential_smoothing_forecasts(usage, alpha):
+    """単純指数平滑による1期先予測（日ごとに全原料をまとめて更新）"""
+    forecasts = np.zeros_like(usage)
+    level = usage[:, 0].copy()
+    for t in range(1, usage.shape[1]):
+        forecasts[:, t] = level
+        level = alpha * usage[:, t] + (1 - alpha) * level
+    return forecasts, level
+
+
+def fit_demand(usage, window=28, alpha=0.3, evaluation_days=28):
+    """移動平均と指数平滑のうち、直近の1期先誤差が小さい方を原料ごとに採用する
+
+    戻り値:
+        rate   -- 1日あたりの予測使用量
+        sigma  -- 1日あたり使用量の予測誤差の標準偏差
+        method -- 採用したモデル名の配列（'moving_average' / 'exponential_smoothing'）
+    """
+    usage = np.asarray(usage, dtype=float)
+    n_materials, n_days = usage.shape
+    if n_materials == 0 or n_days == 0:
+        empty = np.zeros(n_materials)
+        return empty, empty, np.array([], dtype=object)
+
+    ma_forecasts = moving_average_forecasts(usage, window)
+    ma_rate = usage[:, -window:].mean(axis=1)
+    ses_forecasts, ses_rate = exponential_smoothing_forecasts(usage, alpha)
+
+    tail = slice(max(n_days - evaluation_days, 1), n_days)
+    ma_errors = usage[:, tail] - ma_forecasts[:, tail]
+    ses_errors = usage[:, tail] - ses_forecasts[:, tail]
+    use_ses = np.abs(ses_errors).mean(axis=1) < np.abs(ma_errors).mean(axis=1)
+
+    rate = np.where(use_ses, ses_rate, ma_rate)
+    errors = np.where(use_ses[:, None], ses_errors, ma_errors)
+    sigma = np.sqrt((errors ** 2).mean(axis=1)) if errors.shape[1] else np.zeros(n_materials)
+    method = np.where(use_ses, 'exponential_smoothing', 'moving_average')
+    return rate, sigma, method
+
+
+def days_until_depleted(stock, rate, sigma, z=Z_80):
+    """在庫が0になるまでの日数（中央値と信頼区間）
+
+    累積使用量を平均 rate*t、分散 sigma^2*t の正規分布とみなし、
+    rate*t ± z*sigma*sqrt(t) = stock を sqrt(t) について解く。
+    使用実績がない原料や在庫が0以下の原料は、それぞれ inf / 0 を返す。
+    """
+    stock = np.asarray(stock, dtype=float)
+    rate = np.asarray(rate, dtype=float)
+    sigma = np.asarray(sigma, dtype=float)
+    positive = stock > 0
+    consuming = rate > 1e-9
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        expected = np.where(consuming, stock / rate, np.inf)
+        discriminant = np.sqrt((z * sigma) ** 2 + 4 * rate * stock)
+        early = np.where(consuming, ((-z * sigma + discriminant) / (2 * rate)) ** 2, np.inf)
+        late = np.where(consuming, ((z * sigma + discriminant) / (2 * rate)) ** 2, np.inf)
+
+    expected = np.where(positive, expected, 0.0)
+    early = np.where(positive, early, 0.0)
+    late = np.where(positive, late, 0.0)
+    return expected, early, late
+
+
+def demand_statistics(usage):
+    """日別使用量行列から原料ごとの1日平均使用量と標準偏差を求める"""
+    usage = np.asarray(usage, dtype=float)
+    if usage.shape[1] < 2:
+        return usage.mean(axis=1) if usage.shape[1] else np.zeros(usage.shape[0]), np.zeros(usage.shape[0])
+    return usage.mean(axis=1), usage.std(axis=1, ddof=1)
+
+
+def reorder_policy(demand_mean, demand_std, lead_mean, lead_std, position, z=1.65, cover_days=30):
+    """発注点・安全在庫・推奨発注量を全原料まとめて計算する
+
+    安全在庫 = z * sqrt(L * σd^2 + d^2 * σL^2)（需要とリードタイムの両方のばらつきを考慮）
+    発注点   = d * L + 安全在庫
+    在庫ポジション（現在量 + 補充予定 - 使用予定）が発注点以下になったら、
+    発注点 + cover_days 日分の需要まで戻す量を推奨発注量とする。
+    """
+    demand_mean = np.asarray(demand_mean, dtype=float)
+    demand_std = np.asarray(demand_std, dtype=float)
+    lead_mean = np.asarray(lead_mean, dtype=float)
+    lead_std = np.asarray(lead_std, dtype=float)
+    position = np.asarray(position, dtype=float)
+
+    safety_stock = z * np.sqrt(lead_mean * demand_std ** 2 + demand_mean ** 2 * lead_std ** 2)
+    reorder_point = demand_mean * lead_mean + safety_stock
+    target = reorder_point + demand_mean * cover_days
+    order_quantity = np.where(
+        (position <= reorder_point) & (demand_mean > 0),
+        np.maximum(target - position, 0.0),
+        0.0
+    )
+    return safety_stock, reorder_point, order_quantity
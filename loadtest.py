@@ -0,0 +1,441 @@
+"""
+在庫管理システムの負荷テスト（ネットワーク不要・ローカルのみ）
+
+アプリを一時フォルダのデータベースで起動し、N人の仮想オペレーターが
+ダッシュボードの定期更新・使用予約・予約の実行・レシピからの使用予約と一括実行・
+ロット編集を混ぜて同時に操作する。始業時のように全員が一斉に操作を始める状況を再現し、
+スループット・レイテンシの分位点・エラー・SQLite のロック待ちを表示する。
+
+使い方:
+  python loadtest.py --users 20 --duration 60
+
+設定やコードのバージョンを比較する例:
+  python loadtest.py --set SQLITE_PRAGMAS='{"journal_mode": "wal", "busy_timeout": 5000}' --json wal.json
+  python loadtest.py --app-dir ../zaiko-old --json old.json
+
+主なオプション:
+  --users N          仮想オペレーターの人数（既定 10）
+  --duration SEC     計測時間（既定 30秒）
+  --ramp-up SEC      全員が操作を始めるまでの時間（既定 0 = 一斉に開始）
+  --think-ms MS      操作の間の平均待ち時間（指数分布、既定 500）
+  --database PATH    既存の inventory.db（バックアップなど）をコピーして使う
+  --app-dir PATH     別のフォルダの app.py を起動する（コードのバージョン比較用）
+  --set KEY=VALUE    config.json の settings を上書きする（環境変数 ZAIKO_KEY として渡す）
+  --url URL          起動済みのサーバーに対して実行する（起動・初期データ作成を行わない）
+  --json PATH        結果を JSON で保存する
+
+ロックエラー・ロック待ちはアプリの /admin/db_stats の前後の差分。
+この画面がない古いバージョンでは、サーバーのログの「database is locked」の件数だけを数える。
+"""
+
+import argparse
+import http.cookiejar
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+# 操作ごとの比率（重み）
+OPERATOR_MIX = {
+    'dashboard': 45,         # ダッシュボードの定期更新（カウンター・アラート・原料グラフ）
+    'reserve_use': 15,       # 使用予約の登録
+    'execute': 15,           # 自分の予約（個別またはレシピの一括）を実行
+    'use_recipe': 8,         # レシピから使用予約を作成
+    'edit_lot': 7,           # ロットの重量を直接編集
+    'browse': 10,            # 原料一覧・予約一覧を開く
+}
+
+DASHBOARD_URLS = ('/api/dashboard/counters', '/api/dashboard/alerts', '/api/dashboard/materials')
+PERCENTILES = (50, 90, 95, 99)
+
+CSRF_PATTERN = re.compile(r'name="csrf_token"[^>]*value="([^"]+)"')
+
+def free_port():
+    import socket
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+class Client:
+    """1人分のブラウザ（Cookie とCSRFトークンを保持し、リダイレクトをたどる）"""
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        self.csrf_token = None
+
+    def request(self, path, data=None):
+        """(ステータス, 本文)。4xx/5xx も例外にせずステータスで返す"""
+        body = None
+        if data is not None:
+            if self.csrf_token:
+                data = dict(data, csrf_token=self.csrf_token)
+            body = urllib.parse.urlencode(data, doseq=True).encode()
+        try:
+            with self.opener.open(self.base_url + path, body, timeout=self.timeout) as response:
+                return response.status, response.read().decode('utf-8', 'replace')
+        except urllib.error.HTTPError as e:
+            return e.code, e.read().decode('utf-8', 'replace')
+
+    def login(self):
+        """フォームのページから CSRF トークンを取得する（セッションごとに1回）"""
+        status, html = self.request('/add')
+        match = CSRF_PATTERN.search(html)
+        if status != 200 or not match:
+            raise RuntimeError(f'CSRFトークンを取得できません（/add: {status}）')
+        self.csrf_token = match.group(1)
+
+def find_ids(html, pattern):
+    return sorted({int(value) for value in re.findall(pattern, html)})
+
+def discover(client):
+    """画面から原料・ロット・レシピのIDを集める"""
+    _, html = client.request('/')
+    material_ids = find_ids(html, r'/lots/(\d+)"')
+    lots = {}
+    for material_id in material_ids:
+        _, html = client.request(f'/lots/{material_id}')
+        lots[material_id] = find_ids(html, r'/edit_lot/(\d+)"')
+    _, html = client.request('/recipes')
+    recipe_ids = find_ids(html, r'/use_recipe/(\d+)"')
+    return {'materials': material_ids, 'lots': lots, 'recipes': recipe_ids}
+
+def seed(client, materials, lots_per_material, recipes, rng):
+    """空のデータベースに原料・ロット・レシピを登録する（画面と同じフォーム送信で）"""
+    print(f'初期データを作成中: 原料 {materials}件 × ロット {lots_per_material}件、レシピ {recipes}件')
+    for i in range(materials):
+        client.request('/add', {'name': f'負荷試験原料{i + 1:03d}', 'weight': 0, 'min_weight': rng.choice([0, 500, 5000]),
+                                'action_type': 'none', 'email': '', 'excel_path': ''})
+    material_ids = discover(client)['materials']
+    for material_id in material_ids:
+        for j in range(lots_per_material):
+            client.request(f'/add_lot/{material_id}', {'lot_name': f'LT{material_id}-{j + 1}',
+                                                      'weight': rng.randint(50000, 200000), 'location_id': 0})
+    for i in range(recipes):
+        items = rng.sample(material_ids, min(len(material_ids), rng.randint(2, 4)))
+        data = {'name': f'負荷試験レシピ{i + 1}', 'description': ''}
+        data.update({f'material_{material_id}_quantity': rng.randint(5, 50) for material_id in items})
+        client.request('/add_recipe', data)
+
+class Recorder:
+    """操作ごとのレイテンシと結果（スレッドセーフ）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}  # 操作名 -> [秒, ...]
+        self.requests = 0
+        self.errors = {}  # 種類 -> 件数
+        self.error_examples = []
+
+    def record(self, operation, seconds, requests):
+        with self._lock:
+            self.samples.setdefault(operation, []).append(seconds)
+            self.requests += requests
+
+    def error(self, kind, detail):
+        with self._lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+            if len(self.error_examples) < 10:
+                self.error_examples.append(f'{kind}: {detail}')
+
+class VirtualUser(threading.Thread):
+    """OPERATOR_MIX の比率で操作を選び、think_ms の間隔で繰り返す仮想オペレーター"""
+
+    def __init__(self, number, base_url, ids, recorder, start_at, stop_at, think_ms, rng_seed):
+        super().__init__(name=f'vu{number}', daemon=True)
+        self.user_name = f'vu{number}'
+        self.client = Client(base_url)
+        self.ids = ids
+        self.recorder = recorder
+        self.start_at = start_at
+        self.stop_at = stop_at
+        self.think_ms = think_ms
+        self.rng = random.Random(rng_seed)
+
+    def call(self, path, data=None):
+        """1リクエスト送信し、5xx・409 はエラーとして記録する"""
+        status, html = self.client.request(path, data)
+        if status >= 500:
+            self.recorder.error(f'HTTP {status}', path)
+        elif status == 409:
+            self.recorder.error('HTTP 409（競合）', path)
+        return status, html
+
+    def op_dashboard(self):
+        for path in DASHBOARD_URLS:
+            self.call(path)
+        return len(DASHBOARD_URLS)
+
+    def op_browse(self):
+        self.call(self.rng.choice(['/', f'/reservations?user_name={self.user_name}', '/dashboard']))
+        return 1
+
+    def op_reserve_use(self):
+        material_id = self.rng.choice(self.ids['materials'])
+        self.call(f'/reserve_use/{material_id}', {
+            'lot_id': 0, 'lot_name': '', 'quantity': self.rng.randint(1, 100), 'user_name': self.user_name,
+            'purpose': '負荷試験', 'scheduled_date': '', 'location_id': 0
+        })
+        return 1
+
+    def op_use_recipe(self):
+        if not self.ids['recipes']:
+            return self.op_reserve_use()
+        self.call(f'/use_recipe/{self.rng.choice(self.ids["recipes"])}',
+                  {'user_name': self.user_name, 'purpose': '負荷試験', 'scheduled_date': ''})
+        return 1
+
+    def op_execute(self):
+        """予約一覧（自分の予約に絞り込み）を開き、1件（またはレシピ1つ分）を実行する"""
+        _, html = self.call(f'/reservations?user_name={self.user_name}')
+        reservations = find_ids(html, r'/execute_reservation/(\d+)"')
+        recipes = find_ids(html, r'/execute_recipe/(\d+)"')
+        if recipes and (not reservations or self.rng.random() < 0.3):
+            self.call(f'/execute_recipe/{self.rng.choice(recipes)}', {})
+            return 2
+        if reservations:
+            self.call(f'/execute_reservation/{self.rng.choice(reservations)}', {'actual_quantity': self.rng.randint(1, 100)})
+            return 2
+        return 1
+
+    def op_edit_lot(self):
+        """ロット編集画面を開き、重量を増やして保存する（在庫切れで実行が失敗し続けないように）"""
+        lots = [lot_id for lot_ids in self.ids['lots'].values() for lot_id in lot_ids]
+        if not lots:
+            return self.op_dashboard()
+        lot_id = self.rng.choice(lots)
+        status, html = self.call(f'/edit_lot/{lot_id}')
+        if status != 200:
+            return 1
+        def field(name):
+            match = re.search(rf'name="{name}"[^>]*value="([^"]*)"', html)
+            return match.group(1) if match else ''
+        weight = float(field('weight') or 0) + self.rng.randint(100, 1000)
+        self.call(f'/edit_lot/{lot_id}', {'lot_name': field('lot_name'), 'weight': weight, 'expiry_date': field('expiry_date'),
+                                          'version': field('version'), 'location_id': 0})
+        return 2
+
+    def run(self):
+        operations = list(OPERATOR_MIX)
+        weights = [OPERATOR_MIX[name] for name in operations]
+        time.sleep(max(self.start_at - time.perf_counter(), 0))
+        try:
+            self.client.login()
+        except Exception as e:
+            self.recorder.error('ログイン失敗', str(e))
+            return
+        while time.perf_counter() < self.stop_at:
+            operation = self.rng.choices(operations, weights)[0]
+            started = time.perf_counter()
+            try:
+                requests = getattr(self, f'op_{operation}')()
+            except Exception as e:
+                self.recorder.error(type(e).__name__, f'{operation}: {e}')
+                continue
+            self.recorder.record(operation, time.perf_counter() - started, requests)
+            if self.think_ms:
+                time.sleep(min(self.rng.expovariate(1000 / self.think_ms), self.think_ms * 10 / 1000))
+
+def start_server(app_dir, db_dir, settings):
+    """app.py --desktop を起動し、応答するまで待つ（戻り値は (プロセス, URL, ログのパス)）"""
+    port = free_port()
+    env = dict(os.environ, ZAIKO_DATABASE_FOLDER=db_dir, ZAIKO_SERVER_PORT=str(port), ZAIKO_OPEN_BROWSER='false')
+    for key, value in settings.items():
+        env[f'ZAIKO_{key}'] = value
+    log_path = os.path.join(db_dir, 'server.log')
+    log = open(log_path, 'w', encoding='utf-8')
+    process = subprocess.Popen([sys.executable, os.path.join(app_dir, 'app.py'), '--desktop'],
+                               env=env, cwd=db_dir, stdout=log, stderr=subprocess.STDOUT)
+    log.close()
+    url = f'http://127.0.0.1:{port}'
+    started = time.perf_counter()
+    while True:
+        if process.poll() is not None:
+            raise RuntimeError(f'サーバーの起動に失敗しました（終了コード {process.returncode}、ログ: {log_path}）')
+        if time.perf_counter() - started > 120:
+            process.terminate()
+            raise RuntimeError(f'120秒以内にサーバーが起動しませんでした（ログ: {log_path}）')
+        try:
+            with urllib.request.urlopen(url + '/', timeout=1):
+                return process, url, log_path
+        except OSError:
+            time.sleep(0.1)
+
+def server_db_stats(url):
+    """アプリの /admin/db_stats（ない場合は None）"""
+    try:
+        with urllib.request.urlopen(url + '/admin/db_stats', timeout=10) as response:
+            return json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+
+def percentile(values, p):
+    ordered = sorted(values)
+    if not ordered:
+        return None
+    index = min(int(round(p / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+def summarize(recorder, elapsed, before, after, log_lock_errors):
+    """結果を集計する（レイテンシはミリ秒）"""
+    def latency(values):
+        summary = {f'p{p}': round(percentile(values, p) * 1000, 1) for p in PERCENTILES}
+        summary['max'] = round(max(values) * 1000, 1)
+        return summary
+
+    all_samples = [seconds for values in recorder.samples.values() for seconds in values]
+    result = {
+        'elapsed_seconds': round(elapsed, 2),
+        'operations': len(all_samples),
+        'requests': recorder.requests,
+        'operations_per_second': round(len(all_samples) / elapsed, 2) if elapsed else None,
+        'requests_per_second': round(recorder.requests / elapsed, 2) if elapsed else None,
+        'latency_ms': latency(all_samples) if all_samples else None,
+        'by_operation': {
+            name: dict(count=len(values), **latency(values)) for name, values in sorted(recorder.samples.items())
+        },
+        'errors': recorder.errors,
+        'error_examples': recorder.error_examples,
+        'server_log_lock_errors': log_lock_errors
+    }
+    if before is not None and after is not None:
+        result['database'] = {key: round(after[key] - before[key], 3) for key in
+                              ('statements', 'busy_waits', 'busy_wait_seconds', 'lock_errors', 'conflict_retries')}
+        result['database']['busy_wait_threshold_ms'] = after.get('busy_wait_threshold_ms')
+    return result
+
+def print_report(result, options):
+    print("\n" + "=" * 72)
+    print(f"負荷テスト結果（仮想オペレーター {options.users}人 / {result['elapsed_seconds']}秒）")
+    print("=" * 72)
+    print(f"スループット: {result['operations_per_second']} 操作/秒（{result['requests_per_second']} リクエスト/秒）")
+    print(f"\n{'操作':<14}{'件数':>8}" + ''.join(f"{'p' + str(p):>9}" for p in PERCENTILES) + f"{'最大':>9}   (ms)")
+    rows = list(result['by_operation'].items())
+    if result['latency_ms']:
+        rows.append(('全体', dict(count=result['operations'], **result['latency_ms'])))
+    for name, stats in rows:
+        print(f"{name:<14}{stats['count']:>8}" + ''.join(f"{stats['p' + str(p)]:>9.1f}" for p in PERCENTILES)
+              + f"{stats['max']:>9.1f}")
+    print("\nエラー:")
+    if result['errors']:
+        for kind, count in sorted(result['errors'].items()):
+            print(f"  {kind}: {count}件")
+        for example in result['error_examples']:
+            print(f"    例) {example}")
+    else:
+        print("  なし")
+    print("\nデータベース（SQLite）:")
+    database = result.get('database')
+    if database:
+        print(f"  ロックエラー（database is locked）: {database['lock_errors']}件")
+        print(f"  ロック待ち（{database['busy_wait_threshold_ms']}ms以上かかった書き込み）: "
+              f"{database['busy_waits']}件 / 合計 {database['busy_wait_seconds']}秒")
+        print(f"  楽観ロックの再実行: {database['conflict_retries']}回")
+        print(f"  SQL実行数: {database['statements']}")
+    else:
+        print("  /admin/db_stats がないため、サーバーログの件数のみ表示します")
+    print(f"  サーバーログの「database is locked」: {result['server_log_lock_errors']}件")
+    print("=" * 72)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='在庫管理システムの負荷テスト（ローカルのみ）')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--ramp-up', type=float, default=0)
+    parser.add_argument('--think-ms', type=float, default=500)
+    parser.add_argument('--materials', type=int, default=30, help='空のデータベースに作る原料数')
+    parser.add_argument('--lots', type=int, default=3, help='原料あたりのロット数')
+    parser.add_argument('--recipes', type=int, default=5)
+    parser.add_argument('--database', help='コピーして使う既存の inventory.db')
+    parser.add_argument('--app-dir', default=os.path.dirname(os.path.abspath(__file__)))
+    parser.add_argument('--set', action='append', default=[], metavar='KEY=VALUE', help='settings の上書き（複数可）')
+    parser.add_argument('--url', help='起動済みのサーバー（例: http://127.0.0.1:5000）')
+    parser.add_argument('--seed', type=int, default=1, help='乱数の種（同じ値なら同じ操作列）')
+    parser.add_argument('--json', help='結果を保存する JSON ファイル')
+    return parser.parse_args(argv)
+
+def run(options):
+    rng = random.Random(options.seed)
+    settings = {}
+    for item in options.set:
+        key, _, value = item.partition('=')
+        settings[key.strip().upper()] = value
+
+    process = None
+    db_dir = None
+    log_path = None
+    try:
+        if options.url:
+            url = options.url.rstrip('/')
+        else:
+            db_dir = tempfile.mkdtemp(prefix='zaiko-loadtest-')
+            if options.database:
+                shutil.copy2(options.database, os.path.join(db_dir, 'inventory.db'))
+            process, url, log_path = start_server(os.path.abspath(options.app_dir), db_dir, settings)
+            print(f'サーバーを起動しました: {url}（データベース: {db_dir}）')
+
+        setup = Client(url)
+        setup.login()
+        ids = discover(setup)
+        if not ids['materials'] and not options.url:
+            seed(setup, options.materials, options.lots, options.recipes, rng)
+            ids = discover(setup)
+        if not ids['materials']:
+            raise RuntimeError('原料が1件もありません')
+        print(f"原料 {len(ids['materials'])}件 / ロット {sum(len(v) for v in ids['lots'].values())}件 / "
+              f"レシピ {len(ids['recipes'])}件で実行します")
+
+        recorder = Recorder()
+        before = server_db_stats(url)
+        now = time.perf_counter()
+        stop_at = now + options.ramp_up + options.duration
+        users = [
+            VirtualUser(i + 1, url, ids, recorder, now + (options.ramp_up * i / max(options.users - 1, 1)),
+                        stop_at, options.think_ms, rng.random())
+            for i in range(options.users)
+        ]
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.perf_counter() - now
+        after = server_db_stats(url)
+
+        log_lock_errors = None
+        if log_path:
+            with open(log_path, encoding='utf-8', errors='replace') as f:
+                log_lock_errors = f.read().count('database is locked')
+        result = summarize(recorder, elapsed, before, after, log_lock_errors)
+        result['settings'] = settings
+        result['users'] = options.users
+        print_report(result, options)
+        if options.json:
+            with open(options.json, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+            print(f'結果を保存しました: {options.json}')
+        return result
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+        if db_dir:
+            shutil.rmtree(db_dir, ignore_errors=True)
+
+if __name__ == '__main__':
+    try:
+        run(parse_args())
+    except KeyboardInterrupt:
+        print('\n負荷テストを中断しました')
+    except RuntimeError as e:
+        print(f'エラー: {e}')
+        sys.exit(1)
@@ -1,4 +1,5 @@
 """データベースマイグレーションスクリプト - emailフィールドとLotテーブル、予約機能拡張、レシピ機能、エクセルパス・アクションタイプを追加"""
+import re
 import sqlite3
 
 conn = sqlite3.connect('instance/inventory.db')
@@ -187,6 +188,317 @@ except sqlite3.OperationalError as e:
     else:
         print(f"エラー: {e}")
 
+try:
+    # data_versionカラムを追加（原料一覧のキャッシュ無効化用）
+    cursor.execute('ALTER TABLE raw_material ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0')
+    conn.commit()
+    print("✓ data_versionカラムを追加しました")
+except sqlite3.OperationalError as e:
+    if "duplicate column name" in str(e):
+        print("✓ data_versionカラムは既に存在します")
+    else:
+        print(f"エラー: {e}")
+
+try:
+    # 日別使用量ロールアップテーブルを作成
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS daily_usage_rollup (
+            material_id INTEGER NOT NULL,
+            day DATE NOT NULL,
+            used FLOAT NOT NULL DEFAULT 0,
+            replenished FLOAT NOT NULL DEFAULT 0,
+            tx_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (material_id, day),
+            FOREIGN KEY (material_id) REFERENCES raw_material (id)
+        )
+    ''')
+    conn.commit()
+    print("✓ daily_usage_rollupテーブルを作成しました（既存データは `flask --app app backfill-rollup` で集計してください）")
+except sqlite3.Error as e:
+    print(f"daily_usage_rollupテーブル作成エラー: {e}")
+
+try:
+    # 保管場所（拠点）テーブルを作成
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS location (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name VARCHAR(100) NOT NULL UNIQUE,
+            date_created DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    conn.commit()
+    print("✓ locationテーブルを作成しました")
+except sqlite3.Error as e:
+    print(f"locationテーブル作成エラー: {e}")
+
+for table in ('lot', 'reservation'):
+    try:
+        # 拠点IDカラムを追加（既存データは拠点指定なし）
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN location_id INTEGER REFERENCES location (id)')
+        conn.commit()
+        print(f"✓ {table}テーブルにlocation_idカラムを追加しました")
+    except sqlite3.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print(f"✓ {table}.location_idカラムは既に存在します")
+        else:
+            print(f"エラー: {e}")
+
+try:
+    # 拠点別の在庫・予約検索用インデックス
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_lot_location_material ON lot (location_id, material_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_reservation_location_pending ON reservation (location_id, executed, scheduled_date)')
+    conn.commit()
+    print("✓ 拠点別インデックスを作成しました")
+except sqlite3.Error as e:
+    print(f"インデックス作成エラー: {e}")
+
+try:
+    # ロットに使用期限カラムを追加（FEFO割当用）
+    cursor.execute('ALTER TABLE lot ADD COLUMN expiry_date DATE')
+    conn.commit()
+    print("✓ lotテーブルにexpiry_dateカラムを追加しました")
+except sqlite3.OperationalError as e:
+    if "duplicate column name" in str(e):
+        print("✓ expiry_dateカラムは既に存在します")
+    else:
+        print(f"エラー: {e}")
+
+try:
+    # ロット割当記録テーブルとFEFO割当用インデックスを作成
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lot_allocation (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            reservation_id INTEGER NOT NULL,
+            lot_id INTEGER,
+            lot_name VARCHAR(100) NOT NULL,
+            quantity FLOAT NOT NULL,
+            FOREIGN KEY (reservation_id) REFERENCES reservation (id),
+            FOREIGN KEY (lot_id) REFERENCES lot (id) ON DELETE SET NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_lot_allocation_reservation_id ON lot_allocation (reservation_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_lot_material_expiry ON lot (material_id, expiry_date, date_created)')
+    conn.commit()
+    print("✓ lot_allocationテーブルを作成しました")
+except sqlite3.Error as e:
+    print(f"lot_allocationテーブル作成エラー: {e}")
+
+for table in ('lot', 'reservation'):
+    try:
+        # 楽観ロック用のバージョンカラムを追加
+        cursor.execute(f'ALTER TABLE {table} ADD COLUMN version INTEGER NOT NULL DEFAULT 1')
+        conn.commit()
+        print(f"✓ {table}テーブルにversionカラムを追加しました")
+    except sqlite3.OperationalError as e:
+        if "duplicate column name" in str(e):
+            print(f"✓ {table}.versionカラムは既に存在します")
+        else:
+            print(f"エラー: {e}")
+
+try:
+    # 古い実行済み予約のアーカイブテーブルを作成
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS reservation_archive (
+            id INTEGER PRIMARY KEY,
+            material_id INTEGER NOT NULL,
+            lot_id INTEGER,
+            lot_name VARCHAR(100),
+            recipe_id INTEGER,
+            type VARCHAR(20) NOT NULL,
+            quantity FLOAT NOT NULL,
+            actual_quantity FLOAT,
+            user_name VARCHAR(100),
+            purpose VARCHAR(200),
+            scheduled_date DATE,
+            date DATETIME,
+            executed BOOLEAN,
+            executed_date DATETIME,
+            location_id INTEGER,
+            archived_date DATETIME DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (material_id) REFERENCES raw_material (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_reservation_archive_material_executed ON reservation_archive (material_id, executed_date)')
+    conn.commit()
+    print("✓ reservation_archiveテーブルを作成しました（`flask --app app archive-reservations` で古い履歴を移動できます）")
+except sqlite3.Error as e:
+    print(f"reservation_archiveテーブル作成エラー: {e}")
+
+try:
+    # 外部連携API用のトークン・Idempotency-Key 記録テーブルを作成
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS api_token (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name VARCHAR(100) NOT NULL UNIQUE,
+            token_hash VARCHAR(64) NOT NULL UNIQUE,
+            date_created DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_record (
+            key VARCHAR(200) NOT NULL,
+            token_id INTEGER NOT NULL,
+            request_hash VARCHAR(64) NOT NULL,
+            status_code INTEGER NOT NULL,
+            response_body TEXT NOT NULL,
+            date_created DATETIME,
+            PRIMARY KEY (key, token_id),
+            FOREIGN KEY (token_id) REFERENCES api_token (id)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_idempotency_record_date_created ON idempotency_record (date_created)')
+    conn.commit()
+    print("✓ api_token / idempotency_record テーブルを作成しました（`flask --app app create-api-token <名前>` でトークンを発行）")
+except sqlite3.Error as e:
+    print(f"APIテーブル作成エラー: {e}")
+
+try:
+    # Webhook 配信用のアウトボックステーブルを作成
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS outbox_event (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            endpoint VARCHAR(500) NOT NULL,
+            event_type VARCHAR(50) NOT NULL,
+            payload TEXT NOT NULL,
+            created_at DATETIME NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at DATETIME NOT NULL,
+            delivered_at DATETIME,
+            last_error VARCHAR(500)
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_outbox_event_pending ON outbox_event (status, endpoint, next_attempt_at)')
+    conn.commit()
+    print("✓ outbox_eventテーブルを作成しました")
+except sqlite3.Error as e:
+    print(f"outbox_eventテーブル作成エラー: {e}")
+
+try:
+    # 列指向エクスポートのウォーターマークテーブルを作成
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS export_watermark (
+            name VARCHAR(100) PRIMARY KEY,
+            watermark VARCHAR(100) NOT NULL,
+            row_count INTEGER NOT NULL DEFAULT 0,
+            updated_at DATETIME
+        )
+    ''')
+    conn.commit()
+    print("✓ export_watermarkテーブルを作成しました")
+except sqlite3.Error as e:
+    print(f"export_watermarkテーブル作成エラー: {e}")
+
+try:
+    # ロットのトレーサビリティ用テーブルを作成
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS recipe_run (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            recipe_id INTEGER NOT NULL,
+            executed_date DATETIME NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_recipe_run_recipe_id ON recipe_run (recipe_id)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lot_trace_link (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind VARCHAR(10) NOT NULL,
+            lot_id INTEGER NOT NULL,
+            source_lot_id INTEGER,
+            lot_name VARCHAR(100) NOT NULL,
+            material_id INTEGER NOT NULL,
+            reservation_id INTEGER NOT NULL,
+            recipe_run_id INTEGER,
+            quantity FLOAT NOT NULL,
+            created_at DATETIME NOT NULL
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_lot_trace_link_lot ON lot_trace_link (lot_id, kind, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_lot_trace_link_source ON lot_trace_link (source_lot_id, created_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_lot_trace_link_reservation_id ON lot_trace_link (reservation_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_lot_trace_link_recipe_run_id ON lot_trace_link (recipe_run_id)')
+    conn.commit()
+    print("✓ recipe_run / lot_trace_linkテーブルを作成しました")
+    print("  既存の履歴からリンクを作るには flask rebuild-lot-trace を実行してください")
+except sqlite3.Error as e:
+    print(f"lot_trace_linkテーブル作成エラー: {e}")
+
+try:
+    # 原料の論理削除カラムを追加
+    cursor.execute('ALTER TABLE raw_material ADD COLUMN deleted_at DATETIME')
+    conn.commit()
+    print("✓ deleted_atカラムを追加しました")
+except sqlite3.OperationalError as e:
+    if "duplicate column name" in str(e):
+        print("✓ deleted_atカラムは既に存在します")
+    else:
+        print(f"エラー: {e}")
+
+try:
+    # 原料のバックグラウンド削除ジョブ
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_raw_material_deleted_at ON raw_material (deleted_at)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS purge_job (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            material_ids TEXT NOT NULL,
+            label VARCHAR(200) NOT NULL,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            total_rows INTEGER,
+            deleted_rows INTEGER NOT NULL DEFAULT 0,
+            created_at DATETIME NOT NULL,
+            finished_at DATETIME,
+            error VARCHAR(500)
+        )
+    ''')
+    conn.commit()
+    print("✓ purge_jobテーブルを作成しました")
+except sqlite3.Error as e:
+    print(f"purge_jobテーブル作成エラー: {e}")
+
+try:
+    # 日別ロールアップに在庫調整分の使用量カラムを追加（需要予測で除くため）
+    cursor.execute('ALTER TABLE daily_usage_rollup ADD COLUMN adjusted FLOAT NOT NULL DEFAULT 0')
+    conn.commit()
+    print("✓ adjustedカラムを追加しました（既存データは `flask --app app backfill-rollup` で集計し直してください）")
+except sqlite3.OperationalError as e:
+    if "duplicate column name" in str(e):
+        print("✓ adjustedカラムは既に存在します")
+    else:
+        print(f"エラー: {e}")
+
+try:
+    # 予約IDを AUTOINCREMENT にする（アーカイブ済みの予約IDが再利用されて履歴が重複しないように）
+    table_sql = cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'reservation'").fetchone()[0]
+    if 'AUTOINCREMENT' in table_sql.upper():
+        print("✓ reservation.idは既にAUTOINCREMENTです")
+    else:
+        new_sql = re.sub(r'\bid INTEGER NOT NULL', 'id INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT', table_sql, count=1)
+        new_sql = re.sub(r',\s*PRIMARY KEY \(id\)', '', new_sql, count=1)
+        new_sql = re.sub(r'^CREATE TABLE "?reservation"?', 'CREATE TABLE reservation_new', new_sql, count=1)
+        if 'AUTOINCREMENT' not in new_sql or 'PRIMARY KEY (id)' in new_sql or 'reservation_new' not in new_sql:
+            raise sqlite3.OperationalError('reservationテーブルの定義を変換できませんでした')
+        index_sql = [row[0] for row in cursor.execute(
+            "SELECT sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND tbl_name = 'reservation' AND sql IS NOT NULL"
+        ).fetchall()]
+        cursor.execute('BEGIN')
+        cursor.execute(new_sql)
+        cursor.execute('INSERT INTO reservation_new SELECT * FROM reservation')
+        cursor.execute('DROP TABLE reservation')
+        cursor.execute('ALTER TABLE reservation_new RENAME TO reservation')
+        for sql in index_sql:
+            cursor.execute(sql)
+        # 採番はアーカイブ済みの予約IDより後から始める
+        max_id = cursor.execute(
+            'SELECT MAX(id) FROM (SELECT id FROM reservation UNION ALL SELECT id FROM reservation_archive)'
+        ).fetchone()[0] or 0
+        cursor.execute("DELETE FROM sqlite_sequence WHERE name = 'reservation'")
+        cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('reservation', ?)", (max_id,))
+        conn.commit()
+        print("✓ reservation.idをAUTOINCREMENTにしました")
+except sqlite3.Error as e:
+    conn.rollback()
+    print(f"reservationテーブル変換エラー: {e}")
+
 conn.close()
 print("\n✅ マイグレーション完了！")
 
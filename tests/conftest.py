@@ -0,0 +1,33 @@
+"""テスト用の設定: 一時フォルダのデータベースでアプリを読み込む"""
+import os
+import sys
+import tempfile
+
+import pytest
+
+_db_folder = tempfile.mkdtemp(prefix='zaiko-test-')
+os.environ['ZAIKO_DATABASE_FOLDER'] = _db_folder
+os.environ['ZAIKO_JINJA_CACHE_DIR'] = ''
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as zaiko  # noqa: E402
+
+zaiko.app.config.update(TESTING=True, WTF_CSRF_ENABLED=False)
+
+
+@pytest.fixture
+def app_module():
+    """空のデータベースとキャッシュで各テストを始める"""
+    with zaiko.app.app_context():
+        zaiko.db.drop_all()
+        zaiko.db.session.execute(zaiko.db.text('DROP TABLE IF EXISTS search_index'))
+        zaiko.db.create_all()
+        zaiko.reset_caches()
+        zaiko.ensure_search_index()
+        yield zaiko
+        zaiko.db.session.remove()
+
+
+@pytest.fixture
+def client(app_module):
+    return app_module.app.test_client()
@@ -0,0 +1,46 @@
+import pytest
+
+
+@pytest.fixture
+def auth(app_module):
+    app_module.db.session.add(app_module.ApiToken(name='test', token_hash=app_module.hash_token('secret')))
+    app_module.db.session.commit()
+    return {'Authorization': 'Bearer secret'}
+
+
+def test_idempotent_request_runs_once(app_module, client, auth):
+    headers = dict(auth, **{'Idempotency-Key': 'k1'})
+
+    first = client.post('/api/v1/materials', json={'name': '砂糖'}, headers=headers)
+    second = client.post('/api/v1/materials', json={'name': '砂糖'}, headers=headers)
+
+    assert first.status_code == second.status_code == 201
+    assert second.headers['Idempotent-Replayed'] == 'true'
+    assert second.get_json() == first.get_json()
+    assert app_module.RawMaterial.query.count() == 1
+    assert app_module.IdempotencyRecord.query.one().status_code == 201
+
+
+def test_idempotency_key_in_progress_is_a_conflict(app_module, client, auth):
+    body = {'name': '砂糖'}
+    headers = dict(auth, **{'Idempotency-Key': 'k1'})
+    client.post('/api/v1/materials', json=body, headers=headers)
+    record = app_module.IdempotencyRecord.query.one()
+    record.status_code, record.response_body = 0, ''  # 別のリクエストが処理中
+    app_module.db.session.commit()
+
+    response = client.post('/api/v1/materials', json=body, headers=headers)
+
+    assert response.status_code == 409
+    assert app_module.RawMaterial.query.count() == 1
+
+
+def test_rejected_request_does_not_keep_idempotency_key(app_module, client, auth):
+    headers = dict(auth, **{'Idempotency-Key': 'k1'})
+
+    response = client.post('/api/v1/materials', json={'name': {'ja': '砂糖'}}, headers=headers)
+
+    assert response.status_code == 400
+    assert response.get_json()['index'] == 0
+    assert app_module.IdempotencyRecord.query.count() == 0
+    assert client.post('/api/v1/materials', json={'name': '砂糖'}, headers=headers).status_code == 201
@@ -0,0 +1,45 @@
+from datetime import datetime
+
+
+def add_executed_use(app_module, material_id, quantity):
+    reservation = app_module.Reservation(material_id=material_id, type='use', quantity=quantity,
+                                         actual_quantity=quantity, executed=True, executed_date=datetime.now())
+    app_module.db.session.add(reservation)
+    app_module.db.session.commit()
+    return reservation.id
+
+
+def history(app_module):
+    rows = app_module.db.session.query(app_module.executed_history()).all()
+    return sorted((row.id, row.quantity) for row in rows)
+
+
+def test_archive_keeps_history_and_never_reuses_ids(app_module):
+    material = app_module.RawMaterial(name='砂糖', weight=0, min_weight=0)
+    app_module.db.session.add(material)
+    app_module.db.session.commit()
+    first = add_executed_use(app_module, material.id, 10)
+
+    assert app_module.archive_executed_reservations(0) == 1
+    assert app_module.Reservation.query.count() == 0
+    assert history(app_module) == [(first, 10)]
+
+    # 最大IDの予約をアーカイブした後も、新しい予約は別のIDになる
+    second = add_executed_use(app_module, material.id, 20)
+    assert second != first
+    assert app_module.archive_executed_reservations(0) == 1
+    assert history(app_module) == [(first, 10), (second, 20)]
+    assert app_module.ReservationArchive.query.count() == 2
+
+
+def test_executed_history_spans_live_and_archived_rows(app_module):
+    material = app_module.RawMaterial(name='塩', weight=0, min_weight=0)
+    app_module.db.session.add(material)
+    app_module.db.session.commit()
+    archived = add_executed_use(app_module, material.id, 5)
+    app_module.archive_executed_reservations(0)
+    live = add_executed_use(app_module, material.id, 7)
+    app_module.db.session.add(app_module.Reservation(material_id=material.id, type='use', quantity=1))
+    app_module.db.session.commit()
+
+    assert history(app_module) == [(archived, 5), (live, 7)]
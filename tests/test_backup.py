@@ -0,0 +1,26 @@
+import os
+
+
+def test_restore_discards_cached_stock(app_module, client):
+    material = app_module.RawMaterial(name='砂糖', weight=0, min_weight=0)
+    app_module.db.session.add(material)
+    app_module.db.session.commit()
+    material_id = material.id
+
+    client.post('/backup/create')
+    backup = sorted(os.listdir(app_module.get_backup_folder()))[-1]
+
+    # バックアップ後にロットを追加し、その状態を各キャッシュに載せる
+    app_module.create_lot(material_id, 'L1', 100)
+    app_module.db.session.commit()
+    assert app_module.db.session.get(app_module.RawMaterial, material_id).get_total_lot_weight() == 100
+    client.get('/')
+    assert app_module.stock_memo.stats()['entries'] and app_module.material_row_cache.stats()['entries']
+
+    client.post(f'/backup/restore/{backup}')
+
+    assert app_module.stock_memo.stats()['entries'] == 0
+    assert app_module.material_row_cache.stats()['entries'] == 0
+    assert app_module.stock_timeline_index.stats()['entries'] == 0
+    assert app_module._search_index_ready is None
+    assert app_module.db.session.get(app_module.RawMaterial, material_id).get_total_lot_weight() == 0
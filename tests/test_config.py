@@ -0,0 +1,31 @@
+import pytest
+
+
+def test_stock_memo_settings_are_accepted(app_module):
+    config = app_module.validate_config({'settings': {'STOCK_MEMO_PATH': '/tmp/memo.db', 'STOCK_MEMO_MAX_ENTRIES': 100}})
+    assert config['settings']['STOCK_MEMO_PATH'] == '/tmp/memo.db'
+    assert app_module.validate_config({'settings': {'STOCK_MEMO_PATH': None}})['settings']['STOCK_MEMO_PATH'] is None
+    with pytest.raises(app_module.ConfigError):
+        app_module.validate_config({'settings': {'STOCK_MEMO_PATH': 1}})
+
+
+def test_stock_memo_path_from_environment(app_module):
+    expected = app_module.SETTINGS_SCHEMA['STOCK_MEMO_PATH']
+    assert app_module.parse_env_value('ZAIKO_STOCK_MEMO_PATH', '/tmp/memo.db', expected) == '/tmp/memo.db'
+    assert app_module.parse_env_value('ZAIKO_STOCK_MEMO_PATH', '', expected) is None
+
+
+def test_purge_settings_are_accepted(app_module):
+    settings = app_module.validate_config({'settings': {'PURGE_CHUNK_ROWS': 200, 'PURGE_PAUSE_SECONDS': 0}})['settings']
+    assert settings == {'PURGE_CHUNK_ROWS': 200, 'PURGE_PAUSE_SECONDS': 0.0}
+
+
+def test_broken_config_file_warns_and_keeps_previous(app_module, tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_text('{"theme": "dark"}', encoding='utf-8')
+    store = app_module.ConfigStore(str(path))
+    assert store.load() == {'theme': 'dark'}
+
+    path.write_text('{"theme": ', encoding='utf-8')
+    with pytest.warns(RuntimeWarning, match='前回の設定を使います'):
+        assert store.load() == {'theme': 'dark'}
@@ -0,0 +1,17 @@
+def test_api_stats_builds_stock_overview_once(app_module, client, monkeypatch):
+    material = app_module.RawMaterial(name='砂糖', weight=0, min_weight=50)
+    app_module.db.session.add(material)
+    app_module.db.session.commit()
+    calls = []
+    overview = app_module.material_stock_overview
+
+    def counting_overview(*args, **kwargs):
+        calls.append(args)
+        return overview(*args, **kwargs)
+    monkeypatch.setattr(app_module, 'material_stock_overview', counting_overview)
+
+    stats = client.get('/api/stats').get_json()
+
+    assert len(calls) == 1
+    assert stats['total_materials'] == 1
+    assert stats['low_stock_count'] == 1
@@ -0,0 +1,21 @@
+from datetime import date
+
+
+def test_execute_use_reservation_with_zero_quantity(app_module, client):
+    material = app_module.RawMaterial(name='砂糖', weight=0, min_weight=0)
+    app_module.db.session.add(material)
+    app_module.db.session.flush()
+    lot = app_module.create_lot(material.id, 'L1', 100)
+    reservation = app_module.Reservation(material_id=material.id, lot_id=lot.id, type='use', quantity=10,
+                                         scheduled_date=date.today())
+    app_module.db.session.add(reservation)
+    app_module.db.session.commit()
+    reservation_id, lot_id = reservation.id, lot.id
+
+    client.post(f'/execute_reservation/{reservation_id}', data={'actual_quantity': '0'})
+
+    reservation = app_module.db.session.get(app_module.Reservation, reservation_id)
+    assert reservation.executed
+    assert reservation.actual_quantity == 0
+    assert reservation.lot_id == lot_id
+    assert app_module.db.session.get(app_module.Lot, lot_id).weight == 100
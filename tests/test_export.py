@@ -0,0 +1,7 @@
+import pytest
+
+
+@pytest.mark.parametrize('dataset', ['reservations', 'lots'])
+def test_updatable_datasets_reject_incremental_export(app_module, dataset):
+    with pytest.raises(ValueError):
+        app_module.write_columnar_export(dataset, None, since='1')
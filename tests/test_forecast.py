@@ -0,0 +1,27 @@
+from datetime import date
+
+
+def test_usage_matrix_excludes_stock_adjustments(app_module, client):
+    material = app_module.RawMaterial(name='砂糖', weight=0, min_weight=0)
+    app_module.db.session.add(material)
+    app_module.db.session.flush()
+    lot = app_module.create_lot(material.id, 'L1', 100)
+    app_module.db.session.commit()
+    lot_id, version = lot.id, lot.version
+
+    client.post(f'/edit_lot/{lot_id}', data={'lot_name': 'L1', 'weight': '70', 'version': str(version)})
+    app_module.db.session.expire_all()
+    reservation = app_module.Reservation(material_id=material.id, lot_id=lot_id, type='use', quantity=5,
+                                         scheduled_date=date.today())
+    app_module.db.session.add(reservation)
+    app_module.db.session.flush()
+    app_module.execute_use_reservation(reservation, 5, lot_id)
+    app_module.db.session.commit()
+
+    material_ids, usage = app_module.build_usage_matrix(7)
+    assert usage[list(material_ids).index(material.id)].sum() == 5
+
+    app_module.rebuild_daily_usage_rollup()
+    material_ids, usage = app_module.build_usage_matrix(7)
+    assert usage[list(material_ids).index(material.id)].sum() == 5
+    assert app_module.DailyUsageRollup.query.one().used == 35
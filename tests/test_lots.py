@@ -0,0 +1,50 @@
+def test_edit_lot_does_not_move_lot(app_module, client):
+    first, second = app_module.Location(name='本社'), app_module.Location(name='工場')
+    material = app_module.RawMaterial(name='砂糖', weight=0, min_weight=0)
+    app_module.db.session.add_all([first, second, material])
+    app_module.db.session.flush()
+    lot = app_module.create_lot(material.id, 'L1', 100, location_id=first.id)
+    app_module.db.session.commit()
+    lot_id, first_id, second_id, version = lot.id, first.id, second.id, lot.version
+
+    page = client.get(f'/edit_lot/{lot_id}').get_data(as_text=True)
+    assert f'/transfer_lot/{lot_id}' in page
+
+    response = client.post(f'/edit_lot/{lot_id}', data={'lot_name': 'L1', 'weight': '100', 'location_id': str(second_id),
+                                                        'version': str(version)})
+    assert response.status_code == 302
+    app_module.db.session.expire_all()
+    assert app_module.db.session.get(app_module.Lot, lot_id).location_id == first_id
+
+
+def test_edit_lot_without_version_is_a_conflict(app_module, client):
+    material = app_module.RawMaterial(name='塩', weight=0, min_weight=0)
+    app_module.db.session.add(material)
+    app_module.db.session.flush()
+    lot = app_module.create_lot(material.id, 'L1', 100)
+    app_module.db.session.commit()
+    lot_id = lot.id
+
+    response = client.post(f'/edit_lot/{lot_id}', data={'lot_name': 'L1', 'weight': '10'})
+
+    assert response.status_code == 409
+    app_module.db.session.expire_all()
+    assert app_module.db.session.get(app_module.Lot, lot_id).weight == 100
+
+
+def test_edit_reservation_without_version_is_a_conflict(app_module, client):
+    material = app_module.RawMaterial(name='塩', weight=0, min_weight=0)
+    app_module.db.session.add(material)
+    app_module.db.session.flush()
+    reservation = app_module.Reservation(material_id=material.id, type='use', quantity=10)
+    app_module.db.session.add(reservation)
+    app_module.db.session.commit()
+    reservation_id = reservation.id
+
+    client.post(f'/edit_reservation/{reservation_id}', data={'quantity': '99'})
+    app_module.db.session.expire_all()
+    assert app_module.db.session.get(app_module.Reservation, reservation_id).quantity == 10
+
+    client.post(f'/edit_reservation/{reservation_id}', data={'quantity': '99', 'version': '1'})
+    app_module.db.session.expire_all()
+    assert app_module.db.session.get(app_module.Reservation, reservation_id).quantity == 99
@@ -0,0 +1,69 @@
+import os
+import time
+
+import pytest
+
+
+@pytest.fixture
+def routing(app_module, monkeypatch):
+    def use(mode):
+        monkeypatch.setitem(app_module.app.config, 'READ_ROUTING', mode)
+    yield use
+    if app_module._snapshot_refresher is not None:
+        app_module._snapshot_refresher.join()
+    with app_module.app.app_context():
+        path = app_module.snapshot_path()
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def wait_for_snapshot(app_module):
+    app_module._snapshot_refresher.join()
+
+
+def export(app_module, client):
+    """テストではアプリコンテキストを共有するので、振り分け先の接続をリクエストごとに外す"""
+    response = client.get('/export')
+    app_module.g.pop('read_engine', None)
+    app_module.db.session.remove()
+    return response
+
+
+@pytest.mark.parametrize('mode, source', [('primary', 'primary'), ('readonly', 'readonly')])
+def test_read_routing_headers(app_module, client, routing, mode, source):
+    routing(mode)
+    response = export(app_module, client)
+    assert response.headers['X-Data-Source'] == source
+    assert response.headers['X-Data-Staleness'] == '0.0'
+
+
+def test_snapshot_is_refreshed_in_the_background(app_module, client, routing):
+    routing('snapshot')
+    app_module.db.session.add(app_module.RawMaterial(name='砂糖', weight=0, min_weight=0))
+    app_module.db.session.commit()
+
+    # 最初の複製が終わるまでは本体を読み取り専用で読む
+    first = export(app_module, client)
+    assert first.headers['X-Data-Source'] == 'readonly'
+    wait_for_snapshot(app_module)
+
+    second = export(app_module, client)
+    assert second.headers['X-Data-Source'] == 'snapshot'
+    assert float(second.headers['X-Data-Staleness']) < 60
+    assert second.headers['X-Data-Max-Staleness'] == '60'
+    assert '砂糖' in second.get_data().decode('utf-8-sig')
+
+    # 古くなったら既存のスナップショットを返しつつ取り直す
+    path = app_module.snapshot_path()
+    old = time.time() - 600
+    os.utime(path, (old, old))
+    app_module.db.session.add(app_module.RawMaterial(name='塩', weight=0, min_weight=0))
+    app_module.db.session.commit()
+    stale = export(app_module, client)
+    assert stale.headers['X-Data-Source'] == 'snapshot'
+    assert float(stale.headers['X-Data-Staleness']) >= 600
+    wait_for_snapshot(app_module)
+
+    fresh = export(app_module, client)
+    assert float(fresh.headers['X-Data-Staleness']) < 60
+    assert '塩' in fresh.get_data().decode('utf-8-sig')
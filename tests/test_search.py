@@ -0,0 +1,41 @@
+def add_material(zaiko, name):
+    material = zaiko.RawMaterial(name=name, weight=0, min_weight=0)
+    zaiko.db.session.add(material)
+    zaiko.db.session.commit()
+    return material
+
+
+def test_short_kanji_queries_find_materials(app_module):
+    add_material(app_module, '砂糖')
+    add_material(app_module, '食塩')
+    add_material(app_module, '小麦粉')
+
+    assert [row.label for row in app_module.search_entries('砂')] == ['砂糖']
+    assert [row.label for row in app_module.search_entries('砂糖')] == ['砂糖']
+    assert [row.label for row in app_module.search_entries('塩')] == ['食塩']
+    # 3文字以上は FTS5 の trigram で引く
+    assert [row.label for row in app_module.search_entries('小麦粉')] == ['小麦粉']
+
+
+def test_short_query_finds_lots_and_index_page(app_module, client):
+    material = add_material(app_module, '食塩')
+    app_module.create_lot(material.id, '塩A', 100)
+    app_module.db.session.commit()
+
+    kinds = {(row.kind, row.label) for row in app_module.search_entries('塩', kinds=['material', 'lot'])}
+    assert kinds == {('material', '食塩'), ('lot', '塩A')}
+    assert '食塩' in client.get('/?search=塩').get_data(as_text=True)
+
+
+def test_soft_deleted_materials_are_not_searchable(app_module, client):
+    salt = add_material(app_module, 'salt')
+    app_module.create_lot(salt.id, 'salt-lot', 100)
+    add_material(app_module, 'sugar')
+    app_module.db.session.commit()
+
+    client.get(f'/delete/{salt.id}')
+
+    # 削除ジョブの完了前（関連データがまだ残っている間）も検索に出ない
+    for query in ('salt', 'sa', 'lot'):
+        assert client.get(f'/api/search?q={query}').get_json()['results'] == []
+    assert [row['label'] for row in client.get('/api/search?q=sug').get_json()['results']] == ['sugar']
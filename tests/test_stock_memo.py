@@ -0,0 +1,23 @@
+import pytest
+
+
+@pytest.mark.parametrize('disk_tier', [False, True])
+def test_rolled_back_version_is_not_memoized(app_module, monkeypatch, tmp_path, disk_tier):
+    memo = app_module.StockMemo(100, str(tmp_path / 'memo.db') if disk_tier else None)
+    monkeypatch.setattr(app_module, 'stock_memo', memo)
+    material = app_module.RawMaterial(name='砂糖', weight=0, min_weight=0)
+    app_module.db.session.add(material)
+    app_module.db.session.commit()
+    material_id = material.id
+
+    app_module.db.session.add(app_module.Lot(material_id=material_id, lot_name='L1', weight=100.0))
+    app_module.db.session.flush()
+    assert app_module.db.session.get(app_module.RawMaterial, material_id).get_total_lot_weight() == 100.0
+    app_module.db.session.rollback()
+
+    app_module.db.session.add(app_module.Lot(material_id=material_id, lot_name='L2', weight=1.0))
+    app_module.db.session.commit()
+    material = app_module.db.session.get(app_module.RawMaterial, material_id)
+    assert material.get_total_lot_weight() == 1.0
+    assert material.get_total_lot_weight() == 1.0
+    assert memo.stats()['hits'] + memo.stats()['disk_hits'] == 1
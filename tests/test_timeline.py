@@ -0,0 +1,132 @@
+import random
+from datetime import date, timedelta
+
+from timeline import StockTimeline
+
+
+def lowest_during_day(base_date, days, current_stock, events):
+    """各日の「前日の終わり - その日の使用」をそのまま計算する"""
+    values = []
+    end_of_day = current_stock
+    for i in range(days):
+        day_events = [(delta, replenish) for day, delta, replenish in events
+                      if min(max((day - base_date).days, 0), days - 1) == i]
+        values.append(end_of_day + sum(delta for delta, replenish in day_events if not replenish))
+        end_of_day += sum(delta for delta, _ in day_events)
+    return values
+
+
+def test_timeline_matches_brute_force_and_reads_do_not_modify_tree():
+    rng = random.Random(1)
+    base_date = date(2026, 1, 1)
+    days = 20
+    events = []
+    timeline = StockTimeline(base_date, days, 50.0)
+    for _ in range(200):
+        day = base_date + timedelta(days=rng.randrange(-2, days + 3))
+        if events and rng.random() < 0.3:
+            day, delta, replenish = events.pop(rng.randrange(len(events)))
+            timeline.add(day, -delta, replenish)
+        else:
+            replenish = rng.random() < 0.5
+            delta = rng.randrange(1, 30) * (1 if replenish else -1)
+            events.append((day, delta, replenish))
+            timeline.add(day, delta, replenish)
+
+        expected = lowest_during_day(base_date, days, 50.0, events)
+        start = rng.randrange(days)
+        before = (list(timeline._min), list(timeline._lazy))
+        value, at = timeline.min_from(base_date + timedelta(days=start))
+        assert value == min(expected[start:])
+        assert at == base_date + timedelta(days=expected.index(value, start))
+        assert timeline.value_at(base_date + timedelta(days=start)) == expected[start]
+        assert (list(timeline._min), list(timeline._lazy)) == before
+
+    rebuilt = StockTimeline(base_date, days, 50.0, events)
+    assert [rebuilt.value_at(base_date + timedelta(days=i)) for i in range(days)] == \
+        lowest_during_day(base_date, days, 50.0, events)
+
+
+def test_dashboard_alerts_include_intra_day_dip(app_module, client):
+    material = app_module.RawMaterial(name='塩', weight=0, min_weight=50)
+    app_module.db.session.add(material)
+    app_module.db.session.flush()
+    app_module.create_lot(material.id, 'L1', 100)
+    tomorrow = date.today() + timedelta(days=1)
+    app_module.db.session.add_all([
+        app_module.Reservation(material_id=material.id, type='use', quantity=80, scheduled_date=tomorrow),
+        app_module.Reservation(material_id=material.id, type='replenish', quantity=80, scheduled_date=tomorrow),
+    ])
+    app_module.db.session.commit()
+
+    alerts = client.get('/api/dashboard/alerts').get_json()['alerts']
+    assert [alert['id'] for alert in alerts] == [material.id]
+
+
+def test_reserve_use_counts_undated_pending_uses(app_module, client):
+    material = app_module.RawMaterial(name='砂糖', weight=0, min_weight=10)
+    app_module.db.session.add(material)
+    app_module.db.session.flush()
+    app_module.create_lot(material.id, 'L1', 100)
+    app_module.db.session.add(app_module.Reservation(material_id=material.id, type='use', quantity=90))
+    app_module.db.session.commit()
+
+    client.post(f'/reserve_use/{material.id}', data={'lot_id': '0', 'quantity': '50', 'location_id': '0'})
+
+    with client.session_transaction() as session:
+        messages = [message for category, message in session.get('_flashes', [])]
+    assert any('警告' in message and '-40.0g' in message for message in messages)
+
+
+def test_cold_alert_prefilter_builds_timelines_in_bulk(app_module, client):
+    from sqlalchemy import event
+
+    tomorrow = date.today() + timedelta(days=1)
+    for i in range(200):
+        material = app_module.RawMaterial(name=f'原料{i}', weight=0, min_weight=50)
+        app_module.db.session.add(material)
+        app_module.db.session.flush()
+        app_module.db.session.add(app_module.Lot(material_id=material.id, lot_name='L1', weight=100))
+        app_module.db.session.add(app_module.Reservation(material_id=material.id, type='use',
+                                                         quantity=60 if i % 2 else 10, scheduled_date=tomorrow))
+    app_module.db.session.commit()
+    app_module.reset_caches()
+    expected = sorted(m['id'] for m in app_module.material_stock_overview() if m['critical_periods'])
+
+    statements = []
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(app_module.db.engine, 'before_cursor_execute', count)
+    try:
+        alerts = client.get('/api/dashboard/alerts?limit=500').get_json()
+    finally:
+        event.remove(app_module.db.engine, 'before_cursor_execute', count)
+
+    assert sorted(alert['id'] for alert in alerts['alerts']) == expected
+    assert len(expected) == 100
+    assert len(statements) < 20
+
+
+def lowest_stock(app_module, material_id):
+    version = app_module.db.session.query(app_module.RawMaterial.data_version).filter_by(id=material_id).scalar()
+    return app_module.stock_timeline_index.min_from(material_id, version, date.today())[0]
+
+
+def test_rolled_back_timeline_is_not_cached(app_module):
+    material = app_module.RawMaterial(name='砂糖', weight=0, min_weight=0)
+    app_module.db.session.add(material)
+    app_module.db.session.commit()
+    material_id = material.id
+
+    app_module.db.session.add(app_module.Lot(material_id=material_id, lot_name='L1', weight=100.0))
+    app_module.db.session.flush()
+    assert lowest_stock(app_module, material_id) == 100.0
+    app_module.db.session.rollback()
+
+    # 別のプロセスのコミット（このプロセスのインデックスには差分が届かない）
+    with app_module.db.engine.begin() as connection:
+        connection.exec_driver_sql("INSERT INTO lot (material_id, lot_name, weight, version) VALUES (?, 'L2', 1.0, 1)",
+                                   (material_id,))
+        connection.exec_driver_sql('UPDATE raw_material SET data_version = data_version + 1 WHERE id = ?',
+                                   (material_id,))
+    assert lowest_stock(app_module, material_id) == 1.0
@@ -0,0 +1,24 @@
+def trace_links(app_module):
+    return sorted((link.kind, link.lot_id, link.reservation_id, link.quantity)
+                  for link in app_module.LotTraceLink.query)
+
+
+def test_rebuild_lot_trace_skips_stock_adjustments(app_module, client):
+    material = app_module.RawMaterial(name='小麦粉', weight=0, min_weight=0)
+    app_module.db.session.add(material)
+    app_module.db.session.flush()
+    lot = app_module.create_lot(material.id, 'L1', 100)
+    app_module.db.session.commit()
+    lot_id = lot.id
+
+    for weight in ('80', '90'):
+        version = app_module.db.session.get(app_module.Lot, lot_id).version
+        client.post(f'/edit_lot/{lot_id}', data={'lot_name': 'L1', 'weight': weight, 'location_id': '0',
+                                                 'version': str(version)})
+        app_module.db.session.expire_all()
+    assert app_module.Reservation.query.filter(app_module.Reservation.purpose.like('ロット直接編集%')).count() == 2
+    live = trace_links(app_module)
+
+    app_module.rebuild_lot_trace()
+
+    assert trace_links(app_module) == live == [('produce', lot_id, 1, 100.0)]
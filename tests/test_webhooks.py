@@ -0,0 +1,146 @@
+import hmac
+import json
+import threading
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+
+@pytest.fixture
+def receiver():
+    """ローカルの受信サーバー（statuses の順に応答し、尽きたら 204）"""
+    received = []
+    statuses = []
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            received.append((dict(self.headers), body))
+            self.send_response(statuses.pop(0) if statuses else 204)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}/hook', received, statuses
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def webhook(app_module, monkeypatch, receiver):
+    url, received, statuses = receiver
+    monkeypatch.setitem(app_module.app.config, 'WEBHOOK_ENDPOINTS', [{'url': url, 'secret': 's3cret'}])
+    return received, statuses
+
+
+@pytest.fixture
+def stock_webhook(app_module, monkeypatch, webhook):
+    """在庫イベントだけを購読するエンドポイント（create_lot の実行イベントを除く）"""
+    endpoint = dict(app_module.app.config['WEBHOOK_ENDPOINTS'][0], events=['stock.below_minimum', 'stock.recovered'])
+    monkeypatch.setitem(app_module.app.config, 'WEBHOOK_ENDPOINTS', [endpoint])
+    monkeypatch.setitem(app_module.app.config, 'WEBHOOK_BACKOFF_SECONDS', 10)
+    monkeypatch.setitem(app_module.app.config, 'WEBHOOK_MAX_ATTEMPTS', 2)
+    return webhook
+
+
+def outbox(app_module):
+    app_module.db.session.expire_all()
+    return app_module.OutboxEvent.query.order_by(app_module.OutboxEvent.id).all()
+
+
+def make_due(app_module):
+    app_module.OutboxEvent.query.update({'next_attempt_at': datetime.now()})
+    app_module.db.session.commit()
+
+
+def test_stock_changes_enqueue_events_in_the_same_transaction(app_module, webhook):
+    material = app_module.RawMaterial(name='砂糖', weight=0, min_weight=50)
+    app_module.db.session.add(material)
+    app_module.db.session.flush()
+    lot = app_module.create_lot(material.id, 'L1', 100)
+    app_module.db.session.commit()
+
+    reservation = app_module.Reservation(material_id=material.id, lot_id=lot.id, type='use', quantity=60,
+                                         scheduled_date=date.today())
+    app_module.db.session.add(reservation)
+    app_module.db.session.flush()
+    app_module.execute_use_reservation(reservation, 60, lot.id)
+    app_module.db.session.commit()
+
+    lot.weight = 45
+    app_module.db.session.commit()  # 最低量未満のまま（イベントなし）
+    lot.weight = 80
+    app_module.db.session.commit()
+
+    # ロールバックされた変更はイベントにならない
+    lot.weight = 0
+    app_module.db.session.flush()
+    app_module.db.session.rollback()
+
+    events = [(e.event_type, json.loads(e.payload)) for e in outbox(app_module)]
+    # create_lot の補充実績と使用予約の実行もそれぞれ reservation.executed になる
+    assert [event_type for event_type, _ in events] == [
+        'stock.recovered', 'reservation.executed', 'stock.below_minimum', 'reservation.executed', 'stock.recovered']
+    assert events[3][1]['reservation_id'] == reservation.id
+    assert events[3][1]['allocations'] == [{'lot_name': 'L1', 'quantity': 60}]
+    assert (events[2][1]['previous'], events[2][1]['current']) == (100, 40)
+    # コミットで期限切れになったロットへの代入でも変更前の重量から判定する
+    assert (events[4][1]['previous'], events[4][1]['current']) == (45, 80)
+
+
+def test_dispatch_signs_batches_and_retries_after_failure(app_module, stock_webhook):
+    received, statuses = stock_webhook
+    material = app_module.RawMaterial(name='塩', weight=0, min_weight=50)
+    app_module.db.session.add(material)
+    app_module.db.session.flush()
+    app_module.create_lot(material.id, 'L1', 100)
+    app_module.db.session.commit()
+
+    statuses.append(500)
+    assert app_module.dispatch_outbox_once() == {'delivered': 0, 'retry': 1, 'dead': 0}
+    event = outbox(app_module)[0]
+    assert (event.status, event.attempts) == ('pending', 1)
+    assert event.next_attempt_at > datetime.now()
+    assert 'HTTP Error 500' in event.last_error
+    # 再送時刻になるまでは送らない
+    assert app_module.dispatch_outbox_once() == {'delivered': 0, 'retry': 0, 'dead': 0}
+
+    make_due(app_module)
+    assert app_module.dispatch_outbox_once() == {'delivered': 1, 'retry': 0, 'dead': 0}
+    event = outbox(app_module)[0]
+    assert event.status == 'delivered' and event.last_error is None
+
+    headers, body = received[-1]
+    expected = 'sha256=' + app_module.sign_webhook('s3cret', headers['X-Webhook-Timestamp'], body)
+    assert hmac.compare_digest(headers['X-Webhook-Signature'], expected)
+    payload = json.loads(body)
+    assert [(item['id'], item['type']) for item in payload['events']] == [(event.id, 'stock.recovered')]
+
+
+def test_events_are_dead_lettered_and_can_be_redelivered(app_module, stock_webhook):
+    received, statuses = stock_webhook
+    material = app_module.RawMaterial(name='胡椒', weight=0, min_weight=50)
+    app_module.db.session.add(material)
+    app_module.db.session.flush()
+    app_module.create_lot(material.id, 'L1', 100)
+    app_module.db.session.commit()
+
+    statuses.extend([500, 500])
+    assert app_module.dispatch_outbox_once()['retry'] == 1
+    make_due(app_module)
+    assert app_module.dispatch_outbox_once()['dead'] == 1
+    assert outbox(app_module)[0].status == 'dead'
+    make_due(app_module)
+    assert app_module.dispatch_outbox_once() == {'delivered': 0, 'retry': 0, 'dead': 0}
+
+    result = app_module.app.test_cli_runner().invoke(args=['webhook-redeliver'])
+    assert '1件を配信待ちに戻しました' in result.output
+    event = outbox(app_module)[0]
+    assert (event.status, event.attempts) == ('pending', 0)
+    assert app_module.dispatch_outbox_once()['delivered'] == 1
+    assert len(received) == 3
@@ -0,0 +1,141 @@
+"""在庫タイムライン - 原料ごとの予定在庫を日単位のセグメント木で保持する
+
+位置 i は基準日から i 日後の「その日のうちに取りうる最小の予定在庫」
+（前日の終わりの予定在庫からその日の使用予約をすべて引いた量）。同じ日の使用と
+補充の順序によらず危機期間の計算（compute_critical_periods）以下の値になるので、
+この値で不足を判定すれば日中だけの落ち込みも見逃さない。
+使用予約は「予定日以降すべての日に -数量」、補充予約は「予定日の翌日以降に +数量」
+の区間加算になるので、遅延伝播付きセグメント木（区間加算・区間最小）で管理する。
+予約1件の追加・取消と「D日以降の最小予定在庫」の問い合わせはどちらも O(log n)。
+参照系のメソッドは木を書き換えないが、add() と同時に呼ぶ場合は呼び出し側で排他する。
+"""
+from datetime import date
+
+INF = float('inf')
+
+
+class StockTimeline:
+    """基準日から days 日分の予定在庫（範囲外の日付は先頭・末尾に丸める）"""
+
+    def __init__(self, base_date, days, current_stock=0.0, events=()):
+        size = 1
+        while size < days:
+            size *= 2
+        self.base_date = base_date
+        self.days = days
+        self.size = size
+
+        deltas = [0.0] * (days + 1)
+        for day, delta, replenish in events:
+            deltas[self.position(day) + (1 if replenish else 0)] += delta
+        self._min = [INF] * (2 * size)
+        self._lazy = [0.0] * (2 * size)
+        running = current_stock
+        for i, delta in enumerate(deltas[:days]):
+            running += delta
+            self._min[size + i] = running
+        for node in range(size - 1, 0, -1):
+            self._min[node] = min(self._min[2 * node], self._min[2 * node + 1])
+
+    def position(self, day):
+        """日付を位置に変換する（None と基準日より前は基準日、範囲外は末尾）"""
+        if day is None:
+            return 0
+        return min(max((day - self.base_date).days, 0), self.days - 1)
+
+    def day_at(self, position):
+        return date.fromordinal(self.base_date.toordinal() + position)
+
+    def add(self, day, delta, replenish=False):
+        """予約の追加・取消・在庫の増減を反映する
+
+        delta は day 以降の予定在庫すべてに加える。補充予約（replenish）は
+        同じ日の使用より後になるとは限らないので、翌日以降にだけ加える。
+        """
+        start = self.position(day) + (1 if replenish else 0)
+        if delta and start < self.days:
+            self._add(start, self.days - 1, delta, 1, 0, self.size - 1)
+
+    def value_at(self, day):
+        """day のうちに取りうる最小の予定在庫"""
+        position = self.position(day)
+        return self._range_min(position, position, 1, 0, self.size - 1)
+
+    def min_from(self, day):
+        """day 以降の最小予定在庫と、それが最初に現れる日付"""
+        nodes = []
+        self._cover(self.position(day), self.days - 1, 1, 0, self.size - 1, 0.0, nodes)
+        node, lo, hi, pending = min(nodes, key=lambda covered: self._min[covered[0]] + covered[3])
+        value = self._min[node] + pending
+        # 最小値を持つ区間の中を、小さい方の子（同値なら左）へ降りて位置を求める
+        # （兄弟の保留加算は共通なので、比較には _min をそのまま使える）
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._min[2 * node] <= self._min[2 * node + 1]:
+                node, hi = 2 * node, mid
+            else:
+                node, lo = 2 * node + 1, mid + 1
+        return value, self.day_at(lo)
+
+    def first_below(self, threshold, day):
+        """day 以降で予定在庫が threshold を下回る最初の日付（なければ None）"""
+        found = self._find_first(self.position(day), threshold, 1, 0, self.size - 1, 0.0)
+        return None if found < 0 else self.day_at(found)
+
+    def _push(self, node):
+        lazy = self._lazy[node]
+        if lazy:
+            for child in (2 * node, 2 * node + 1):
+                self._min[child] += lazy
+                self._lazy[child] += lazy
+            self._lazy[node] = 0.0
+
+    def _add(self, left, right, delta, node, lo, hi):
+        if right < lo or hi < left:
+            return
+        if left <= lo and hi <= right:
+            self._min[node] += delta
+            self._lazy[node] += delta
+            return
+        self._push(node)
+        mid = (lo + hi) // 2
+        self._add(left, right, delta, 2 * node, lo, mid)
+        self._add(left, right, delta, 2 * node + 1, mid + 1, hi)
+        self._min[node] = min(self._min[2 * node], self._min[2 * node + 1])
+
+    # 参照系は _push せず、祖先の保留加算 pending を足しながら降りる（木を書き換えない）
+
+    def _cover(self, left, right, node, lo, hi, pending, nodes):
+        """[left, right] を覆う節点を左から順に (節点, lo, hi, 祖先の保留加算) で集める"""
+        if right < lo or hi < left:
+            return
+        if left <= lo and hi <= right:
+            nodes.append((node, lo, hi, pending))
+            return
+        pending += self._lazy[node]
+        mid = (lo + hi) // 2
+        self._cover(left, right, 2 * node, lo, mid, pending, nodes)
+        self._cover(left, right, 2 * node + 1, mid + 1, hi, pending, nodes)
+
+    def _range_min(self, left, right, node, lo, hi, pending=0.0):
+        if right < lo or hi < left:
+            return INF
+        if left <= lo and hi <= right:
+            return self._min[node] + pending
+        pending += self._lazy[node]
+        mid = (lo + hi) // 2
+        return min(self._range_min(left, right, 2 * node, lo, mid, pending),
+                   self._range_min(left, right, 2 * node + 1, mid + 1, hi, pending))
+
+    def _find_first(self, left, threshold, node, lo, hi, pending):
+        """left 以降で値が threshold 未満の最初の位置（なければ -1）"""
+        if hi < left or self._min[node] + pending >= threshold:
+            return -1
+        if lo == hi:
+            return lo
+        pending += self._lazy[node]
+        mid = (lo + hi) // 2
+        found = self._find_first(left, threshold, 2 * node, lo, mid, pending)
+        if found < 0:
+            found = self._find_first(left, threshold, 2 * node + 1, mid + 1, hi, pending)
+        return found